@@ -0,0 +1,601 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for stages of the pipeline
+Each bench_ function returns a list of summary dictionaries, one per
+implementation timed, which are printed as json lines when run as a script
+
+@author: markfunke
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import requests
+import numpy as np
+import pandas as pd
+from bs4 import BeautifulSoup
+from PIL import Image
+from sklearn.decomposition import NMF
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+from textblob import TextBlob
+from palettable.colorbrewer.diverging import Spectral_9
+try:
+    from matplotlib.colors import makeMappingArray
+except ImportError:
+    # renamed in matplotlib 3.3
+    from matplotlib.colors import _create_lookup_table as makeMappingArray
+
+import crawl_store
+import corpus_format
+import synthetic_corpus
+from extractors import extract_article_text
+from http_cache import ResponseCache
+from scraper import parse_api, parse_api_columns, nyt_lgbtq_api, fetch_weeks, scrape_articles
+from preprocessing import (clean_text, clean_texts, LemmaCache, load_nlp_models, lemmatize_text, lemmatize_documents,
+                           shard_path, load_shards)
+from modeling import (sentiment_scores, sentiment_lexicon_scores, LEXICON_TOLERANCE,
+                      vectorize_corpus, top_topic_words)
+from word_cloud import gradient_mask, render_word_clouds
+from dedup import minhash_texts, lsh_candidates, verify_pairs, cluster_pairs
+
+def time_per_item(func, items):
+    """
+    Calls func on each item and returns array of seconds taken per call
+    """
+    times = np.empty(len(items))
+    for n, item in enumerate(items):
+        start = time.perf_counter()
+        func(item)
+        times[n] = time.perf_counter() - start
+    return times
+
+def summarize(stage, times, n_bytes=None, **extra):
+    """
+    Summarizes per-item timings into throughput and latency percentiles
+
+    Parameters
+    ----------
+    stage : string
+        name of stage / implementation timed
+    times : array
+        seconds taken per item
+    n_bytes : int
+        total input bytes, adds MB/s to the summary if given
+    **extra : added to the summary as-is
+
+    Returns
+    -------
+    summary : dictionary
+
+    """
+    total = float(np.sum(times))
+    summary = {"stage": stage, "items": len(times), "seconds": round(total, 4),
+               "items_per_s": round(len(times) / total, 1) if total else None,
+               "mean_ms": round(float(np.mean(times)) * 1000, 3),
+               "p50_ms": round(float(np.percentile(times, 50)) * 1000, 3),
+               "p95_ms": round(float(np.percentile(times, 95)) * 1000, 3),
+               "p99_ms": round(float(np.percentile(times, 99)) * 1000, 3)}
+    if n_bytes is not None:
+        summary["mb_per_s"] = round(n_bytes / 1e6 / total, 2) if total else None
+    summary.update(extra)
+    return summary
+
+def bs4_article_text(page):
+    # extraction as originally done in scraper.scrape_article_text
+    soup = BeautifulSoup(page, "lxml")
+    return ' '.join([p.text for p in soup.find_all("p", {'class':'css-158dogj evys1bk0'})])
+
+def bench_extract(pages):
+    """
+    Times article body extraction per page, full BeautifulSoup parse
+    against the compiled XPath extractor
+
+    Parameters
+    ----------
+    pages : list
+        html of article pages (string or bytes)
+
+    Returns
+    -------
+    list of summary dictionaries, see summarize
+
+    """
+    n_bytes = sum(len(page) for page in pages)
+    old = [bs4_article_text(page) for page in pages]
+    new = [extract_article_text(page) for page in pages]
+    # pages where both found text under the original selector should match exactly
+    same = sum(a == b for a, b in zip(old, new) if a)
+    return [summarize("extract_bs4", time_per_item(bs4_article_text, pages), n_bytes,
+                      empty=sum(not a for a in old)),
+            summarize("extract_lxml", time_per_item(extract_article_text, pages), n_bytes,
+                      empty=sum(not b for b in new), matches_bs4=same)]
+
+def bench_parse(responses):
+    """
+    Times parsing of Article Search json into a DataFrame, per-response
+    parse_api dictionaries against one batch parse_api_columns pass
+
+    Parameters
+    ----------
+    responses : list
+        json outputs from Article Search API
+
+    Returns
+    -------
+    list of summary dictionaries, see summarize
+
+    """
+    n_docs = sum(len(articles['response']['docs']) for articles in responses)
+    start = time.perf_counter()
+    old = pd.concat([pd.DataFrame(parse_api(articles)) for articles in responses], ignore_index=True)
+    old_time = time.perf_counter() - start
+    start = time.perf_counter()
+    new = pd.DataFrame(parse_api_columns(responses))
+    new_time = time.perf_counter() - start
+    same = bool((old.astype(str).values == new[old.columns].astype(str).values).all())
+    # one timing for the whole batch, reported per document
+    return [summarize("parse_dicts", np.full(n_docs, old_time / max(n_docs, 1))),
+            summarize("parse_columns", np.full(n_docs, new_time / max(n_docs, 1)), matches_parse_api=same)]
+
+def bench_clean(texts):
+    """
+    Times text cleaning, clean_text per row through Series.apply against
+    the clean_texts batch cleaner, and checks they give identical output
+
+    Parameters
+    ----------
+    texts : list
+        documents of raw article text
+
+    Returns
+    -------
+    list of summary dictionaries, see summarize
+
+    """
+    n_bytes = sum(len(text.encode()) for text in texts)
+    series = pd.Series(texts)
+    start = time.perf_counter()
+    old = series.apply(clean_text)
+    old_time = time.perf_counter() - start
+    start = time.perf_counter()
+    new = clean_texts(series)
+    new_time = time.perf_counter() - start
+    mismatches = int((old != new).sum())
+    if mismatches:
+        raise AssertionError(f"clean_texts differs from clean_text on {mismatches} documents")
+    n = max(len(texts), 1)
+    return [summarize("clean_apply", np.full(n, old_time / n), n_bytes),
+            summarize("clean_batch", np.full(n, new_time / n), n_bytes)]
+
+def textblob_sentiment(text):
+    # scoring as originally done in modeling.sentiment_analysis
+    return TextBlob(text).sentiment.polarity, TextBlob(text).sentiment.subjectivity
+
+def bench_sentiment(texts, n_jobs=None):
+    """
+    Times sentiment scoring: two TextBlob calls per document, the one-pass
+    process pool, and the vectorized lexicon scoring, and reports how
+    many lexicon scores fall within LEXICON_TOLERANCE of TextBlob
+
+    Parameters
+    ----------
+    texts : list
+        documents cleaned with clean_text
+    n_jobs : int
+        worker processes for sentiment_scores
+
+    Returns
+    -------
+    list of summary dictionaries, see summarize
+
+    """
+    n = max(len(texts), 1)
+    n_bytes = sum(len(text.encode()) for text in texts)
+    old_times = time_per_item(textblob_sentiment, texts)
+    start = time.perf_counter()
+    pol, sub = sentiment_scores(texts, n_jobs=n_jobs)
+    pool_time = time.perf_counter() - start
+    start = time.perf_counter()
+    lex_pol, lex_sub = sentiment_lexicon_scores(texts)
+    lex_time = time.perf_counter() - start
+    diff = np.maximum(np.abs(lex_pol - pol), np.abs(lex_sub - sub))
+    return [summarize("sentiment_textblob", old_times, n_bytes),
+            summarize("sentiment_pool", np.full(n, pool_time / n), n_bytes),
+            summarize("sentiment_lexicon", np.full(n, lex_time / n), n_bytes,
+                      mean_abs_diff=round(float(diff.mean()), 4), max_abs_diff=round(float(diff.max()), 4),
+                      within_tolerance=round(float((diff <= LEXICON_TOLERANCE).mean()), 4))]
+
+def gradient_mask_loop(mask, gradient_orientation, cmap=Spectral_9.mpl_colormap):
+    # pixel loop as originally done in word_cloud.gradient_cloud
+    mask = mask.copy()
+    imgsize = mask.size
+    palette = makeMappingArray(imgsize[1], cmap)
+    for y in range(imgsize[1]):
+        for x in range(imgsize[0]):
+            if mask.getpixel((x,y)) != (255,255,255):
+                color = palette[y] if gradient_orientation == "vertical" else palette[x]
+                r = int(color[0] * 255)
+                g = int(color[1] * 255)
+                b = int(color[2] * 255)
+                mask.putpixel((x, y), (r, g, b))
+    return np.array(mask)
+
+def synthetic_icon(width, height):
+    """
+    Returns RGBA mask of a filled ellipse on white, as word_cloud.icon_mask
+    would give for an icon with a transparent background
+    """
+    yy, xx = np.mgrid[:height, :width]
+    inside = ((xx - width / 2) / (width / 2)) ** 2 + ((yy - height / 2) / (height / 2)) ** 2 <= 1
+    pixels = np.full((height, width, 4), 255, dtype=np.uint8)
+    pixels[inside, :3] = (200, 30, 90)
+    return Image.fromarray(pixels, "RGBA")
+
+def bench_gradient(sizes=((200, 300), (1000, 1500), (2000, 3000), (300, 200)), repeat=3):
+    """
+    Times gradient mask creation per resolution and orientation, the
+    original getpixel / putpixel loop against word_cloud.gradient_mask.
+    tests/test_word_cloud.py checks that their output is identical
+
+    Parameters
+    ----------
+    sizes : list
+        (width, height) of icons to time. The loop indexes a palette of
+        image height by column for horizontal gradients, so it can't run
+        horizontal on wider than tall icons, only gradient_mask is timed
+    repeat : int
+        times gradient_mask is run per size, the loop is run once
+
+    Returns
+    -------
+    list of summary dictionaries, see summarize
+
+    """
+    summaries = []
+    for width, height in sizes:
+        mask = synthetic_icon(width, height)
+        for orientation in ("vertical", "horizontal"):
+            extra = {"width": width, "height": height, "orientation": orientation}
+            new_times = time_per_item(lambda m: gradient_mask(m, orientation), [mask] * repeat)
+            summaries.append(summarize("gradient_numpy", new_times, **extra))
+            if orientation == "horizontal" and width > height:
+                continue
+            start = time.perf_counter()
+            gradient_mask_loop(mask, orientation)
+            old_time = time.perf_counter() - start
+            summaries.append(summarize("gradient_loop", np.array([old_time]), **extra))
+    return summaries
+
+# End-to-end suite over a synthetic corpus, see synthetic_corpus.py
+# Each stage runs in a fresh process so its peak RSS is its own.
+# Stages that time a whole batch report the batch time spread per document,
+# stages that time one call per document give real latency percentiles
+
+# Documents timed one at a time for latency, per stage
+LATENCY_SAMPLE = 1000
+
+def peak_rss_mb():
+    """
+    Returns peak resident memory (MB) of this process, and the largest of
+    its finished child processes (e.g. lemmatize or sentiment workers)
+    """
+    # ru_maxrss is kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return round(own, 1), round(children, 1)
+
+def batch_summary(stage, seconds, n_items, n_bytes=None, **extra):
+    # one timing for the whole batch, reported per item
+    n = max(n_items, 1)
+    return summarize(stage, np.full(n, seconds / n), n_bytes, **extra)
+
+def stage_api(n_docs, seed, n_jobs, workdir):
+    # Article Search requests against the stub server, then parse the json
+    windows = synthetic_corpus.week_windows(n_docs)
+    with synthetic_corpus.StubServer(n_docs, seed) as stub:
+        session = requests.Session()
+        request_times = time_per_item(lambda w: nyt_lgbtq_api(w[0], w[1], "benchmark", base_url=stub.api_url,
+                                                              session=session), windows[:LATENCY_SAMPLE])
+        stub.requests = 0
+        start = time.perf_counter()
+        responses = [page for _, _, pages in fetch_weeks(windows, "benchmark", requests_per_minute=1e9,
+                                                         workers=n_jobs or 8, base_url=stub.api_url)
+                     for page in pages]
+        fetch_time = time.perf_counter() - start
+        n_requests = stub.requests
+    n_bytes = sum(len(json.dumps(page)) for page in responses)
+    start = time.perf_counter()
+    parse_api_columns(responses)
+    parse_time = time.perf_counter() - start
+    return [summarize("api_request", request_times),
+            batch_summary("api_fetch_weeks", fetch_time, n_docs, n_bytes, requests=n_requests),
+            batch_summary("api_parse_columns", parse_time, n_docs, n_bytes)]
+
+def stage_scrape(n_docs, seed, n_jobs, workdir):
+    # article pages from the stub server, then extraction alone on local html
+    with synthetic_corpus.StubServer(n_docs, seed) as stub:
+        articles = [(i, synthetic_corpus.article_url(i, stub.base_url)) for i in range(n_docs)]
+        start = time.perf_counter()
+        texts = dict(scrape_articles(articles, per_host=n_jobs or 8, requests_per_second=1e9))
+        scrape_time = time.perf_counter() - start
+    vocab = synthetic_corpus.synthetic_vocab(seed=seed)
+    pages = [synthetic_corpus.synthetic_page(i, seed, vocab) for i in range(min(n_docs, LATENCY_SAMPLE))]
+    return [batch_summary("scrape_articles", scrape_time, n_docs, empty=sum(not t for t in texts.values())),
+            summarize("extract_lxml", time_per_item(extract_article_text, pages), sum(len(p) for p in pages))]
+
+def stage_clean(n_docs, seed, n_jobs, workdir):
+    texts = synthetic_corpus.synthetic_texts(n_docs, seed)
+    n_bytes = sum(len(text.encode()) for text in texts)
+    start = time.perf_counter()
+    clean_texts(texts)
+    batch_time = time.perf_counter() - start
+    return [summarize("clean_text", time_per_item(clean_text, texts), n_bytes),
+            batch_summary("clean_texts", batch_time, n_docs, n_bytes)]
+
+def stage_lemmatize(n_docs, seed, n_jobs, workdir):
+    cleaned = clean_texts(synthetic_corpus.synthetic_texts(n_docs, seed))
+    load_nlp_models()
+    latency = time_per_item(lemmatize_text, cleaned[:LATENCY_SAMPLE])
+    lemma_cache = LemmaCache()
+    start = time.perf_counter()
+    lemmatize_documents(cleaned, n_jobs=n_jobs, lemma_cache=lemma_cache)
+    pool_time = time.perf_counter() - start
+    return [summarize("lemmatize_text", latency),
+            batch_summary("lemmatize_documents", pool_time, n_docs, **lemma_cache.stats())]
+
+def stage_topics(n_docs, seed, n_jobs, workdir):
+    # cleaned rather than lemmatized text, so this stage runs without NLTK data
+    cleaned = clean_texts(synthetic_corpus.synthetic_texts(n_docs, seed))
+    start = time.perf_counter()
+    doc_word, vocab, cv = vectorize_corpus(cleaned, ENGLISH_STOP_WORDS, min_df=2, max_df=.9,
+                                           ngram_range=(1,2), cache_dir=None)
+    vectorize_time = time.perf_counter() - start
+    start = time.perf_counter()
+    nmf_model = NMF(9)
+    nmf_model.fit_transform(doc_word)
+    nmf_time = time.perf_counter() - start
+    start = time.perf_counter()
+    top_topic_words(nmf_model.components_, vocab)
+    top_time = time.perf_counter() - start
+    return [batch_summary("vectorize", vectorize_time, n_docs, vocab_size=len(vocab), nnz=int(doc_word.nnz)),
+            batch_summary("nmf_fit", nmf_time, n_docs, n_iter=int(nmf_model.n_iter_)),
+            batch_summary("top_topic_words", top_time, n_docs)]
+
+def stage_sentiment(n_docs, seed, n_jobs, workdir):
+    cleaned = clean_texts(synthetic_corpus.synthetic_texts(n_docs, seed))
+    n_bytes = sum(len(text.encode()) for text in cleaned)
+    latency = time_per_item(textblob_sentiment, cleaned[:LATENCY_SAMPLE])
+    start = time.perf_counter()
+    sentiment_scores(cleaned, n_jobs=n_jobs)
+    pool_time = time.perf_counter() - start
+    start = time.perf_counter()
+    sentiment_lexicon_scores(cleaned)
+    lexicon_time = time.perf_counter() - start
+    return [summarize("sentiment_textblob", latency),
+            batch_summary("sentiment_pool", pool_time, n_docs, n_bytes),
+            batch_summary("sentiment_lexicon", lexicon_time, n_docs, n_bytes)]
+
+def stage_word_cloud(n_docs, seed, n_jobs, workdir):
+    # clouds are the same size whatever n_docs, the topic words are synthetic
+    icon = synthetic_icon(3000, 2000)
+    gradient_times = time_per_item(lambda m: gradient_mask(m, "horizontal"), [icon] * 3)
+    mask_path = os.path.join(workdir, "mask.png")
+    icon.convert("RGB").save(mask_path)
+    rng = np.random.default_rng(seed)
+    vocab = synthetic_corpus.synthetic_vocab(seed=seed)
+    top_words = top_topic_words(rng.random((9, len(vocab))), vocab, k=40)
+    jobs = [(topic, f"topic{topic}", mask_path) for topic in range(9)]
+    start = time.perf_counter()
+    render_word_clouds(top_words, jobs, None, out_dir=os.path.join(workdir, "clouds"), n_jobs=n_jobs,
+                       skip_unchanged=False)
+    render_time = time.perf_counter() - start
+    return [summarize("gradient_mask_3000x2000", gradient_times),
+            batch_summary("render_word_clouds", render_time, len(jobs))]
+
+SHARD_SIZE = 2000
+
+# columns modeling.py reads from the article shards to fit and summarize topics
+MODELING_COLUMNS = ["article_text", "year", "decade"]
+
+def load_corpus(shard_dir, fmt, columns):
+    # runs in a fresh process, so peak RSS is only the load
+    start = time.perf_counter()
+    if fmt == "pickle":
+        paths = sorted(os.path.join(shard_dir, name) for name in os.listdir(shard_dir))
+        corpus = pd.concat([pd.read_pickle(path)[columns] for path in paths], ignore_index=True)
+    else:
+        corpus = load_shards(shard_dir, columns)
+    seconds = time.perf_counter() - start
+    return seconds, len(corpus), peak_rss_mb()[0]
+
+def stage_corpus_format(n_docs, seed, n_jobs, workdir):
+    # the same shards as pandas pickles and as corpus_format Arrow files,
+    # each loaded in its own spawned process
+    vocab = synthetic_corpus.synthetic_vocab(seed=seed)
+    dirs = {fmt: os.path.join(workdir, f"shards_{fmt}") for fmt in ("pickle", "arrow")}
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    for n, start in enumerate(range(0, n_docs, SHARD_SIZE)):
+        shard = synthetic_corpus.synthetic_articles(start, min(start + SHARD_SIZE, n_docs), seed, vocab)
+        shard.to_pickle(os.path.join(dirs["pickle"], f"part-{n:05d}.p"))
+        corpus_format.write_frame(shard_path(dirs["arrow"], n), shard)
+
+    summaries = []
+    context = multiprocessing.get_context("spawn")
+    for fmt, shard_dir in dirs.items():
+        n_bytes = sum(os.path.getsize(os.path.join(shard_dir, name)) for name in os.listdir(shard_dir))
+        for label, columns in (("all", None), ("modeling", MODELING_COLUMNS)):
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                # an empty load first, so the import memory of the worker is known
+                base_rss = executor.submit(peak_rss_mb).result()[0]
+                seconds, n_rows, load_rss = executor.submit(load_corpus, shard_dir, fmt,
+                                                            columns or list(shard.columns)).result()
+            summaries.append(batch_summary(f"load_{fmt}_{label}", seconds, n_rows, n_bytes,
+                                           load_rss_mb=round(load_rss - base_rss, 1)))
+    return summaries
+
+def stage_dedup(n_docs, seed, n_jobs, workdir):
+    # 10% of the corpus is reprinted with 1% of words changed (Jaccard
+    # similarity of 5 word shingles about 0.9), which should all be found
+    texts = clean_texts(synthetic_corpus.synthetic_texts(n_docs, seed))
+    rng = np.random.default_rng(seed)
+    sources = rng.choice(n_docs, n_docs // 10, replace=False)
+    for i in sources:
+        words = np.array(texts[i].split(), dtype=object)
+        words[rng.random(len(words)) < 0.01] = "reprint"
+        texts.append(" ".join(words))
+    start = time.perf_counter()
+    signatures = minhash_texts(texts, n_jobs=n_jobs)
+    minhash_time = time.perf_counter() - start
+    start = time.perf_counter()
+    candidates = lsh_candidates(signatures)
+    clusters = cluster_pairs(len(texts), verify_pairs(signatures, candidates))
+    lsh_time = time.perf_counter() - start
+    found = int((clusters[n_docs:] == clusters[sources]).sum())
+    # originals merged with another original
+    false_positives = int((clusters[:n_docs] != np.arange(n_docs)).sum())
+    return [batch_summary("minhash", minhash_time, len(texts)),
+            batch_summary("lsh_cluster", lsh_time, len(texts), candidates=len(candidates),
+                          recall=round(found / max(len(sources), 1), 4), false_positives=false_positives)]
+
+STAGES = {"api": stage_api, "scrape": stage_scrape, "clean": stage_clean, "lemmatize": stage_lemmatize,
+          "topics": stage_topics, "sentiment": stage_sentiment, "word_cloud": stage_word_cloud,
+          "corpus_format": stage_corpus_format, "dedup": stage_dedup}
+
+def run_stage(name, n_docs, seed, n_jobs, workdir):
+    """
+    Runs one stage of the suite and adds this process's peak RSS to its
+    summaries. Stages needing data that isn't installed (e.g. NLTK models)
+    return an error entry instead of failing the suite
+    """
+    try:
+        summaries = STAGES[name](n_docs, seed, n_jobs, workdir)
+    except LookupError as e:
+        message = [line.strip() for line in str(e).splitlines() if line.strip("* \n")]
+        return [{"stage": name, "error": message[0] if message else repr(e)}]
+    own, children = peak_rss_mb()
+    for summary in summaries:
+        summary.update(group=name, peak_rss_mb=own, children_peak_rss_mb=children)
+    return summaries
+
+def bench_suite(n_docs, seed=0, stages=tuple(STAGES), n_jobs=None, workdir=None):
+    """
+    Runs the end-to-end benchmark suite over a synthetic corpus
+
+    Parameters
+    ----------
+    n_docs : int
+        documents in the corpus, e.g. 1000 to 1000000
+    seed : int
+        corpus seed, the same seed gives the same corpus
+    stages : list
+        names of stages to run, from STAGES
+    n_jobs : int
+        threads / processes used by the parallel stages, default is their own
+    workdir : string
+        directory for files written by stages, default is a temporary directory
+
+    Returns
+    -------
+    report : dictionary
+        run metadata and "stages", the list of stage summaries
+
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix="nyt_bench_")
+    report = {"n_docs": n_docs, "seed": seed, "n_jobs": n_jobs, "python": platform.python_version(),
+              "platform": platform.platform(), "cpus": os.cpu_count(), "stages": []}
+    # spawn, so each stage starts from a fresh interpreter and measures its own memory
+    context = multiprocessing.get_context("spawn")
+    for name in stages:
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            report["stages"] += executor.submit(run_stage, name, n_docs, seed, n_jobs, workdir).result()
+    return report
+
+def compare_reports(baseline, report):
+    """
+    Compares items_per_s of each stage of two bench_suite reports
+
+    Returns
+    -------
+    list of dictionaries
+        stage, baseline and new items_per_s, and speedup (new / baseline)
+
+    """
+    old = {s["stage"]: s for s in baseline["stages"] if s.get("items_per_s")}
+    rows = []
+    for summary in report["stages"]:
+        if summary["stage"] in old and summary.get("items_per_s"):
+            before = old[summary["stage"]]["items_per_s"]
+            rows.append({"stage": summary["stage"], "baseline_items_per_s": before,
+                         "items_per_s": summary["items_per_s"],
+                         "speedup": round(summary["items_per_s"] / before, 3)})
+    return rows
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", default="pickles/crawl.db")
+    parser.add_argument("--cache-dir", default="cache/http")
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--gradient-only", action="store_true")
+    parser.add_argument("--gradient-sizes", default="200x300,1000x1500,2000x3000,300x200")
+    parser.add_argument("--synthetic", type=int, metavar="N_DOCS",
+                        help="run the end-to-end suite over a synthetic corpus of N_DOCS instead")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--n-jobs", type=int)
+    parser.add_argument("--out", help="write the suite report to this json file")
+    parser.add_argument("--compare", help="suite report json to compare against")
+    args = parser.parse_args()
+    
+    if args.synthetic:
+        report = bench_suite(args.synthetic, args.seed, args.stages.split(","), args.n_jobs)
+        for summary in report["stages"]:
+            print(json.dumps(summary))
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(report, f, indent=1)
+        if args.compare:
+            with open(args.compare) as f:
+                for row in compare_reports(json.load(f), report):
+                    print(json.dumps(row))
+        sys.exit()
+
+    # Time gradient masks for word_cloud.gradient_cloud, needs no crawl data
+    sizes = [tuple(map(int, size.split("x"))) for size in args.gradient_sizes.split(",")]
+    for summary in bench_gradient(sizes):
+        print(json.dumps(summary))
+    if args.gradient_only:
+        raise SystemExit
+    
+    # Time extraction over article html already in the response cache
+    cache = ResponseCache(args.cache_dir)
+    store = crawl_store.open_store(args.store)
+    urls = [row[0] for row in store.execute("SELECT web_url FROM articles LIMIT ?", (args.limit,))]
+    pages = [page for page in map(cache.get, urls) if page is not None]
+
+    for summary in bench_extract(pages):
+        print(json.dumps(summary))
+
+    # Time parsing of the cached API json
+    responses = [json.loads(cache.get(url)) for url in cache.urls("%articlesearch%")]
+    for summary in bench_parse(responses):
+        print(json.dumps(summary))
+
+    # Time cleaning of the scraped article text
+    texts = [row[0] for row in store.execute("SELECT article_text FROM article_text WHERE article_text != '' LIMIT ?",
+                                             (args.limit,))]
+    for summary in bench_clean(texts):
+        print(json.dumps(summary))
+
+    # Time sentiment scoring of the cleaned text
+    for summary in bench_sentiment(clean_texts(texts)):
+        print(json.dumps(summary))
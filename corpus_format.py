@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar on-disk format for article metadata and text, used for the
+preprocessing shards instead of pandas pickles
+Files are uncompressed Arrow IPC (Feather v2), read through a memory map,
+so only the columns asked for are paged in and nothing is unpickled.
+Low cardinality columns are dictionary encoded (read back as pandas
+categoricals) and keyword columns are list<string> rather than Python
+lists in object cells (read back as arrays of strings)
+
+@author: markfunke
+"""
+
+import os
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from crawl_store import CATEGORICAL_COLUMNS, LIST_COLUMNS
+
+# Dictionary encoded columns: the crawl store's categoricals, plus year,
+# which has about 60 distinct values over the whole corpus
+DICTIONARY_COLUMNS = CATEGORICAL_COLUMNS + ["year"]
+
+# Integer columns stored narrower than pandas' int64
+NARROW_COLUMNS = {"decade": pa.int16()}
+
+def to_table(df):
+    """
+    Converts a DataFrame of articles to an Arrow table with the corpus
+    column types, so shards written separately share one schema
+
+    Parameters
+    ----------
+    df : DataFrame
+        article metadata and/or text, any subset of the crawl columns
+
+    Returns
+    -------
+    table : pyarrow.Table
+
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i, name in enumerate(table.column_names):
+        column = table.column(i)
+        if name in LIST_COLUMNS:
+            column = column.cast(pa.list_(pa.string()))
+        elif name in NARROW_COLUMNS:
+            column = column.cast(NARROW_COLUMNS[name])
+        elif pa.types.is_null(column.type) or pa.types.is_large_string(column.type):
+            # all missing in this shard (e.g. an empty headline), or a pandas
+            # str column. Shards never hold 2 GB of text, so string is enough
+            column = column.cast(pa.string())
+        if name in DICTIONARY_COLUMNS:
+            column = column.cast(pa.string()).dictionary_encode()
+        table = table.set_column(i, name, column)
+    return table
+
+def write_frame(path, df):
+    """
+    Writes a DataFrame of articles to path, replacing it in one step so a
+    crash never leaves a partial file
+    """
+    tmp = path + ".tmp"
+    # uncompressed, so reads can map the file rather than decompress it
+    feather.write_feather(to_table(df), tmp, compression="uncompressed")
+    os.replace(tmp, path)
+
+def read_table(path, columns=None):
+    """
+    Memory maps the file at path, returning an Arrow table of only columns
+    (default all) backed by the map
+    """
+    return feather.read_table(path, columns=columns, memory_map=True)
+
+def to_frame(table):
+    """
+    Converts an Arrow table to a DataFrame, dictionary columns as categoricals
+    """
+    # split_blocks avoids copying columns into consolidated 2D blocks
+    return table.to_pandas(split_blocks=True)
+
+def read_frame(path, columns=None):
+    """
+    Reads only columns (default all) of the file at path as a DataFrame
+    """
+    return to_frame(read_table(path, columns))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Durable SQLite store for the NYT crawl in scraper.py
+Each week of parsed API output is written as soon as it is parsed, so a
+crashed run can pick up from the last finished date window
+
+@author: markfunke
+"""
+
+import json
+import sqlite3
+import pandas as pd
+
+# Columns produced by scraper.parse_api, in the order they are stored
+ARTICLE_COLUMNS = ['_id','abstract','lead_paragraph','snippet','section_name','word_count',
+                   'type_of_material','news_desk','web_url','headline','date','locations','subjects']
+
+# Low cardinality columns, returned as categoricals here and by scraper.parse_api_columns
+CATEGORICAL_COLUMNS = ['section_name','news_desk','type_of_material']
+
+# Columns holding lists, stored as json text
+LIST_COLUMNS = ['locations','subjects']
+
+def open_store(path):
+    """
+    Opens (and creates if needed) the crawl store at path
+
+    Parameters
+    ----------
+    path : string
+        path of SQLite file, e.g. "pickles/crawl.db"
+
+    Returns
+    -------
+    conn : sqlite3.Connection
+        connection to pass to the other functions in this module
+
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    columns = ", ".join(f"{c} TEXT" for c in ARTICLE_COLUMNS if c != '_id')
+    conn.execute(f"CREATE TABLE IF NOT EXISTS articles (_id TEXT PRIMARY KEY, {columns})")
+    conn.execute("""CREATE TABLE IF NOT EXISTS windows (
+                        begin_date INTEGER, end_date INTEGER, n_articles INTEGER,
+                        PRIMARY KEY (begin_date, end_date))""")
+    conn.execute("CREATE TABLE IF NOT EXISTS article_text (_id TEXT PRIMARY KEY, article_text TEXT)")
+    conn.commit()
+    return conn
+
+def save_week(conn, begin_date, end_date, columns):
+    """
+    Writes one date window of parsed articles and marks the window as done,
+    in a single transaction. Articles already in the store are replaced
+    (dedupe on _id), so an offline re-parse picks up parse_api changes
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        connection from open_store
+    begin_date, end_date : int
+        date window the articles were pulled for (YYYYMMDD)
+    columns : dictionary
+        column name -> values, from scraper.parse_api_columns
+
+    Returns
+    -------
+    None.
+
+    """
+    values = [map(json.dumps, columns[c]) if c in LIST_COLUMNS else columns[c] for c in ARTICLE_COLUMNS]
+    placeholders = ", ".join("?" * len(ARTICLE_COLUMNS))
+    with conn:
+        conn.executemany(f"INSERT OR REPLACE INTO articles ({', '.join(ARTICLE_COLUMNS)}) VALUES ({placeholders})",
+                         zip(*values))
+        conn.execute("INSERT OR REPLACE INTO windows VALUES (?, ?, ?)", (begin_date, end_date, len(columns['_id'])))
+
+def completed_windows(conn):
+    """
+    Returns set of (begin_date, end_date) windows already saved to the store
+    """
+    return set(conn.execute("SELECT begin_date, end_date FROM windows"))
+
+def load_articles(conn):
+    """
+    Reads every stored article in one query
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        connection from open_store
+
+    Returns
+    -------
+    article_df : DataFrame
+        one row per unique article, same columns as parse_api output
+
+    """
+    article_df = pd.read_sql_query(f"SELECT {', '.join(ARTICLE_COLUMNS)} FROM articles ORDER BY date", conn)
+    for c in LIST_COLUMNS:
+        article_df[c] = [json.loads(x) for x in article_df[c]]
+    article_df["word_count"] = pd.to_numeric(article_df["word_count"], errors="coerce")
+    for c in CATEGORICAL_COLUMNS:
+        article_df[c] = article_df[c].astype("category")
+    return article_df
+
+def save_article_text(conn, _id, article_text):
+    """
+    Writes scraped body text for one article, replacing any earlier scrape
+    unless the new text is empty and the stored text isn't
+    """
+    with conn:
+        conn.execute("""INSERT INTO article_text VALUES (?, ?)
+                        ON CONFLICT (_id) DO UPDATE SET article_text = excluded.article_text
+                        WHERE excluded.article_text != '' OR article_text.article_text = ''""",
+                     (_id, article_text))
+
+def scraped_ids(conn):
+    """
+    Returns set of article _ids that already have scraped text in the store
+    """
+    return {row[0] for row in conn.execute("SELECT _id FROM article_text")}
+
+def load_article_text(conn):
+    """
+    Reads all scraped article text in one query
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        connection from open_store
+
+    Returns
+    -------
+    DataFrame
+        "_id" and "article_text" columns
+
+    """
+    return pd.read_sql_query("SELECT _id, article_text FROM article_text", conn)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Near-duplicate detection between preprocessing.py and modeling.py
+Reprinted wire stories, "Archives" copies and letters quoting the article
+they answer are found with word shingles, MinHash signatures and
+locality-sensitive hashing, so time grows with the number of documents
+rather than the number of pairs. Each article gets a cluster id, the index
+of the earliest article it duplicates, and only the first article of each
+cluster is kept for topic modeling and sentiment
+
+@author: markfunke
+"""
+
+import functools
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from sklearn.feature_extraction.text import HashingVectorizer
+from concurrent.futures import ProcessPoolExecutor
+
+import corpus_format
+import instrumentation
+from preprocessing import load_shards
+
+# Words per shingle, 5 word shingles rarely repeat between unrelated articles
+SHINGLE_SIZE = 5
+
+# Number of MinHash permutations, split into BANDS bands of NUM_PERM / BANDS
+# rows each. Pairs agreeing on every row of any band become candidates,
+# with 16 bands of 8 rows about 95% of pairs with Jaccard similarity 0.8
+# are found, 61% at 0.7 and 6% at 0.5 (1 - (1 - s^8)^16), which
+# verify_pairs then removes
+NUM_PERM = 128
+BANDS = 16
+
+# Estimated Jaccard similarity of shingles at which candidates are duplicates
+THRESHOLD = 0.8
+
+# Signature of documents too short to have a shingle, never a duplicate
+EMPTY = np.iinfo(np.uint32).max
+
+def shingle_matrix(texts, shingle_size=SHINGLE_SIZE):
+    """
+    Returns sparse binary matrix of documents x hashed word shingles.
+    Hashing is stable across processes and runs, unlike Python's hash
+    """
+    hv = HashingVectorizer(analyzer="word", ngram_range=(shingle_size, shingle_size), token_pattern=r"(?u)\S+",
+                           lowercase=False, n_features=1 << 30, binary=True, norm=None, alternate_sign=False)
+    return hv.transform(texts)
+
+def permutations(num_perm=NUM_PERM, seed=0):
+    """
+    Returns (a, b) uint64 arrays of the MinHash hash functions, multiply-shift
+    hashes ((a * x + b) mod 2^64) >> 32 with a odd. Wrapping uint64
+    arithmetic does the mod, much faster than a prime modulus
+    """
+    rng = np.random.default_rng(seed)
+    return (rng.integers(0, 1 << 63, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1),
+            rng.integers(0, 1 << 63, num_perm, dtype=np.uint64) * np.uint64(2))
+
+def minhash_signatures(shingles, num_perm=NUM_PERM, seed=0, block_size=1 << 16):
+    """
+    MinHash signatures of each row of a shingle matrix
+
+    Parameters
+    ----------
+    shingles : scipy.sparse.csr_matrix
+        documents x shingles, from shingle_matrix
+    num_perm : int
+        number of permutations (signature length)
+    seed : int
+        seed of the permutations, signatures are only comparable with the same seed
+    block_size : int
+        maximum shingle x permutation hashes held in memory at once, blocks
+        that fit in cache are about twice as fast as larger ones
+
+    Returns
+    -------
+    signatures : array
+        (documents, num_perm) uint32, rows of EMPTY for documents without shingles
+
+    """
+    a, b = permutations(num_perm, seed)
+    n_docs = shingles.shape[0]
+    indptr, indices = shingles.indptr, shingles.indices.astype(np.uint64)
+    signatures = np.full((n_docs, num_perm), EMPTY, dtype=np.uint32)
+    max_nnz = max(block_size // num_perm, 1)
+    start = 0
+    while start < n_docs:
+        # as many documents as fit in one block, at least one
+        stop = max(int(np.searchsorted(indptr, indptr[start] + max_nnz, side="right")) - 1, start + 1)
+        stop = min(stop, n_docs)
+        lo, hi = indptr[start], indptr[stop]
+        if hi > lo:
+            # permutations x shingles, so the min over each document's
+            # shingles reduces along contiguous memory
+            hashes = np.multiply.outer(a, indices[lo:hi])
+            hashes += b[:, None]
+            hashes >>= np.uint64(32)
+            rows = np.arange(start, stop)
+            rows = rows[indptr[rows + 1] > indptr[rows]]
+            signatures[rows] = np.minimum.reduceat(hashes.astype(np.uint32), indptr[rows] - lo, axis=1).T
+        start = stop
+    return signatures
+
+def signature_chunk(texts, shingle_size=SHINGLE_SIZE, num_perm=NUM_PERM, seed=0):
+    """
+    Shingles and MinHashes a list of documents, run in worker processes
+    """
+    return minhash_signatures(shingle_matrix(texts, shingle_size), num_perm, seed)
+
+def minhash_texts(texts, shingle_size=SHINGLE_SIZE, num_perm=NUM_PERM, seed=0, n_jobs=None, chunksize=1000):
+    """
+    MinHash signatures of documents across a pool of processes
+
+    Parameters
+    ----------
+    texts : Series or list
+        documents cleaned with clean_text (lowercase, no punctuation)
+    shingle_size, num_perm, seed : see shingle_matrix and minhash_signatures
+    n_jobs : int
+        number of worker processes, default is one per core.
+        1 runs in this process without a pool
+    chunksize : int
+        number of documents sent to a worker at a time
+
+    Returns
+    -------
+    signatures : array
+        (documents, num_perm) uint32, in input order
+
+    """
+    docs = list(texts)
+    chunks = [docs[i:i + chunksize] for i in range(0, len(docs), chunksize)]
+    worker = functools.partial(signature_chunk, shingle_size=shingle_size, num_perm=num_perm, seed=seed)
+    if n_jobs == 1:
+        parts = [worker(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            parts = list(executor.map(worker, chunks))
+    return np.concatenate(parts) if parts else np.empty((0, num_perm), dtype=np.uint32)
+
+def lsh_candidates(signatures, bands=BANDS):
+    """
+    Candidate duplicate pairs: documents whose signatures agree on every
+    row of at least one band. Documents are sorted by band key, and each
+    document in a bucket is paired with the first one, so a bucket of m
+    documents gives m - 1 pairs rather than m^2
+
+    Parameters
+    ----------
+    signatures : array
+        from minhash_signatures, num_perm divisible by bands
+    bands : int
+        number of bands
+
+    Returns
+    -------
+    pairs : array
+        (n_pairs, 2) int64 document indices, unique, first below second
+
+    """
+    n_docs, num_perm = signatures.shape
+    if num_perm % bands:
+        raise ValueError(f"{num_perm} permutations don't split into {bands} bands")
+    rows = num_perm // bands
+    docs = np.flatnonzero(signatures[:, 0] != EMPTY)
+    if not len(docs):
+        # empty corpus, or no document long enough to shingle
+        return np.empty((0, 2), dtype=np.int64)
+    # random odd multipliers fold each band's rows into one 64 bit key.
+    # Colliding keys only add candidates, which verify_pairs removes
+    multipliers = np.random.default_rng(0).integers(0, 1 << 63, rows, dtype=np.uint64) | np.uint64(1)
+    pairs = []
+    for band in range(bands):
+        band_rows = signatures[docs, band * rows:(band + 1) * rows].astype(np.uint64)
+        keys = (band_rows * multipliers).sum(axis=1)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        new_bucket = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+        first = np.maximum.accumulate(np.where(new_bucket, np.arange(len(order)), 0))
+        members = ~new_bucket
+        pairs.append(np.column_stack([docs[order[first[members]]], docs[order[members]]]))
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    return np.unique(pairs, axis=0).astype(np.int64)
+
+def verify_pairs(signatures, pairs, threshold=THRESHOLD, block_size=1 << 16):
+    """
+    Keeps candidate pairs whose estimated Jaccard similarity (share of
+    equal signature values) is at least threshold
+    """
+    keep = np.zeros(len(pairs), dtype=bool)
+    for start in range(0, len(pairs), block_size):
+        block = pairs[start:start + block_size]
+        similarity = (signatures[block[:, 0]] == signatures[block[:, 1]]).mean(axis=1)
+        keep[start:start + block_size] = similarity >= threshold
+    return pairs[keep]
+
+def cluster_pairs(n_docs, pairs):
+    """
+    Groups documents joined by duplicate pairs, directly or through other
+    documents, and returns array of each document's cluster id: the
+    smallest document index in its cluster
+    """
+    graph = scipy.sparse.coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+                                    shape=(n_docs, n_docs))
+    _, labels = connected_components(graph, directed=False)
+    first = np.full(labels.max() + 1 if n_docs else 0, n_docs, dtype=np.int64)
+    np.minimum.at(first, labels, np.arange(n_docs))
+    return first[labels]
+
+@instrumentation.stage("near_duplicates", items=instrumentation.count_items)
+def near_duplicate_clusters(texts, threshold=THRESHOLD, shingle_size=SHINGLE_SIZE, num_perm=NUM_PERM,
+                            bands=BANDS, seed=0, n_jobs=None):
+    """
+    Finds near-duplicate documents
+
+    Parameters
+    ----------
+    texts : Series or list
+        documents cleaned with clean_text, in date order so the earliest
+        copy of each story is kept
+    threshold : float
+        estimated Jaccard similarity of shingles at which two documents are
+        duplicates. Pairs below the LSH curve of bands (about 0.7 for the
+        defaults) are rarely compared, so lower thresholds need more bands
+    shingle_size, num_perm, seed : see shingle_matrix and minhash_signatures
+    bands : int
+        number of LSH bands, see lsh_candidates
+    n_jobs : int
+        number of worker processes, see minhash_texts
+
+    Returns
+    -------
+    clusters : array
+        cluster id of each document, the index of the first document in its
+        cluster. Documents with no duplicate are their own cluster
+
+    """
+    signatures = minhash_texts(texts, shingle_size, num_perm, seed, n_jobs)
+    pairs = verify_pairs(signatures, lsh_candidates(signatures, bands), threshold)
+    return cluster_pairs(len(signatures), pairs)
+
+def find_duplicates(shard_dir="pickles/shards", out_path="pickles/duplicates.arrow", **kwargs):
+    """
+    Finds near-duplicates among the cleaned (not lemmatized) shards written
+    by preprocessing.preprocess_shards and saves the result
+
+    Parameters
+    ----------
+    shard_dir : string
+        out_dir of preprocess_shards
+    out_path : string
+        file to write, see corpus_format
+    **kwargs : passed to near_duplicate_clusters
+
+    Returns
+    -------
+    duplicates : DataFrame
+        "_id", "cluster" and "keep" (first of its cluster) for every
+        article, in shard order
+
+    """
+    articles = load_shards(f"{shard_dir}/sentiment", ["_id", "article_text"])
+    clusters = near_duplicate_clusters(articles["article_text"], **kwargs)
+    duplicates = pd.DataFrame({"_id": articles["_id"], "cluster": clusters,
+                               "keep": clusters == np.arange(len(clusters))})
+    corpus_format.write_frame(out_path, duplicates)
+    return duplicates
+
+def load_duplicates(path="pickles/duplicates.arrow"):
+    return corpus_format.read_frame(path)
+
+def drop_duplicates(df, duplicates):
+    """
+    Keeps the first article of each cluster of a DataFrame read from the
+    shards (rows in the same order as duplicates)
+    """
+    if len(df) != len(duplicates):
+        raise ValueError(f"{len(df)} rows but {len(duplicates)} duplicate flags, rerun find_duplicates")
+    return df[duplicates["keep"].to_numpy()].reset_index(drop=True)
+
+if __name__ == "__main__":
+
+    # Run after preprocessing.py. Near-duplicates are dropped by modeling.py
+    # before vectorizing, so reprints don't skew NMF topics or yearly counts
+    duplicates = find_duplicates("pickles/shards", "pickles/duplicates.arrow")
+    sizes = duplicates.groupby("cluster").size()
+    print(f"{(~duplicates.keep).sum()} of {len(duplicates)} articles are near-duplicates, "
+          f"in {(sizes > 1).sum()} clusters")
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Article body extraction for NYT article pages
+Uses compiled lxml XPath selectors, tried in order, so pages from older
+NYT templates still return text instead of ""
+
+@author: markfunke
+"""
+
+import threading
+from lxml import etree
+
+# Ordered (name, selector) pairs, first selector that finds text wins
+# Names are the NYT page templates each selector was written for
+ARTICLE_SELECTORS = [
+    # 2019+ react pages, the class originally used in scrape_article_text
+    ("css", etree.XPath('//p[@class="css-158dogj evys1bk0"]')),
+    # react pages with a different generated class name
+    ("section", etree.XPath('//section[@name="articleBody"]//p')),
+    # 2014-2018 pages
+    ("story-body", etree.XPath('//p[contains(concat(" ", normalize-space(@class), " "), " story-body-text ")]')),
+    # schema.org markup used on blogs and archive pages
+    ("itemprop", etree.XPath('//*[@itemprop="articleBody"]//p')),
+    # pre-2014 pages
+    ("legacy", etree.XPath('//div[@id="articleBody"]//p | //div[contains(@class, "articleBody")]//p')),
+]
+
+# lxml parsers are not thread safe, keep one per thread
+_local = threading.local()
+
+def _parser():
+    if not hasattr(_local, "parser"):
+        _local.parser = etree.HTMLParser(remove_comments=True, remove_pis=True, no_network=True)
+    return _local.parser
+
+def extract_with_selector(page, selectors=ARTICLE_SELECTORS):
+    """
+    Extracts article body text, and reports which selector found it
+
+    Parameters
+    ----------
+    page : string or bytes
+        html of a New York Times article page
+    selectors : list
+        ordered (name, compiled XPath) pairs, default is ARTICLE_SELECTORS
+
+    Returns
+    -------
+    (name, article_text) : tuple
+        name of matching selector and paragraphs joined by a space,
+        (None, "") if no selector found any text
+
+    """
+    if not page:
+        return None, ""
+    tree = etree.HTML(page, _parser())
+    if tree is None:
+        return None, ""
+    for name, selector in selectors:
+        article_text = ' '.join([''.join(p.itertext()) for p in selector(tree)])
+        if article_text.strip():
+            return name, article_text
+    return None, ""
+
+def extract_article_text(page, selectors=ARTICLE_SELECTORS):
+    """
+    Extracts article body text from html, see extract_with_selector
+
+    Returns
+    -------
+    article_text : string
+        Article body text, "" if no selector matched
+
+    """
+    return extract_with_selector(page, selectors)[1]
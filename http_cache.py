@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compressed, content-addressed cache of HTTP responses for scraper.py
+API json and article html are stored once per unique body, keyed by url,
+so parsing can be re-run offline without hitting the network
+
+@author: markfunke
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Query parameters left out of the cache key, so a cache built with one
+# api key can be replayed with another
+IGNORED_PARAMS = {"api-key"}
+
+class CacheMiss(KeyError):
+    """
+    Raised when a url is not in the cache and the network is not allowed
+    """
+
+def cache_key(url):
+    """
+    Normalizes url into the key used by the cache (drops the api key)
+    """
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in IGNORED_PARAMS]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+class ResponseCache:
+    """
+    Response bodies are zlib compressed and stored under the sha256 of their
+    content, an SQLite index maps each url to its body. When the stored bodies
+    grow past max_bytes, the least recently used urls are evicted.
+
+    Parameters
+    ----------
+    cache_dir : string
+        directory holding the index and compressed bodies
+    max_bytes : int
+        size limit of compressed bodies on disk, default is 2 GB
+
+    """
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "index.db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                 url TEXT PRIMARY KEY, digest TEXT, accessed REAL)""")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], digest)
+
+    def get(self, url):
+        """
+        Returns cached body (bytes) for url, or None if it is not cached
+        """
+        key = cache_key(url)
+        with self.lock:
+            row = self.conn.execute("SELECT digest FROM responses WHERE url = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            # read under the lock, so a put on another thread can't evict the file first
+            try:
+                with open(self._object_path(row[0]), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                # index row without its file, e.g. after a crash. Drop it as a miss
+                self._forget(row[0])
+                self.misses += 1
+                return None
+            with self.conn:
+                self.conn.execute("UPDATE responses SET accessed = ? WHERE url = ?", (time.time(), key))
+            self.hits += 1
+        return zlib.decompress(data)
+
+    def _forget(self, digest):
+        # removes a body and every url pointing to it from the index. Caller holds the lock.
+        size = self.conn.execute("SELECT size FROM objects WHERE digest = ?", (digest,)).fetchone()
+        with self.conn:
+            self.conn.execute("DELETE FROM responses WHERE digest = ?", (digest,))
+            self.conn.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+        if size is not None:
+            self.total_bytes -= size[0]
+
+    def urls(self, like="%"):
+        """
+        Returns list of cached url keys matching a SQL LIKE pattern
+        """
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT url FROM responses WHERE url LIKE ?", (like,))]
+
+    def put(self, url, body):
+        """
+        Stores body (bytes) for url, evicting old entries if over max_bytes
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        path = self._object_path(digest)
+        with self.lock:
+            known = self.conn.execute("SELECT 1 FROM objects WHERE digest = ?", (digest,)).fetchone()
+            if known is None:
+                data = zlib.compress(body, 6)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+                self.total_bytes += len(data)
+            with self.conn:
+                if known is None:
+                    self.conn.execute("INSERT INTO objects VALUES (?, ?)", (digest, len(data)))
+                self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                                  (cache_key(url), digest, time.time()))
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # drop least recently used urls until under the limit, then delete
+        # any bodies no longer referenced by a url. Caller holds the lock.
+        # urls can share a body, its size is only freed with the last of them
+        refs = dict(self.conn.execute("SELECT digest, COUNT(*) FROM responses GROUP BY digest"))
+        rows = self.conn.execute("""SELECT r.url, r.digest, o.size FROM responses r
+                                    JOIN objects o ON r.digest = o.digest
+                                    ORDER BY r.accessed""")
+        freed, to_drop = 0, []
+        for url, digest, size in rows:
+            if self.total_bytes - freed <= self.max_bytes:
+                break
+            to_drop.append(url)
+            refs[digest] -= 1
+            if refs[digest] == 0:
+                freed += size
+        with self.conn:
+            self.conn.executemany("DELETE FROM responses WHERE url = ?", [(url,) for url in to_drop])
+            orphans = self.conn.execute("""SELECT digest, size FROM objects WHERE digest NOT IN
+                                           (SELECT digest FROM responses)""").fetchall()
+            self.conn.executemany("DELETE FROM objects WHERE digest = ?", [(d,) for d, s in orphans])
+        for digest, size in orphans:
+            try:
+                os.remove(self._object_path(digest))
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in per-stage instrumentation for the pipeline
+Functions are marked with the stage decorator (or the timed context
+manager), which records wall time, items, bytes fetched, cache hits and
+misses and memory per stage. Recording is off unless enable() is
+called, or NYT_INSTRUMENT is set to the path metrics are written to when
+the script exits (.prom for Prometheus text, anything else for json lines)
+
+e.g. NYT_INSTRUMENT=metrics.jsonl python preprocessing.py
+
+Time of a stage includes any stages called inside it. Work done inside
+process pool workers is recorded by the stage that submitted it
+
+Memory comes from ru_maxrss, the most the process has held since it
+started, so per stage there is process_max_rss_mb (that high-water mark
+when the stage finished, including every stage before it) and
+max_rss_growth_mb (how far the stage's calls raised it, i.e. memory the
+stage needed beyond any earlier peak)
+
+@author: markfunke
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import threading
+import resource
+import multiprocessing
+from contextlib import contextmanager
+
+_enabled = False
+_lock = threading.Lock()
+_stats = {}
+
+# stack of stages running in each thread, so bytes and cache counts
+# recorded by helpers like scraper.cached_get go to the calling stage
+_local = threading.local()
+
+def _max_rss_mb():
+    # ru_maxrss is kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024
+
+class StageStats:
+    """
+    Running totals for one stage
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.items = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.process_max_rss_mb = 0.0
+        self.max_rss_growth_mb = 0.0
+
+    def as_dict(self):
+        lookups = self.cache_hits + self.cache_misses
+        return {"stage": self.name, "calls": self.calls, "errors": self.errors, "items": self.items,
+                "seconds": round(self.seconds, 4),
+                "items_per_s": round(self.items / self.seconds, 1) if self.seconds else None,
+                "bytes": self.bytes, "cache_hits": self.cache_hits, "cache_misses": self.cache_misses,
+                "cache_hit_rate": round(self.cache_hits / lookups, 4) if lookups else None,
+                "process_max_rss_mb": round(self.process_max_rss_mb, 1),
+                "max_rss_growth_mb": round(self.max_rss_growth_mb, 1)}
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def enabled():
+    return _enabled
+
+def reset():
+    """
+    Clears all recorded stats
+    """
+    with _lock:
+        _stats.clear()
+
+def _get(name):
+    # caller holds the lock
+    if name not in _stats:
+        _stats[name] = StageStats(name)
+    return _stats[name]
+
+def add(nbytes=0, hits=0, misses=0, items=0, stage=None):
+    """
+    Adds bytes, cache hits / misses or items to a stage, default is the
+    innermost stage running in this thread. Does nothing when disabled
+    """
+    if not _enabled:
+        return
+    if stage is None:
+        stack = getattr(_local, "stack", None)
+        if not stack:
+            return
+        stage = stack[-1]
+    with _lock:
+        stats = _get(stage)
+        stats.bytes += nbytes
+        stats.cache_hits += hits
+        stats.cache_misses += misses
+        stats.items += items
+
+@contextmanager
+def timed(name, items=0):
+    """
+    Records the time of a block of code as one call of stage name
+
+    Parameters
+    ----------
+    name : string
+        stage name
+    items : int
+        items processed by the block, more can be added with add()
+
+    """
+    if not _enabled:
+        yield
+        return
+    stack = _local.__dict__.setdefault("stack", [])
+    stack.append(name)
+    rss_before = _max_rss_mb()
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        stack.pop()
+        rss_after = _max_rss_mb()
+        with _lock:
+            stats = _get(name)
+            stats.calls += 1
+            stats.errors += failed
+            stats.items += items
+            stats.seconds += seconds
+            stats.process_max_rss_mb = max(stats.process_max_rss_mb, rss_after)
+            stats.max_rss_growth_mb += rss_after - rss_before
+
+def stage(name, items=None):
+    """
+    Decorator recording each call of a function as stage name
+
+    Parameters
+    ----------
+    name : string
+        stage name
+    items : callable
+        items(result, *args, **kwargs) -> number of items the call processed,
+        default is 1 per call
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with timed(name):
+                result = func(*args, **kwargs)
+            add(items=items(result, *args, **kwargs) if items else 1, stage=name)
+            return result
+        return wrapper
+    return decorator
+
+def count_items(result, texts, *args, **kwargs):
+    # items helper for functions taking a batch of documents first
+    return len(texts)
+
+def summary():
+    """
+    Returns list of stage dictionaries, in the order stages first ran
+    """
+    with _lock:
+        return [stats.as_dict() for stats in _stats.values()]
+
+def to_jsonl():
+    return "".join(json.dumps(row) + "\n" for row in summary())
+
+# (metric, stage dictionary key, type, help) for the Prometheus export
+PROMETHEUS_METRICS = [
+    ("nyt_stage_calls_total", "calls", "counter", "Calls of the stage"),
+    ("nyt_stage_errors_total", "errors", "counter", "Calls of the stage that raised"),
+    ("nyt_stage_items_total", "items", "counter", "Items processed by the stage"),
+    ("nyt_stage_seconds_total", "seconds", "counter", "Wall time spent in the stage"),
+    ("nyt_stage_bytes_total", "bytes", "counter", "Bytes fetched by the stage"),
+    ("nyt_stage_cache_hits_total", "cache_hits", "counter", "Cache hits in the stage"),
+    ("nyt_stage_cache_misses_total", "cache_misses", "counter", "Cache misses in the stage"),
+    ("nyt_process_max_rss_megabytes", "process_max_rss_mb", "gauge",
+     "Process lifetime max RSS when the stage last finished"),
+    ("nyt_stage_max_rss_growth_megabytes_total", "max_rss_growth_mb", "counter",
+     "Growth of the process max RSS during the stage"),
+]
+
+def to_prometheus():
+    """
+    Returns stats in the Prometheus text exposition format
+    """
+    rows = summary()
+    lines = []
+    for metric, key, kind, help_text in PROMETHEUS_METRICS:
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+        lines += [f'{metric}{{stage="{row["stage"]}"}} {row[key]}' for row in rows]
+    return "\n".join(lines) + "\n"
+
+def write(path):
+    """
+    Writes stats to path, Prometheus text if it ends in .prom else json lines
+    """
+    with open(path, "w") as f:
+        f.write(to_prometheus() if path.endswith(".prom") else to_jsonl())
+
+if os.environ.get("NYT_INSTRUMENT"):
+    enable()
+    # only the script's own process writes, not pool workers inheriting the variable
+    if multiprocessing.parent_process() is None:
+        atexit.register(write, os.environ["NYT_INSTRUMENT"])
@@ -7,16 +7,146 @@ to a corpus of documents
 @author: markfunke
 """
 
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
 import pandas as pd
+import scipy.sparse
+import sklearn
+import time
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
 from gensim import models, matutils
 from sklearn.decomposition import NMF
-from textblob import TextBlob
+from sklearn.model_selection import ParameterGrid
+from textblob.en import sentiment as pattern_sentiment
 from sklearn.feature_extraction.text import TfidfVectorizer
 from nltk.corpus import stopwords
+import instrumentation
+from preprocessing import load_shards
+from dedup import load_duplicates, drop_duplicates
+
+# Vectorized doc-word matrices are cached here, see vectorize_corpus
+TFIDF_CACHE_DIR = "pickles/tfidf_cache"
+
+# Stated tolerance of sentiment_lexicon_scores against TextBlob, as the max
+# absolute difference of polarity or subjectivity for a document. Scores
+# only differ by float summation order.
+# benchmarks.bench_sentiment reports the share of documents within it
+LEXICON_TOLERANCE = 1e-9
+
+# Words kept per topic by top_topic_words. Covers the 2000 word title cloud
+# in word_cloud.py, which takes each word's highest weight over all topics
+TOP_WORDS = 2000
+
+# Names given to the 9 NMF topics, after reading their top words
+TOPIC_DICT = {0:"Love/Relationships",1:"Marriage",2:"Religion",3:"Military"
+              ,4:"Politics",5:"Parade/March/Crime",6:"HIV/AIDS",7:"Gender Identity"
+              ,8:"Boy Scouts"}
+
+# manually added stopwords related to topics
+TOPIC_STOP_WORDS = ["gay", "homosexual", "lesbian", "men", "woman", "york"
+                    ,"homosexuality", "editor", "article", "news", "year"
+                    ,"book", "guy", "girl", "man"]
+
+def build_stop_words(csv_path, extra_words=TOPIC_STOP_WORDS):
+    """
+    Builds stop word set from the csv created from stopword collection at
+    https://www.ranks.nl/stopwords, the NLTK stopword list and extra_words
+    """
+    stop_words_csv = pd.read_csv(csv_path)
+    stop_word_list = [word for word in stop_words_csv.stop_words]
+    stop_word_list.extend(stopwords.words('english')) # Add NLTK stopword list
+    stop_word_list.extend(extra_words)
+    return set(stop_word_list)
+
+def corpus_digest(texts):
+    """
+    Returns sha256 hex digest of the documents, in order
+    """
+    key = hashlib.sha256()
+    for text in texts:
+        key.update(text.encode())
+        key.update(b"\0")
+    return key.hexdigest()
+
+def tfidf_cache_path(texts, stop_words_to_use, min_df, max_df, ngram_range, cache_dir=TFIDF_CACHE_DIR,
+                     digest=None):
+    """
+    Returns path prefix of the TF-IDF cache entry for these documents and
+    vectorizer parameters, see vectorize_corpus. digest is corpus_digest(texts)
+    if already computed, so the documents aren't hashed again
+    """
+    params = {"stop_words": sorted(stop_words_to_use) if stop_words_to_use else None,
+              "min_df": min_df, "max_df": max_df, "ngram_range": list(ngram_range),
+              "sklearn": sklearn.__version__, "corpus": digest or corpus_digest(texts)}
+    key = hashlib.sha256(json.dumps(params).encode())
+    return os.path.join(cache_dir, key.hexdigest())
+
+@instrumentation.stage("vectorize", items=instrumentation.count_items)
+def vectorize_corpus(texts, stop_words_to_use, min_df=0, max_df=1, ngram_range=(1,1),
+                     cache_dir=TFIDF_CACHE_DIR, digest=None):
+    """
+    Fits TF-IDF vectorizer and transforms documents in one pass, caching the
+    result on disk. The cache key is a hash of the documents and every
+    vectorizer parameter, so re-runs with the same corpus and parameters
+    (e.g. only changing the number of topics) skip vectorizing entirely
+    
+    Parameters
+    ----------
+    texts : Series or list
+        documents of text
+    stop_words_to_use : Set
+        stop words to be excluded from vectorizer
+    min_df, max_df, ngram_range : sklearn TdidfVectorizer input, see documentation
+    cache_dir : string
+        directory of cached matrices, None to disable caching
+    digest : string
+        corpus_digest(texts), if already computed
+
+    Returns
+    -------
+    doc_word : scipy.sparse.csr_matrix
+        document-term TF-IDF matrix
+    vocab : array
+        term for each column of doc_word
+    cv : TfidfVectorizer
+        fitted vectorizer
+
+    """
+    if cache_dir is not None:
+        path = tfidf_cache_path(texts, stop_words_to_use, min_df, max_df, ngram_range, cache_dir, digest)
+        if os.path.exists(path + ".vectorizer.p"):
+            doc_word = scipy.sparse.load_npz(path + ".npz")
+            vocab = np.load(path + ".vocab.npy", allow_pickle=True)
+            with open(path + ".vectorizer.p", "rb") as f:
+                cv = pickle.load(f)
+            instrumentation.add(hits=1)
+            return doc_word, vocab, cv
+        instrumentation.add(misses=1)
+    
+    stop_words = sorted(stop_words_to_use) if stop_words_to_use else None
+    cv = TfidfVectorizer(min_df=min_df, max_df=max_df, ngram_range = ngram_range, stop_words = stop_words)
+    doc_word = cv.fit_transform(texts)
+    vocab = cv.get_feature_names_out()
+    # terms dropped by min_df/max_df aren't needed to transform, and can be huge for bigrams
+    cv.stop_words_ = None
+    
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        scipy.sparse.save_npz(path + ".npz", doc_word, compressed=False)
+        np.save(path + ".vocab.npy", vocab)
+        # vectorizer written last, its presence marks the entry as complete
+        with open(path + ".vectorizer.p", "wb") as f:
+            pickle.dump(cv, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return doc_word, vocab, cv
 
 def LDA_topic_words(article_clean,stop_words_to_use,min_df=0,max_df=1,ngram_range=(1,1),
-                    num_topics=2, passes = 10, alpha = 'auto', iterations = 1000):
+                    num_topics=2, passes = 10, alpha = 'auto', iterations = 1000,
+                    cache_dir=TFIDF_CACHE_DIR, workers=None, chunksize=2000, as_array=False):
     """
     Vectorizes documents, fits LDA model and returns doc-topic matrix
     
@@ -41,34 +171,57 @@ def LDA_topic_words(article_clean,stop_words_to_use,min_df=0,max_df=1,ngram_rang
         default is 'auto'
     iterations : gensim LDA model input, see documentation
         default is 1000
+    cache_dir : string
+        TF-IDF cache directory, see vectorize_corpus
+    workers : int
+        if given, trains online across this many worker processes with gensim
+        LdaMulticore. alpha='auto' isn't supported there, 'symmetric' is used.
+        default is None, single process LdaModel
+    chunksize : int
+        documents streamed to the model per training chunk, default is 2000
+    as_array : bool
+        return doc-topic distribution as a dense float32 array instead of
+        a list of (topic, probability) lists. default is False
 
     Returns
     -------
     lda_docs : doc-topic matrix output from LDA
+        (n_docs, num_topics) float32 array if as_array
 
     """
-    # Vectorize Text
-    cv = TfidfVectorizer(min_df=min_df, max_df=max_df
-                         ,ngram_range = ngram_range, stop_words = stop_words_to_use)
-    cv.fit(article_clean["article_text"])
-    doc_word = cv.transform(article_clean["article_text"]).transpose()
+    # Vectorize Text, loaded from cache if already done with these parameters
+    doc_word, vocab, cv = vectorize_corpus(article_clean["article_text"], stop_words_to_use,
+                                           min_df=min_df, max_df=max_df, ngram_range=ngram_range,
+                                           cache_dir=cache_dir)
     
     # Convert sparse matrix of counts to a gensim corpus
-    corpus = matutils.Sparse2Corpus(doc_word)
-    id2word = dict((v, k) for k, v in cv.vocabulary_.items())
+    corpus = matutils.Sparse2Corpus(doc_word.transpose())
+    id2word = dict(enumerate(vocab))
     
     # Create lda model    
-    lda = models.LdaModel(corpus=corpus, num_topics=num_topics, id2word=id2word
-                          ,passes=passes, alpha = alpha ,iterations=iterations)
+    if workers and alpha == 'auto':
+        print("LdaMulticore does not support alpha='auto', using 'symmetric'")
+        alpha = 'symmetric'
+    with instrumentation.timed("lda_fit", items=doc_word.shape[0]):
+        if workers:
+            lda = models.LdaMulticore(corpus=corpus, num_topics=num_topics, id2word=id2word, workers=workers
+                                      ,chunksize=chunksize, passes=passes, alpha = alpha ,iterations=iterations)
+        else:
+            lda = models.LdaModel(corpus=corpus, num_topics=num_topics, id2word=id2word, chunksize=chunksize
+                                  ,passes=passes, alpha = alpha ,iterations=iterations)
     
     # Print topics and return doc-topic matrix
     lda.print_topics()
-    lda_corpus = lda[corpus]
+    lda_corpus = lda.get_document_topics(corpus, minimum_probability=0) if as_array else lda[corpus]
+    if as_array:
+        return matutils.corpus2dense(lda_corpus, num_terms=num_topics, num_docs=doc_word.shape[0],
+                                     dtype=np.float32).T
     lda_docs = [doc for doc in lda_corpus]  
     
     return lda_docs
 
-def NMF_topic_words(article_clean,stop_words_to_use, n_topics=2, min_df=0, max_df=1, ngram_range = (1,1)):
+def NMF_topic_words(article_clean,stop_words_to_use, n_topics=2, min_df=0, max_df=1, ngram_range = (1,1),
+                    cache_dir=TFIDF_CACHE_DIR, model_path=None):
     """
 
     Parameters
@@ -86,34 +239,380 @@ def NMF_topic_words(article_clean,stop_words_to_use, n_topics=2, min_df=0, max_d
         default is 1
     ngram_range : sklearn TdidfVectorizer input, see documentation
         default is (1,1)
+    cache_dir : string
+        TF-IDF cache directory, see vectorize_corpus
+    model_path : string
+        if given, saves fitted vectorizer and NMF model here so new articles
+        can be added with update_topic_model. default is None
 
     Returns
     -------
     doc_topic : doc-topic matrix output from NMF
-    topic_word : topic-word matrix output from NMF
+    top_words : top words of each topic from the NMF topic-word matrix,
+        see top_topic_words
 
     """
     
-    # Vectorize text
-    cv = TfidfVectorizer(min_df=min_df, max_df=max_df, ngram_range = ngram_range, stop_words = stop_words_to_use)
-    cv.fit(article_clean["article_text"])
-    doc_word = cv.transform(article_clean["article_text"])
+    # Vectorize text, loaded from cache if already done with these parameters
+    doc_word, vocab, cv = vectorize_corpus(article_clean["article_text"], stop_words_to_use,
+                                           min_df=min_df, max_df=max_df, ngram_range=ngram_range,
+                                           cache_dir=cache_dir)
     
     # Fit NMF model
     nmf_model = NMF(n_topics)
-    doc_topic = nmf_model.fit_transform(doc_word)
-    
-    # Create topic-word matrix and print top words for each topic
-    columns = ["topic"+str(n) for n in range(n_topics)]
-    topic_word = (pd.DataFrame(nmf_model.components_.round(3),
-             index = columns,
-             columns = cv.get_feature_names()).transpose())
-    for n in range(n_topics):
-        topic_words = topic_word.sort_values(by=columns[n], ascending=False).iloc[0:15,n]
-        print(topic_words)
+    with instrumentation.timed("nmf_fit", items=doc_word.shape[0]):
+        doc_topic = nmf_model.fit_transform(doc_word)
+    if model_path is not None:
+        save_topic_model(model_path, cv, nmf_model, doc_word, doc_topic)
+    
+    # Keep only the top words of each topic and print the first 15
+    top_words = top_topic_words(nmf_model.components_, vocab)
+    print_top_words(top_words)
         
-    return doc_topic, topic_word
+    return doc_topic, top_words
+
+def top_word_ids(components, k):
+    """
+    Returns (n_topics, k) array of the highest weighted word ids per topic,
+    in descending weight order. argpartition finds the k words per topic
+    without sorting the whole vocabulary, only those k are then sorted
+    """
+    k = min(k, components.shape[1])
+    ids = np.argpartition(-components, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(components, ids, axis=1), axis=1)
+    return np.take_along_axis(ids, order, axis=1)
+
+def top_topic_words(components, vocab, k=TOP_WORDS):
+    """
+    Compact top-k representation of a topic-word matrix
+    
+    Parameters
+    ----------
+    components : array
+        topic-word matrix, e.g. NMF components_
+    vocab : array
+        vectorizer vocabulary, one word per column of components
+    k : int
+        number of words kept per topic, default is TOP_WORDS
+
+    Returns
+    -------
+    top_words : dictionary
+        "vocab": array of every word kept by any topic, "word_ids": (n_topics, k)
+        indexes into that vocab in descending weight order, "weights": (n_topics, k)
+        float32 weights of those words
+
+    """
+    ids = top_word_ids(components, k)
+    kept, word_ids = np.unique(ids, return_inverse=True)
+    return {"vocab": np.asarray(vocab, dtype=object)[kept],
+            "word_ids": word_ids.reshape(ids.shape),
+            "weights": np.take_along_axis(components, ids, axis=1).astype(np.float32)}
+
+def print_top_words(top_words, n=15):
+    """
+    Prints the n highest weighted words of each topic
+    """
+    for topic, (ids, weights) in enumerate(zip(top_words["word_ids"], top_words["weights"])):
+        print(pd.Series(weights[:n].round(3), index=top_words["vocab"][ids[:n]], name="topic"+str(topic)))
+
+def save_top_words(path, top_words):
+    """
+    Saves top_topic_words output for word_cloud.py
+    """
+    with open(path, "wb") as f:
+        pickle.dump(top_words, f)
+
+def load_top_words(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
         
+def save_topic_model(path, cv, nmf_model, doc_word, doc_topic):
+    """
+    Saves fitted vectorizer and NMF model, plus the running sums
+    WtW = doc_topic' doc_topic and WtX = doc_topic' doc_word that
+    update_topic_model needs to update the topics from new documents only
+    
+    Parameters
+    ----------
+    path : string
+        path of pickle to write
+    cv : TfidfVectorizer
+        fitted vectorizer
+    nmf_model : NMF
+        fitted NMF model
+    doc_word : sparse matrix
+        document-term matrix the model was fit on
+    doc_topic : array
+        doc-topic matrix from fit_transform
+
+    Returns
+    -------
+    None.
+
+    """
+    model = {"vectorizer": cv, "nmf": nmf_model,
+             "WtW": doc_topic.T @ doc_topic,
+             "WtX": np.asarray((doc_word.T @ doc_topic).T)}
+    with open(path, "wb") as f:
+        pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_topic_model(path):
+    """
+    Loads dictionary saved by save_topic_model: "vectorizer", "nmf", "WtW", "WtX"
+    """
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def append_doc_topic(path, doc_topic, overwrite=False):
+    """
+    Appends rows to a doc-topic matrix stored as raw float32 on disk,
+    so adding documents never rewrites the historical rows
+
+    Parameters
+    ----------
+    path : string
+        path of doc-topic file
+    doc_topic : array
+        rows to add, (n_docs, n_topics)
+    overwrite : bool
+        start a new file instead of appending. default is False
+
+    Returns
+    -------
+    n_before : int
+        number of rows in the file before these were added
+
+    """
+    n_topics = doc_topic.shape[1]
+    n_before = 0 if overwrite or not os.path.exists(path) else os.path.getsize(path) // (4 * n_topics)
+    with open(path, "wb" if overwrite else "ab") as f:
+        f.write(np.ascontiguousarray(doc_topic, dtype=np.float32).tobytes())
+    return n_before
+
+def load_doc_topic(path, n_topics):
+    """
+    Reads doc-topic matrix written by append_doc_topic, as (n_docs, n_topics) float32
+    """
+    return np.fromfile(path, dtype=np.float32).reshape(-1, n_topics)
+
+def tableau_rows(summary, doc_topic):
+    """
+    Builds rows of the Tableau topic export from article metadata
+
+    Parameters
+    ----------
+    summary : DataFrame
+        article metadata with "year" and "decade", same rows as doc_topic
+    doc_topic : array
+        doc-topic matrix
+
+    Returns
+    -------
+    tableau : DataFrame
+        year, year_bin, decade, topic, topic_name for articles after 1969
+
+    """
+    summary = summary.copy()
+    summary["topic"] = doc_topic.argmax(axis=1)
+    summary["year"] = summary["year"].astype(int)
+    summary["year_bin"] = bin_years(summary["year"], low_end=1960, high_end=2020, width=5)
+    tableau = summary.loc[summary['year']>1969,["year","year_bin","decade","topic"]]
+    tableau["topic_name"] = tableau["topic"].apply(lambda x: TOPIC_DICT[x])
+    return tableau
+
+def update_topic_model(new_articles, model_path="pickles/topic_model.p", doc_topic_path="pickles/doc_topic.f32",
+                       tableau_path="csv/tableau_topics.csv", update_iter=0, top_words_path="pickles/topic_words.p"):
+    """
+    Adds a batch of newly crawled articles (e.g. a week) to an NMF topic
+    model saved by NMF_topic_words, without refitting or touching historical
+    rows. Cost grows with the size of the batch, not the whole corpus.
+    New documents are vectorized with the fitted vocabulary, so words not
+    seen in the original fit are ignored
+    
+    Parameters
+    ----------
+    new_articles : DataFrame
+        lemmatized "article_text" plus "year" and "decade" of new articles
+    model_path : string
+        topic model saved by NMF_topic_words / save_topic_model
+    doc_topic_path : string
+        doc-topic file to append to, see append_doc_topic
+    tableau_path : string
+        Tableau csv to append to
+    update_iter : int
+        number of multiplicative updates of the topic-word matrix using the
+        new documents, 0 keeps topics fixed. Updates use running sums of
+        WtW and WtX, so they cost the same whatever the corpus size
+    top_words_path : string
+        top words for word_cloud.py, rewritten from the updated topics when
+        update_iter is given, see save_top_words. None leaves it alone
+
+    Returns
+    -------
+    doc_topic : array
+        doc-topic rows of the new articles
+
+    """
+    model = load_topic_model(model_path)
+    cv, nmf_model = model["vectorizer"], model["nmf"]
+    doc_word = cv.transform(new_articles["article_text"])
+    doc_topic = nmf_model.transform(doc_word)
+    
+    if update_iter:
+        model["WtW"] += doc_topic.T @ doc_topic
+        model["WtX"] += np.asarray((doc_word.T @ doc_topic).T)
+        components = nmf_model.components_
+        for _ in range(update_iter):
+            components *= model["WtX"] / np.maximum(model["WtW"] @ components, 1e-10)
+        nmf_model.components_ = components
+        with open(model_path, "wb") as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # so word clouds and topic labels show the updated topics
+        if top_words_path is not None:
+            save_top_words(top_words_path, top_topic_words(components, cv.get_feature_names_out()))
+    
+    n_before = append_doc_topic(doc_topic_path, doc_topic)
+    tableau = tableau_rows(new_articles.reset_index(drop=True), doc_topic)
+    tableau.index += n_before
+    tableau.to_csv(tableau_path, mode="a", header=not os.path.exists(tableau_path))
+    return doc_topic
+
+def umass_coherence(doc_word, top_ids):
+    """
+    UMass coherence of a topic's top words, from how often pairs of them
+    appear in the same document. Higher (closer to 0) is more coherent
+    
+    Parameters
+    ----------
+    doc_word : sparse matrix
+        document-term matrix
+    top_ids : array
+        column ids of the topic's top words, most important first
+
+    Returns
+    -------
+    coherence : float
+        mean of log((D(w_i, w_j) + 1) / D(w_j)) over pairs where w_j ranks above w_i
+
+    """
+    present = (doc_word[:, top_ids] > 0).astype(np.float64)
+    co_docs = (present.T @ present).toarray() # diagonal is document frequency
+    i, j = np.tril_indices(len(top_ids), k=-1)
+    return float(np.mean(np.log((co_docs[i, j] + 1) / np.maximum(co_docs[j, j], 1))))
+
+# (doc_word, vocab) of this sweep worker, keyed by cache path, or by
+# vectorizer for matrices sent to the worker when there is no cache
+_sweep_matrices = {}
+
+def fit_sweep_config(config):
+    """
+    Fits one topic model configuration of a sweep, run in a worker process.
+    The doc-word matrix is read from the TF-IDF cache once per worker
+    
+    Parameters
+    ----------
+    config : dictionary
+        "model" ("nmf" or "lda"), "n_topics", "top_n", "matrix" (TF-IDF cache
+        path, or key of a matrix sent by sweep_worker_init), vectorizer
+        parameters, and for lda "passes", "iterations", "alpha"
+
+    Returns
+    -------
+    result : dictionary
+        config plus fit_seconds, reconstruction_err (nmf), log_perplexity (lda),
+        coherence (mean UMass over topics) and top_words per topic
+
+    """
+    path = config["matrix"]
+    if path not in _sweep_matrices:
+        _sweep_matrices[path] = (scipy.sparse.load_npz(path + ".npz"),
+                                 np.load(path + ".vocab.npy", allow_pickle=True))
+    doc_word, vocab = _sweep_matrices[path]
+    
+    result = {k: v for k, v in config.items() if k != "matrix"}
+    start = time.perf_counter()
+    if config["model"] == "nmf":
+        nmf_model = NMF(config["n_topics"])
+        nmf_model.fit(doc_word)
+        components = nmf_model.components_
+        result["reconstruction_err"] = nmf_model.reconstruction_err_
+    else:
+        corpus = matutils.Sparse2Corpus(doc_word.transpose())
+        lda = models.LdaModel(corpus=corpus, num_topics=config["n_topics"], id2word=dict(enumerate(vocab)),
+                              passes=config.get("passes", 10), alpha=config.get("alpha", "auto"),
+                              iterations=config.get("iterations", 1000))
+        components = lda.get_topics()
+        result["log_perplexity"] = lda.log_perplexity(corpus)
+    result["fit_seconds"] = round(time.perf_counter() - start, 3)
+    
+    top_ids = top_word_ids(components, config["top_n"])
+    result["coherence"] = np.mean([umass_coherence(doc_word, ids) for ids in top_ids])
+    result["top_words"] = [" ".join(vocab[ids]) for ids in top_ids]
+    return result
+
+def sweep_worker_init(matrices=None):
+    # one BLAS thread per process, the pool provides the parallelism
+    threadpool_limits(1)
+    _sweep_matrices.update(matrices or {})
+
+def sweep_topic_models(article_clean, stop_words_to_use, grid, n_jobs=None, top_n=15,
+                       cache_dir=TFIDF_CACHE_DIR):
+    """
+    Fits NMF and/or LDA models for every combination in a parameter grid
+    across a pool of processes. Each distinct vectorizer configuration is
+    vectorized once, through the TF-IDF cache, and shared by all fits using it
+    
+    Parameters
+    ----------
+    article_clean : DataFrame
+        DataFrame containing "article_text" series which must be documents
+        of text
+    stop_words_to_use : Set
+        stop words to be excluded from vectorizer
+    grid : dictionary or list of dictionaries
+        sklearn ParameterGrid input, e.g.
+        {"model": ["nmf"], "n_topics": [5, 9, 12], "min_df": [0.01],
+         "max_df": [0.9], "ngram_range": [(1,1), (1,2)]}
+        vectorizer keys default to min_df=0.01, max_df=0.9, ngram_range=(1,1)
+    n_jobs : int
+        number of worker processes, default is one per core
+    top_n : int
+        number of top words recorded, and used for coherence, per topic
+    cache_dir : string
+        TF-IDF cache directory, see vectorize_corpus. None keeps the matrices
+        in memory and sends each worker all of them when it starts
+
+    Returns
+    -------
+    results : DataFrame
+        one row per configuration, see fit_sweep_config
+
+    """
+    texts = article_clean["article_text"]
+    # documents hashed once for every vectorizer configuration
+    digest = corpus_digest(texts) if cache_dir is not None else None
+    configs = []
+    matrices, in_memory = {}, {}
+    for params in ParameterGrid(grid):
+        config = {"model": "nmf", "min_df": 0.01, "max_df": 0.9, "ngram_range": (1,1), "top_n": top_n}
+        config.update(params)
+        vectorizer = (config["min_df"], config["max_df"], tuple(config["ngram_range"]))
+        if vectorizer not in matrices:
+            doc_word, vocab, cv = vectorize_corpus(texts, stop_words_to_use, *vectorizer, cache_dir=cache_dir,
+                                                   digest=digest)
+            if cache_dir is None:
+                matrices[vectorizer] = repr(vectorizer)
+                in_memory[repr(vectorizer)] = (doc_word, vocab)
+            else:
+                matrices[vectorizer] = tfidf_cache_path(texts, stop_words_to_use, *vectorizer, cache_dir, digest)
+        config["matrix"] = matrices[vectorizer]
+        configs.append(config)
+    
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=sweep_worker_init, initargs=(in_memory,)) as executor:
+        results = list(executor.map(fit_sweep_config, configs))
+    return pd.DataFrame(results)
+
 def find_bins(year,low_end,high_end,width):
     """
     Places year into pre-defined bins as described by user
@@ -127,7 +626,279 @@ def find_bins(year,low_end,high_end,width):
         if year < num:
             return bins[i-1]
         
-def sentiment_analysis(sent_df):
+def bin_years(years, low_end, high_end, width):
+    """
+    Vectorized find_bins: places every year into pre-defined bins at once
+    
+    Parameters
+    ----------
+    years : array or Series
+        integer years
+    low_end: low range of year bins
+    high_end: high range of year bins
+    width: interval of year bins
+
+    Returns
+    -------
+    bins : array
+        lower edge of each year's bin, same as find_bins for years in
+        [low_end, high_end + width). Years outside that range are NaN,
+        where find_bins would return None (too late) or wrap around to the
+        last bin (too early)
+
+    """
+    years = np.asarray(years)
+    bins = low_end + (years - low_end) // width * width
+    last_edge = list(range(low_end,high_end+width*2,width))[-1]
+    outside = (years < low_end) | (years >= last_edge)
+    if outside.any():
+        bins = bins.astype(float)
+        bins[outside] = np.nan
+    return bins
+
+def topic_year_cube(years, topics, polarity, subjectivity):
+    """
+    Aggregates article-level results into a year x topic cube in one
+    grouping pass, with counts and sums so any rollup can be derived
+    from the cube without going back to the articles
+    
+    Parameters
+    ----------
+    years, topics : arrays
+        integer year and topic of each article
+    polarity, subjectivity : arrays
+        sentiment scores of each article
+
+    Returns
+    -------
+    cube : DataFrame
+        one row per year and topic: count, polarity_sum, subjectivity_sum,
+        polarity_mean, subjectivity_mean. No rows when there are no articles
+
+    """
+    years = np.asarray(years, dtype=np.int64)
+    topics = np.asarray(topics, dtype=np.int64)
+    if len(years):
+        first_year = years.min()
+        n_years = years.max() - first_year + 1
+        n_topics = topics.max() + 1
+    else:
+        first_year = n_years = n_topics = 0
+    cell = (years - first_year) * n_topics + topics
+    size = n_years * n_topics
+    
+    cube = pd.DataFrame({"year": np.repeat(np.arange(first_year, first_year + n_years), n_topics),
+                         "topic": np.tile(np.arange(n_topics), n_years),
+                         "count": np.bincount(cell, minlength=size),
+                         # bincount of nothing is int even with weights
+                         "polarity_sum": np.bincount(cell, weights=polarity, minlength=size).astype(float, copy=False),
+                         "subjectivity_sum": np.bincount(cell, weights=subjectivity,
+                                                         minlength=size).astype(float, copy=False)})
+    cube = cube[cube["count"] > 0].reset_index(drop=True)
+    return add_cube_means(cube)
+
+def add_cube_means(cube):
+    cube["polarity_mean"] = cube["polarity_sum"] / cube["count"]
+    cube["subjectivity_mean"] = cube["subjectivity_sum"] / cube["count"]
+    return cube
+
+def rollup_cube(cube, by):
+    """
+    Rolls the year x topic cube up to coarser groups, e.g. ["decade"],
+    ["year_bin", "topic"] or ["topic"]. "decade" and "year_bin" (5 years,
+    from 1960) are derived from year
+    
+    Returns
+    -------
+    DataFrame
+        count, sums and means for each group
+
+    """
+    cube = cube.assign(decade=cube["year"] // 10 * 10,
+                       year_bin=bin_years(cube["year"], low_end=1960, high_end=2020, width=5))
+    rolled = cube.groupby(by)[["count", "polarity_sum", "subjectivity_sum"]].sum().reset_index()
+    return add_cube_means(rolled)
+
+def tableau_from_cube(cube):
+    """
+    Builds Tableau export of topic counts and mean sentiment per year and
+    topic from the cube, for years after 1969
+    """
+    tableau = cube[cube["year"] > 1969].copy()
+    tableau["year_bin"] = bin_years(tableau["year"], low_end=1960, high_end=2020, width=5)
+    tableau["decade"] = tableau["year"] // 10 * 10
+    tableau["topic_name"] = tableau["topic"].map(TOPIC_DICT)
+    return tableau[["year", "year_bin", "decade", "topic", "topic_name", "count",
+                    "polarity_mean", "subjectivity_mean"]]
+
+def sentiment_chunk(texts):
+    """
+    Scores a list of documents with TextBlob's pattern analyzer, one pass per
+    document for both scores (same result as TextBlob(text).sentiment)
+    """
+    return [tuple(pattern_sentiment(text)) for text in texts]
+
+def sentiment_scores(texts, n_jobs=None, chunksize=200):
+    """
+    Scores TextBlob polarity and subjectivity of documents across a pool
+    of processes
+    
+    Parameters
+    ----------
+    texts : Series or list
+        text documents to be evaluated
+    n_jobs : int
+        number of worker processes, default is one per core.
+        1 runs in this process without a pool
+    chunksize : int
+        number of documents sent to a worker at a time
+
+    Returns
+    -------
+    polarity, subjectivity : arrays
+        one score per document, in input order
+
+    """
+    docs = list(texts)
+    chunks = [docs[i:i + chunksize] for i in range(0, len(docs), chunksize)]
+    if n_jobs == 1:
+        scores = [score for chunk in chunks for score in sentiment_chunk(chunk)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            scores = [score for chunk in executor.map(sentiment_chunk, chunks) for score in chunk]
+    scores = np.array(scores, dtype=np.float64).reshape(-1, 2)
+    return scores[:, 0], scores[:, 1]
+
+def lexicon_token_table(tokens):
+    """
+    Looks up each distinct token once in TextBlob's lexicon
+
+    Returns
+    -------
+    codes : array
+        index of each token into the table columns
+    table : dictionary
+        per distinct token: "known", "p", "s", "i" (scores and intensity
+        averaged over word senses), "mod" (has an adverb sense, modifies
+        the next word), "ly" (ends in "ly", takes a following negation),
+        "neg" (negation word), "len", "strip_len" (length without ')
+
+    """
+    codes, uniques = pd.factorize(np.array(tokens, dtype=object))
+    scores = [pattern_sentiment.get(w) for w in uniques]
+    psi = np.array([w[None][:3] if w else (0.0, 0.0, 1.0) for w in scores], dtype=np.float64).reshape(-1, 3)
+    table = {"known": np.array([w is not None for w in scores], dtype=bool),
+             "p": psi[:, 0], "s": psi[:, 1], "i": psi[:, 2],
+             "mod": np.array([bool(w) and any(pos in w for pos in pattern_sentiment.modifiers) for w in scores],
+                             dtype=bool),
+             "ly": np.array([pattern_sentiment.modifier(w) for w in uniques], dtype=bool),
+             "neg": np.isin(uniques, pattern_sentiment.negations),
+             "len": np.array([len(w) for w in uniques]),
+             "strip_len": np.array([len(w.strip("'")) for w in uniques])}
+    return codes, table
+
+def lexicon_chunk(texts):
+    """
+    Scores a list of documents for sentiment_lexicon_scores, over one flat
+    array of all their tokens
+    """
+    docs = [text.split() for text in texts]
+    # a long unknown word after each document ends any modifier or negation
+    tokens = [w for doc in docs for w in doc + ["<doc>"]]
+    codes, table = lexicon_token_table(tokens)
+    known, mod, ly, neg = (table[c][codes] for c in ("known", "mod", "ly", "neg"))
+    length, strip_len = table["len"][codes], table["strip_len"][codes]
+    
+    def prefix(flags):
+        # count of flags in the open interval (a, b) is c[b] - c[a + 1]
+        return np.r_[0, np.cumsum(flags)]
+    position = np.arange(len(tokens))
+    unknown = ~known
+    # unknown words that end a modifier's reach: any of 3+ letters, and
+    # for modifiers not ending in "ly", negations too ("very not good")
+    breaks, neg_breaks = prefix(unknown & ~neg & (length > 2)), prefix(neg & (length > 2))
+    # unknown words that end a negation's reach ("not a good" but not "not the good")
+    clears = prefix(unknown & ~neg & (strip_len > 1))
+    negs = prefix(neg)
+    
+    K = np.flatnonzero(known)
+    if not len(K):
+        return np.zeros(len(docs)), np.zeros(len(docs))
+    doc_of = np.repeat(np.arange(len(docs)), [len(doc) + 1 for doc in docs])[K]
+    prev = np.r_[-1, K[:-1]]
+    has_prev = prev >= 0
+    prev_ = np.maximum(prev, 0)
+    # known word merges into the previous one's assessment (is modified by it)
+    reach = breaks[K] - breaks[prev_ + 1] + np.where(ly[prev_], 0, neg_breaks[K] - neg_breaks[prev_ + 1])
+    merged = has_prev & mod[prev_] & (reach == 0)
+    
+    # negation pending when the known word is reached: the last negation
+    # since the previous known word, unless an "ly" modifier took it
+    last_neg = np.maximum.accumulate(np.where(neg, position, -1))[np.maximum(K - 1, 0)]
+    last_neg[K == 0] = -1
+    last_neg_ = np.maximum(last_neg, 0)
+    taken = has_prev & mod[prev_] & ly[prev_] & (breaks[last_neg_] - breaks[prev_ + 1] == 0)
+    pending = (last_neg > prev) & (clears[K] - clears[last_neg_ + 1] == 0) & ~taken
+    
+    # negations taken by an "ly" modifier before its reach ends
+    next_break = np.minimum.accumulate((np.where(unknown & ~neg & (length > 2), position, len(tokens)))[::-1])[::-1]
+    end = np.minimum(np.r_[K[1:], len(tokens)], next_break[np.minimum(K + 1, len(tokens) - 1)])
+    negated_after = mod[K] & ly[K] & (negs[end] - negs[K + 1] > 0)
+    
+    # one assessment per run of merged words, scored from its last word
+    # times the intensity of the word before (inverted by a negation)
+    assessment = np.cumsum(~merged) - 1
+    negated = np.bincount(assessment, weights=pending | negated_after) > 0
+    last = np.r_[~merged[1:], True]
+    p, s = table["p"][codes[K]], table["s"][codes[K]]
+    intensity = table["i"][codes[prev_]]
+    intensity = np.where(np.r_[False, pending[:-1]], 1 / intensity, intensity)
+    p_last = np.where(merged, np.clip(p * intensity, -1, 1), p)[last]
+    s_last = np.where(merged, np.clip(s * intensity, -1, 1), s)[last]
+    p_last = np.where(negated, -0.5 * p_last, p_last)
+    
+    assess_doc = doc_of[last]
+    n_scored = np.maximum(np.bincount(assess_doc, minlength=len(docs)), 1)
+    return (np.bincount(assess_doc, weights=p_last, minlength=len(docs)) / n_scored,
+            np.bincount(assess_doc, weights=s_last, minlength=len(docs)) / n_scored)
+
+def sentiment_lexicon_scores(texts, chunksize=5000):
+    """
+    Vectorized TextBlob sentiment of cleaned text: the same scores as
+    pattern's assessments (see sentiment_chunk), computed with array
+    operations over every token rather than a Python loop per word.
+    Intensifiers ("very good" is good times the intensity of very, as one
+    word) and negation ("not good", "not a good", "really not good" are -0.5
+    times good) follow pattern's rules, found from prefix sums of which
+    known words each modifier or negation reaches.
+    Emoticons and "!" aren't scored, clean_text removes them.
+    Uncleaned text with apostrophe contractions can score differently
+    from TextBlob ("it isn't good" is 0.25 here, 0.7 in TextBlob).
+    clean_text splits them into separate words ("it isn t good"), which
+    score the same as TextBlob
+    
+    Parameters
+    ----------
+    texts : Series or list
+        documents cleaned with clean_text (lowercase, no punctuation).
+        Other text is split on whitespace, see above for apostrophes
+    chunksize : int
+        documents scored at a time, bounds the memory of the token arrays
+
+    Returns
+    -------
+    polarity, subjectivity : arrays
+        one score per document, 0 for documents with no lexicon words
+
+    """
+    docs = list(texts)
+    scores = [lexicon_chunk(docs[i:i + chunksize]) for i in range(0, len(docs), chunksize)]
+    if not scores:
+        return np.zeros(0), np.zeros(0)
+    return np.concatenate([pol for pol, sub in scores]), np.concatenate([sub for pol, sub in scores])
+
+@instrumentation.stage("sentiment_analysis", items=instrumentation.count_items)
+def sentiment_analysis(sent_df, n_jobs=None, lexicon=False):
     """
     Performs TextBlob sentiment analysis on DataFrame of documents
     
@@ -135,6 +906,11 @@ def sentiment_analysis(sent_df):
     ----------
     sent_df : DataFrame
         DataFrame containing text documents to be evaluated
+    n_jobs : int
+        number of worker processes, see sentiment_scores
+    lexicon : bool
+        use the faster vectorized scoring, see sentiment_lexicon_scores.
+        default is False, TextBlob itself
 
     Returns
     -------
@@ -142,50 +918,38 @@ def sentiment_analysis(sent_df):
         Contains document, polarity, and sentiment score
 
     """
-    pol = []
-    sub=[]
-    for article in sent_df.article_text:
-        sentp = TextBlob(article).sentiment.polarity
-        sents = TextBlob(article).sentiment.subjectivity
-        pol.append(sentp)
-        sub.append(sents)  
+    if lexicon:
+        pol, sub = sentiment_lexicon_scores(sent_df.article_text)
+    else:
+        pol, sub = sentiment_scores(sent_df.article_text, n_jobs=n_jobs)
        
     sent_df['Polarity'] = pol
     sent_df['Subjectivity'] = sub
     return sent_df
 
-if __name__ == __main__:
+if __name__ == "__main__":
     
-    # Read in article_clean from preprocessing.py
-    article_clean = pd.read_pickle("pickles/cleaned_df.p")
+    # Read in article_clean from preprocessing.py, keeping the first article
+    # of each cluster of near-duplicates found by dedup.py
+    duplicates = load_duplicates("pickles/duplicates.arrow")
+    article_clean = drop_duplicates(load_shards("pickles/shards/cleaned", ["article_text"]), duplicates)
     
     # Create stop word list
-    # Import csv created from stopword collection at the following site:
-    # https://www.ranks.nl/stopwords
-    stop_words_csv = pd.read_csv("csv/stopwords.csv")
-    stop_word_list = [word for word in stop_words_csv.stop_words]
-    stop_word_list.extend(stopwords.words('english')) # Add NLTK stopword list
-    # manually added stopwords related to topics
-    stop_word_list.extend(["gay", "homosexual", "lesbian", "men", "woman", "york"
-                           ,"homosexuality", "editor", "article", "news", "year"
-                           ,"book", "guy", "girl", "man"])
-    stop_words_to_use = set(stop_word_list)
+    stop_words_to_use = build_stop_words("csv/stopwords.csv")
     
     # Fit LDA model
     # Note: This is an iterative process and can be used to test multiple
     # parameters to find the best topic outputs
     # Ultimately found LDA did not work well for finding intelligib topics
+    # Trains online across 3 worker processes, returns doc-topic array
     lda_docs = \
     LDA_topic_words(article_clean,stop_words_to_use,min_df=0.01,max_df=.9,ngram_range=(1,2)
-    ,num_topics=5, passes = 100, alpha = 'auto', iterations = 5000)
+    ,num_topics=5, passes = 100, alpha = 'symmetric', iterations = 5000, workers=3, as_array=True)
     
     # Find most likely topic for each document
-    max_topics = []
-    for doc in lda_docs:
-        max_topic =  max(doc,key=lambda item:item[1])[0]
-        max_topics.append(max_topic)
+    max_topics = lda_docs.argmax(axis=1)
     
-    article_topics = pd.read_pickle("pickles/article_noNaNs.p").reset_index()
+    article_topics = drop_duplicates(load_shards("pickles/shards/articles", ["decade"]), duplicates)
     article_topics["max_topic"] = pd.Series(max_topics)
     article_topics.max_topic.value_counts()
     
@@ -194,45 +958,53 @@ if __name__ == __main__:
     
     # Note: This is an iterative process and can be used to test multiple
     # parameters to find the best topic outputs
+    # sweep_topic_models fits a grid of them in parallel to compare side by side
+    sweep = sweep_topic_models(article_clean, stop_words_to_use,
+                               {"model": ["nmf"], "n_topics": list(range(5, 15)),
+                                "min_df": [0.01], "max_df": [.9], "ngram_range": [(1,1), (1,2)]})
+    sweep.sort_values("coherence", ascending=False)
+    
     # The model shown below is the iteration that found the best topics,
     # in my qualitative, subjective opinion 
-    doc_topic, topic_word = NMF_topic_words(article_clean, stop_words_to_use
-                        ,n_topics= 9, min_df=0.01, max_df=.9, ngram_range = (1,2))
+    doc_topic, top_words = NMF_topic_words(article_clean, stop_words_to_use
+                        ,n_topics= 9, min_df=0.01, max_df=.9, ngram_range = (1,2)
+                        ,model_path="pickles/topic_model.p")
     
     # Save for word_cloud creation
-    topic_word.to_pickle("pickles/topic_words.p")
-    
-    # Create Output For Tableau Modeling
-    doc_topic['Max'] = doc_topic.idxmax(axis=1)
+    save_top_words("pickles/topic_words.p", top_words)
     
-    summary = pd.read_pickle("pickles/article_noNaNs.p").reset_index()
-    summary["topic"] = doc_topic['Max']
+    # Save doc-topic matrix, new weeks are appended with update_topic_model
+    append_doc_topic("pickles/doc_topic.f32", doc_topic, overwrite=True)
     
+    # Create Output For Tableau Modeling
+    # only year and decade are read from the article shards
+    summary = drop_duplicates(load_shards("pickles/shards/articles", ["year", "decade"]), duplicates)
+    summary["topic"] = doc_topic.argmax(axis=1)
     summary["year"] = summary["year"].astype(int)
-    summary["year_bin"] = summary["year"].apply(find_bins,low_end=1960,high_end=2020,width=5)
-    chart = summary.groupby(['year','topic']).size().unstack(fill_value=0) # quick view of distribution
     
-    tableau = summary.loc[summary['year']>1969,["year","year_bin","decade","topic"]]
-    topic_dict = {0:"Love/Relationships",1:"Marriage",2:"Religion",3:"Military"
-                  ,4:"Politics",5:"Parade/March/Crime",6:"HIV/AIDS",7:"Gender Identity"
-                  ,8:"Boy Scouts"}
-    tableau["topic_name"] = tableau["topic"].apply(lambda x: topic_dict[x])    
+    tableau = tableau_rows(summary, doc_topic)
     tableau.to_csv("csv/tableau_topics.csv")
     
-    #Sentiment Analysis
-    sent_df = pd.read_pickle("pickles/sentiment.p").reset_index()
+    # New weeks of articles from scraper.py / preprocessing.py can then be
+    # added without refitting, e.g.
+    # update_topic_model(new_week, update_iter=5)
     
+    #Sentiment Analysis
+    sent_df = drop_duplicates(load_shards("pickles/shards/sentiment", ["article_text"]), duplicates)
     sent_df = sentiment_analysis(sent_df)
-    sent_df.reset_index(inplace=True)
-    sent_df["year"] = summary["year"]
-    sent_df["decade"] = summary["decade"]
-    sent_df["year_bin"] = summary["year_bin"]
-    sent_df["topic"] = summary["topic"]
-    
-    pol_year = sent_df.groupby(['year']).Polarity.mean()
-    pol_year_bin = sent_df.groupby(['year_bin']).Polarity.mean()
-    pol_decade = sent_df.groupby(['decade']).Polarity.mean()
-    pol_topic = sent_df.groupby(['topic']).Polarity.mean()
+    sent_df["topic"] = summary["topic"].values
+    
+    # Aggregate year x topic counts and sentiment once, every other view
+    # (decade, 5 year bins, topic, Tableau) is rolled up from the cube
+    cube = topic_year_cube(summary["year"], summary["topic"], sent_df["Polarity"], sent_df["Subjectivity"])
+    cube.to_pickle("pickles/topic_cube.p")
+    tableau_from_cube(cube).to_csv("csv/tableau_topic_cube.csv", index=False)
+    
+    chart = cube.pivot(index="year", columns="topic", values="count").fillna(0) # quick view of distribution
+    pol_year = rollup_cube(cube, ["year"]).set_index("year").polarity_mean
+    pol_year_bin = rollup_cube(cube, ["year_bin"]).set_index("year_bin").polarity_mean
+    pol_decade = rollup_cube(cube, ["decade"]).set_index("decade").polarity_mean
+    pol_topic = rollup_cube(cube, ["topic"]).set_index("topic").polarity_mean
     
     plt.hist(sent_df[sent_df.topic == 0].Polarity,bins=20,range=[-.5, .5]);
     plt.hist(sent_df[sent_df.topic != 0].Polarity,bins=20,range=[-.5, .5]);
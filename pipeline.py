@@ -0,0 +1,611 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs the project as one DAG of stages, instead of running scraper.py,
+preprocessing.py, dedup.py, modeling.py and word_cloud.py in turn and
+handing off through pickles by hand
+
+Each stage declares the artifacts it reads and writes. Its key is a hash
+of its stage function's code, the source of the project modules it uses
+(so editing e.g. preprocessing.clean_text re-runs preprocess onward),
+parameters and the content of its inputs. Stages whose key
+and outputs match the manifest are skipped, so changing a stop word only
+re-runs vectorize onward, and a stage that re-runs to identical output
+doesn't re-run the stages after it. Stages with no path between them
+(e.g. sentiment and nmf) run at the same time
+
+e.g. python pipeline.py                 run everything that is out of date
+     python pipeline.py word_clouds     only what word_clouds needs
+     python pipeline.py --force nmf     re-run nmf and everything after it
+
+@author: markfunke
+"""
+
+import os
+import sys
+import ast
+import json
+import pickle
+import hashlib
+import inspect
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from sklearn.decomposition import NMF
+
+import crawl_store
+import corpus_format
+import instrumentation
+from http_cache import ResponseCache
+from scraper import crawl, week_dates
+from preprocessing import LemmaCache, iter_article_shards, preprocess_shards, load_shards
+from modeling import (TOPIC_STOP_WORDS, build_stop_words, vectorize_corpus, save_topic_model, top_topic_words,
+                      print_top_words, save_top_words, append_doc_topic, load_doc_topic, sentiment_analysis,
+                      tableau_rows, topic_year_cube, tableau_from_cube)
+from dedup import find_duplicates, load_duplicates, drop_duplicates
+from word_cloud import TOPIC_CLOUDS, render_word_clouds, title_cloud_dict, gradient_cloud
+
+# Artifact types: whether each is a file or a directory, and how to load it
+ARTIFACT_TYPES = {
+    "sqlite": "file",    # crawl store, see crawl_store.py
+    "csv": "file",
+    "pickle": "file",
+    "f32": "file",       # raw float32 matrix, see modeling.append_doc_topic
+    "arrow": "file",     # Arrow file, see corpus_format
+    "image": "file",
+    "font": "file",
+    "shards": "dir",     # numbered Arrow files, see preprocessing.load_shards
+    "tfidf": "dir",      # doc_word.npz, vocab.npy and vectorizer.p
+    "images": "dir",
+}
+
+class Artifact:
+    """
+    A file or directory passed between stages
+
+    Parameters
+    ----------
+    name : string
+        name stages refer to it by
+    path : string
+        location on disk
+    kind : string
+        type from ARTIFACT_TYPES
+
+    """
+    def __init__(self, name, path, kind):
+        if kind not in ARTIFACT_TYPES:
+            raise ValueError(f"unknown artifact type {kind!r} for {name}")
+        self.name, self.path, self.kind = name, path, kind
+
+    @property
+    def is_dir(self):
+        return ARTIFACT_TYPES[self.kind] == "dir"
+
+    def exists(self):
+        return os.path.isdir(self.path) if self.is_dir else os.path.isfile(self.path)
+
+    def load(self):
+        """
+        Reads the artifact, for looking at results interactively
+        """
+        if self.kind == "sqlite":
+            return crawl_store.open_store(self.path)
+        if self.kind == "csv":
+            return pd.read_csv(self.path)
+        if self.kind == "pickle":
+            with open(self.path, "rb") as f:
+                return pickle.load(f)
+        if self.kind == "shards":
+            return load_shards(self.path)
+        if self.kind == "tfidf":
+            return load_tfidf(self.path)
+        if self.kind == "arrow":
+            return corpus_format.read_frame(self.path)
+        if self.kind == "f32":
+            return np.fromfile(self.path, dtype=np.float32)
+        return self.path
+
+class Stage:
+    """
+    One step of the pipeline
+
+    Parameters
+    ----------
+    name : string
+    func : function
+        called as func(inputs, outputs, **params, **settings), with inputs
+        and outputs as dictionaries of artifact name -> path
+    inputs, outputs : list
+        artifact names
+    params : dictionary
+        parameters that change the output, part of the stage key
+    settings : dictionary
+        parameters that don't change the output (api key, workers, cache
+        directories), passed to func but not hashed
+
+    """
+    def __init__(self, name, func, inputs, outputs, params=None, settings=None):
+        self.name, self.func = name, func
+        self.inputs, self.outputs = list(inputs), list(outputs)
+        self.params, self.settings = params or {}, settings or {}
+
+def file_digest(path, stat_cache):
+    # sha256 of a file, reused from stat_cache while size and mtime are unchanged
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    cached = stat_cache.get(key)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    stat_cache[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return digest.hexdigest()
+
+def path_digest(path, stat_cache):
+    """
+    Content hash of a file, or of every file under a directory by relative path
+    """
+    if not os.path.isdir(path):
+        return file_digest(path, stat_cache)
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            digest.update(os.path.relpath(full, path).encode() + b"\0")
+            digest.update(file_digest(full, stat_cache).encode())
+    return digest.hexdigest()
+
+def code_names(code):
+    # global names used by compiled code and the functions nested in it
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= code_names(const)
+    return names
+
+def imported_names(path):
+    """
+    Returns dictionary of each name a module imports -> module it is imported from
+    """
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    names = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                names[alias.asname or alias.name] = alias.name
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            for alias in node.names:
+                names[alias.asname or alias.name] = node.module
+    return names
+
+def stage_code(func):
+    """
+    Finds the code a stage's output depends on: the stage function, the
+    functions of its own module it calls, and the project modules (.py files
+    beside it) it imports names from, with the project modules those import
+
+    Returns
+    -------
+    sources : list
+        source of the stage function and its helpers
+    modules : list
+        paths of the project modules, sorted
+
+    """
+    path = inspect.getsourcefile(func)
+    project_dir = os.path.dirname(os.path.abspath(path))
+    imports = imported_names(path)
+
+    def project_module(module):
+        module_path = os.path.join(project_dir, module.split(".")[0] + ".py")
+        return module_path if os.path.isfile(module_path) else None
+
+    sources, modules = [], set()
+    todo, seen = [func], {func}
+    while todo:
+        f = todo.pop()
+        sources.append(inspect.getsource(f))
+        for name in sorted(code_names(f.__code__)):
+            obj = f.__globals__.get(name)
+            if name in imports:
+                if project_module(imports[name]):
+                    modules.add(project_module(imports[name]))
+            elif inspect.isfunction(obj) and obj.__module__ == func.__module__ and obj not in seen:
+                seen.add(obj)
+                todo.append(obj)
+    todo = list(modules)
+    while todo:
+        for module in imported_names(todo.pop()).values():
+            module_path = project_module(module)
+            if module_path and module_path not in modules:
+                modules.add(module_path)
+                todo.append(module_path)
+    return sources, sorted(modules)
+
+class Pipeline:
+    """
+    Runs stages in dependency order, skipping those that are up to date
+
+    Parameters
+    ----------
+    stages : list
+        Stage objects, each output artifact made by exactly one stage
+    artifacts : list
+        Artifact objects. Artifacts no stage makes are sources (e.g. csv/stopwords.csv)
+    manifest_path : string
+        json file recording each stage's key and output hashes
+
+    """
+    def __init__(self, stages, artifacts, manifest_path="pickles/pipeline_manifest.json"):
+        self.stages = {stage.name: stage for stage in stages}
+        self.artifacts = {artifact.name: artifact for artifact in artifacts}
+        self.manifest_path = manifest_path
+        self.producer = {}
+        for stage in stages:
+            for name in stage.inputs + stage.outputs:
+                if name not in self.artifacts:
+                    raise ValueError(f"stage {stage.name} uses undeclared artifact {name}")
+            for name in stage.outputs:
+                if name in self.producer:
+                    raise ValueError(f"{name} is made by both {self.producer[name]} and {stage.name}")
+                self.producer[name] = stage.name
+        self.lock = threading.Lock()
+        self.manifest = {"stages": {}, "files": {}}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def upstream(self, name):
+        """
+        Returns names of the stages stage name reads from directly
+        """
+        return {self.producer[a] for a in self.stages[name].inputs if a in self.producer}
+
+    def needed(self, targets):
+        """
+        Returns names of the target stages and every stage they depend on
+        """
+        needed, todo = set(), list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in self.stages:
+                raise KeyError(f"unknown stage {name}")
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.upstream(name))
+        return needed
+
+    def _save_manifest(self):
+        # caller holds the lock
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.manifest_path)
+
+    def _digest(self, path):
+        stat_cache = self.manifest["files"]
+        with self.lock:
+            stat_cache = dict(stat_cache)
+        digest = path_digest(path, stat_cache)
+        with self.lock:
+            self.manifest["files"].update(stat_cache)
+        return digest
+
+    def stage_key(self, stage, input_digests):
+        """
+        Hash of a stage's code, the project modules it uses (see stage_code),
+        parameters and input content
+        """
+        sources, modules = stage_code(stage.func)
+        spec = {"stage": stage.name, "code": sources, "params": stage.params,
+                "modules": {os.path.basename(path): self._digest(path) for path in modules},
+                "inputs": {name: input_digests[name] for name in stage.inputs}}
+        return hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _up_to_date(self, stage, key):
+        record = self.manifest["stages"].get(stage.name)
+        if record is None or record["key"] != key:
+            return False
+        for name in stage.outputs:
+            artifact = self.artifacts[name]
+            if not artifact.exists() or self._digest(artifact.path) != record["outputs"].get(name):
+                return False
+        return True
+
+    def _run_stage(self, stage, digests, force):
+        # runs in a pool thread. Returns "ran" or "skipped"
+        missing = [name for name in stage.inputs if not self.artifacts[name].exists()]
+        if missing:
+            raise FileNotFoundError(f"{stage.name} needs {', '.join(missing)}, which don't exist")
+        for name in stage.inputs:
+            if name not in digests:
+                digests[name] = self._digest(self.artifacts[name].path)
+        key = self.stage_key(stage, digests)
+        if stage.name not in force and self._up_to_date(stage, key):
+            status = "skipped"
+        else:
+            with self.lock:
+                print(f"running {stage.name}")
+            for name in stage.outputs:
+                parent = os.path.dirname(self.artifacts[name].path)
+                os.makedirs(parent or ".", exist_ok=True)
+            with instrumentation.timed(f"pipeline.{stage.name}"):
+                stage.func({name: self.artifacts[name].path for name in stage.inputs},
+                           {name: self.artifacts[name].path for name in stage.outputs},
+                           **stage.params, **stage.settings)
+            for name in stage.outputs:
+                if not self.artifacts[name].exists():
+                    raise FileNotFoundError(f"{stage.name} did not write {name} ({self.artifacts[name].path})")
+            status = "ran"
+        outputs = {name: self._digest(self.artifacts[name].path) for name in stage.outputs}
+        with self.lock:
+            digests.update(outputs)
+            self.manifest["stages"][stage.name] = {"key": key, "outputs": outputs}
+            self._save_manifest()
+        return status
+
+    def run(self, targets=None, force=(), max_workers=4):
+        """
+        Runs every out of date stage needed for targets, independent stages
+        in parallel threads (stages do their heavy work in numpy, sklearn
+        or their own process pools)
+
+        Parameters
+        ----------
+        targets : list
+            stage names, default is every stage
+        force : list
+            stage names to re-run even if up to date. Stages after them
+            re-run if their output changed
+        max_workers : int
+            maximum stages running at once
+
+        Returns
+        -------
+        status : dictionary
+            stage name -> "ran" or "skipped"
+
+        """
+        needed = self.needed(targets or list(self.stages))
+        force = set(force)
+        digests, status, failed = {}, {}, None
+        waiting = set(needed)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while waiting or running:
+                if failed is None:
+                    ready = [name for name in waiting if not (self.upstream(name) & (waiting | set(running.values())))]
+                    for name in sorted(ready):
+                        waiting.discard(name)
+                        running[executor.submit(self._run_stage, self.stages[name], digests, force)] = name
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        status[name] = future.result()
+                        print(f"{name}: {status[name]}")
+                    except Exception as e:
+                        print(f"{name}: failed, {e!r}")
+                        failed = failed or e
+        if failed is not None:
+            raise failed
+        return status
+
+    def load(self, name):
+        """
+        Loads an artifact by name, see Artifact.load
+        """
+        return self.artifacts[name].load()
+
+# Stage functions. Each reads its inputs and writes its outputs by path,
+# calling the functions in the project's modules
+
+def stage_crawl(inputs, outputs, start, periods, api_key=None, cache_dir="cache/http", offline=False,
+                requests_per_minute=10, per_host=4, requests_per_second=5):
+    crawl(outputs["crawl_db"], api_key, week_dates(start, periods), cache=ResponseCache(cache_dir),
+          offline=offline, requests_per_minute=requests_per_minute, per_host=per_host,
+          requests_per_second=requests_per_second)
+
+def stage_preprocess(inputs, outputs, shard_size, n_jobs=None, lemma_cache_path="pickles/lemma_cache.p"):
+    out_dir = os.path.dirname(outputs["article_shards"])
+    expected = {os.path.join(out_dir, d) for d in ("articles", "sentiment", "cleaned")}
+    if {outputs["article_shards"], outputs["sentiment_shards"], outputs["lemmatized_shards"]} != expected:
+        raise ValueError(f"preprocess writes {out_dir}/articles, sentiment and cleaned")
+    lemma_cache = LemmaCache.load(lemma_cache_path)
+    preprocess_shards(iter_article_shards(inputs["crawl_db"], shard_size=shard_size), out_dir,
+                      n_jobs=n_jobs, lemma_cache=lemma_cache)
+    lemma_cache.save(lemma_cache_path)
+
+def stage_dedup(inputs, outputs, threshold, shingle_size, num_perm, bands, n_jobs=None):
+    shard_dir = os.path.dirname(inputs["sentiment_shards"])
+    find_duplicates(shard_dir, outputs["duplicates"], threshold=threshold, shingle_size=shingle_size,
+                    num_perm=num_perm, bands=bands, n_jobs=n_jobs)
+
+def stage_stop_words(inputs, outputs, extra_words):
+    with open(outputs["stop_words"], "wb") as f:
+        pickle.dump(sorted(build_stop_words(inputs["stop_words_csv"], extra_words)), f)
+
+def load_tfidf(path):
+    """
+    Reads the doc_word matrix, vocab and vectorizer written by stage_vectorize
+    """
+    with open(os.path.join(path, "vectorizer.p"), "rb") as f:
+        cv = pickle.load(f)
+    return (scipy.sparse.load_npz(os.path.join(path, "doc_word.npz")),
+            np.load(os.path.join(path, "vocab.npy"), allow_pickle=True), cv)
+
+def stage_vectorize(inputs, outputs, min_df, max_df, ngram_range):
+    with open(inputs["stop_words"], "rb") as f:
+        stop_words = pickle.load(f)
+    texts = drop_duplicates(load_shards(inputs["lemmatized_shards"], ["article_text"]),
+                            load_duplicates(inputs["duplicates"]))["article_text"]
+    doc_word, vocab, cv = vectorize_corpus(texts, stop_words, min_df=min_df, max_df=max_df,
+                                           ngram_range=tuple(ngram_range), cache_dir=None)
+    path = outputs["tfidf"]
+    os.makedirs(path, exist_ok=True)
+    scipy.sparse.save_npz(os.path.join(path, "doc_word.npz"), doc_word, compressed=False)
+    np.save(os.path.join(path, "vocab.npy"), vocab)
+    with open(os.path.join(path, "vectorizer.p"), "wb") as f:
+        pickle.dump(cv, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def stage_nmf(inputs, outputs, n_topics, random_state):
+    doc_word, vocab, cv = load_tfidf(inputs["tfidf"])
+    nmf_model = NMF(n_topics, random_state=random_state)
+    with instrumentation.timed("nmf_fit", items=doc_word.shape[0]):
+        doc_topic = nmf_model.fit_transform(doc_word)
+    save_topic_model(outputs["topic_model"], cv, nmf_model, doc_word, doc_topic)
+    top_words = top_topic_words(nmf_model.components_, vocab)
+    print_top_words(top_words)
+    save_top_words(outputs["topic_words"], top_words)
+    append_doc_topic(outputs["doc_topic"], doc_topic, overwrite=True)
+
+def stage_sentiment(inputs, outputs, lexicon, n_jobs=None):
+    sent_df = drop_duplicates(load_shards(inputs["sentiment_shards"], ["_id", "article_text"]),
+                              load_duplicates(inputs["duplicates"]))
+    sent_df = sentiment_analysis(sent_df, n_jobs=n_jobs, lexicon=lexicon)
+    sent_df[["_id", "Polarity", "Subjectivity"]].to_pickle(outputs["sentiment"])
+
+def stage_summarize(inputs, outputs, n_topics):
+    summary = drop_duplicates(load_shards(inputs["article_shards"], ["year", "decade"]),
+                              load_duplicates(inputs["duplicates"]))
+    doc_topic = load_doc_topic(inputs["doc_topic"], n_topics)
+    summary["topic"] = doc_topic.argmax(axis=1)
+    summary["year"] = summary["year"].astype(int)
+    tableau_rows(summary, doc_topic).to_csv(outputs["tableau_topics"])
+
+    sent_df = pd.read_pickle(inputs["sentiment"])
+    cube = topic_year_cube(summary["year"], summary["topic"], sent_df["Polarity"], sent_df["Subjectivity"])
+    cube.to_pickle(outputs["topic_cube"])
+    tableau_from_cube(cube).to_csv(outputs["tableau_topic_cube"], index=False)
+
+def stage_word_clouds(inputs, outputs, num_words, n_jobs=None):
+    with open(inputs["topic_words"], "rb") as f:
+        top_words = pickle.load(f)
+    render_word_clouds(top_words, [(topic, name, inputs["cloud_mask"]) for topic, name in TOPIC_CLOUDS],
+                       inputs["font"], out_dir=outputs["word_clouds"], num_words=num_words, n_jobs=n_jobs)
+
+def stage_title_cloud(inputs, outputs, gradient_orientation):
+    with open(inputs["topic_words"], "rb") as f:
+        top_words = pickle.load(f)
+    gradient_cloud(title_cloud_dict(top_words), inputs["cloud_mask"], inputs["font"], gradient_orientation,
+                   outputs["title_cloud"])
+
+# Every artifact of the project
+ARTIFACTS = [
+    Artifact("crawl_db", "pickles/crawl.db", "sqlite"),
+    Artifact("article_shards", "pickles/shards/articles", "shards"),
+    Artifact("sentiment_shards", "pickles/shards/sentiment", "shards"),
+    Artifact("lemmatized_shards", "pickles/shards/cleaned", "shards"),
+    Artifact("duplicates", "pickles/duplicates.arrow", "arrow"),
+    Artifact("stop_words_csv", "csv/stopwords.csv", "csv"),
+    Artifact("stop_words", "pickles/stop_words.p", "pickle"),
+    Artifact("tfidf", "pickles/tfidf", "tfidf"),
+    Artifact("topic_model", "pickles/topic_model.p", "pickle"),
+    Artifact("topic_words", "pickles/topic_words.p", "pickle"),
+    Artifact("doc_topic", "pickles/doc_topic.f32", "f32"),
+    Artifact("sentiment", "pickles/sentiment.p", "pickle"),
+    Artifact("topic_cube", "pickles/topic_cube.p", "pickle"),
+    Artifact("tableau_topics", "csv/tableau_topics.csv", "csv"),
+    Artifact("tableau_topic_cube", "csv/tableau_topic_cube.csv", "csv"),
+    Artifact("cloud_mask", "images/rainbow.jpg", "image"),
+    Artifact("font", "font/AmaticSC-Bold.ttf", "font"),
+    Artifact("word_clouds", "images/word_clouds", "images"),
+    Artifact("title_cloud", "images/flag_title.png", "image"),
+]
+
+# Parameters of the final analysis, as in the __main__ blocks of each script
+DEFAULT_PARAMS = {
+    "crawl": {"start": "1/1/1960", "periods": 3162},
+    "preprocess": {"shard_size": 2000},
+    "dedup": {"threshold": 0.8, "shingle_size": 5, "num_perm": 128, "bands": 16},
+    "stop_words": {"extra_words": TOPIC_STOP_WORDS},
+    "vectorize": {"min_df": 0.01, "max_df": .9, "ngram_range": [1, 2]},
+    "nmf": {"n_topics": 9, "random_state": 0},
+    "sentiment": {"lexicon": False},
+    "summarize": {"n_topics": 9},
+    "word_clouds": {"num_words": 40},
+    "title_cloud": {"gradient_orientation": "horizontal"},
+}
+
+def project_pipeline(params=None, api_key=None, offline=False, n_jobs=None,
+                     manifest_path="pickles/pipeline_manifest.json", requests_per_minute=10,
+                     per_host=4, requests_per_second=5):
+    """
+    Builds the project's pipeline
+
+    Parameters
+    ----------
+    params : dictionary
+        stage name -> parameters, default is DEFAULT_PARAMS
+    api_key : str
+        NYT api key for the crawl stage
+    offline : bool
+        crawl only from the response cache, see scraper.cached_get
+    n_jobs : int
+        worker processes for preprocess, sentiment and word_clouds
+    manifest_path : string
+        see Pipeline
+    requests_per_minute, per_host, requests_per_second :
+        crawl rate limits, see scraper.crawl. Like api_key and offline they
+        are settings, so changing them doesn't re-run the crawl
+
+    Returns
+    -------
+    Pipeline
+
+    """
+    params = params or DEFAULT_PARAMS
+    stages = [
+        Stage("crawl", stage_crawl, [], ["crawl_db"], params["crawl"],
+              {"api_key": api_key, "offline": offline, "requests_per_minute": requests_per_minute,
+               "per_host": per_host, "requests_per_second": requests_per_second}),
+        Stage("preprocess", stage_preprocess, ["crawl_db"],
+              ["article_shards", "sentiment_shards", "lemmatized_shards"], params["preprocess"], {"n_jobs": n_jobs}),
+        Stage("dedup", stage_dedup, ["sentiment_shards"], ["duplicates"], params["dedup"], {"n_jobs": n_jobs}),
+        Stage("stop_words", stage_stop_words, ["stop_words_csv"], ["stop_words"], params["stop_words"]),
+        Stage("vectorize", stage_vectorize, ["lemmatized_shards", "duplicates", "stop_words"], ["tfidf"],
+              params["vectorize"]),
+        Stage("nmf", stage_nmf, ["tfidf"], ["topic_model", "topic_words", "doc_topic"], params["nmf"]),
+        Stage("sentiment", stage_sentiment, ["sentiment_shards", "duplicates"], ["sentiment"], params["sentiment"],
+              {"n_jobs": n_jobs}),
+        Stage("summarize", stage_summarize, ["article_shards", "duplicates", "doc_topic", "sentiment"],
+              ["topic_cube", "tableau_topics", "tableau_topic_cube"], params["summarize"]),
+        Stage("word_clouds", stage_word_clouds, ["topic_words", "cloud_mask", "font"], ["word_clouds"],
+              params["word_clouds"], {"n_jobs": n_jobs}),
+        Stage("title_cloud", stage_title_cloud, ["topic_words", "cloud_mask", "font"], ["title_cloud"],
+              params["title_cloud"]),
+    ]
+    return Pipeline(stages, ARTIFACTS, manifest_path)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("targets", nargs="*", help="stages to bring up to date, default is all")
+    parser.add_argument("--force", nargs="*", default=[], help="stages to re-run even if up to date")
+    parser.add_argument("--workers", type=int, default=4, help="stages running at once")
+    parser.add_argument("--n-jobs", type=int, help="processes used inside a stage")
+    parser.add_argument("--offline", action="store_true")
+    parser.add_argument("--requests-per-minute", type=float, default=10, help="NYT API request budget")
+    parser.add_argument("--per-host", type=int, default=4, help="article requests in flight per host")
+    parser.add_argument("--requests-per-second", type=float, default=5, help="article request rate per host")
+    args = parser.parse_args()
+
+    # API Key for article_search API on New York Times
+    pipeline = project_pipeline(api_key=os.environ.get("NYT_API_KEY", "YOUR_API_KEY_HERE"),
+                                offline=args.offline, n_jobs=args.n_jobs,
+                                requests_per_minute=args.requests_per_minute, per_host=args.per_host,
+                                requests_per_second=args.requests_per_second)
+    status = pipeline.run(args.targets or None, force=args.force, max_workers=args.workers)
+    print(json.dumps(status))
+    sys.exit()
@@ -7,15 +7,47 @@ Set of NLP logic that cleans, lemmatizes, and tokenizes dataframe of text
 """
 
 import pandas as pd
-import numpy as np
+import pyarrow as pa
 import re
+import json
 import string
+import os
+import glob
+import pickle
+import crawl_store
+import corpus_format
+import instrumentation
 from nltk.tokenize import word_tokenize
 from nltk.stem import WordNetLemmatizer
-from nltk import pos_tag
-from nltk.corpus import wordnet as wn
+from nltk.tag import PerceptronTagger
+from nltk.corpus.reader.wordnet import NOUN, ADJ, VERB, ADV
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
+# NYT articles use curved versions of " and ', adding to punctiation list
+PUNCTUATION = string.punctuation + "“" + "‘" + "’" + "”"
+
+# Lemmatize all of Noun, Adjective, Verb, Adverb
+# Maps first letter of the Penn Treebank POS tag to the WordNet POS
+# (constants imported from the reader so WordNet isn't loaded at import)
+TAG_MAP = defaultdict(lambda : NOUN)
+TAG_MAP['J'] = ADJ
+TAG_MAP['V'] = VERB
+TAG_MAP['R'] = ADV
+
+# Tagger, lemmatizer and lemma cache, loaded once per process by load_nlp_models
+_tagger = None
+_lemmatizer = None
+_lemma_cache = None
+
+# Article types kept for NLP, drops outliers like corrections, obituaries, lists etc.
+INCLUDED_TYPES = ["News", "Letter", "Op-Ed", "Editorial","Brief", "Archives"]
+
+# Compiled once for clean_texts
+PUNCTUATION_PATTERN = re.compile('[%s]'%re.escape(PUNCTUATION))
+DIGIT_RUN = re.compile(r'\d\w*')
+
+@instrumentation.stage("clean_text")
 def clean_text(text):
     '''
     Removes punctuation, digits, and upper case from string of text
@@ -47,43 +79,380 @@ def clean_text(text):
     clean = re.sub('\w*\d\w*', ' ', clean)
     return clean
 
-if __name__ == __main__:
+def remove_digit_tokens(text):
+    '''
+    Replaces every word containing a digit with a space, same output as the
+    digit regex in clean_text. That regex retries from every character of
+    every word, so instead jump to each digit and walk back to the start
+    of its word
+
+    Parameters
+    ----------
+    text : string
+        string of text data
+
+    Returns
+    -------
+    clean : string
+        text without digit tokens
+
+    '''
+    pieces = []
+    end = 0
+    for match in DIGIT_RUN.finditer(text):
+        start = match.start()
+        # same characters as \w: letters, numbers and underscore
+        while start > end and (text[start-1].isalnum() or text[start-1] == '_'):
+            start -= 1
+        pieces.append(text[end:start])
+        pieces.append(' ')
+        end = match.end()
+    if not pieces:
+        return text
+    pieces.append(text[end:])
+    return ''.join(pieces)
+
+@instrumentation.stage("clean_texts", items=instrumentation.count_items)
+def clean_texts(texts):
+    '''
+    Batch version of clean_text, gives the same output for every document.
+    Patterns are compiled once at import rather than on every call
+
+    Parameters
+    ----------
+    texts : Series or iterable
+        documents of text data
+
+    Returns
+    -------
+    clean : Series or list
+        cleaned documents, a Series with the same index if given a Series
+
+    '''
+    remove_punctuation = PUNCTUATION_PATTERN.sub
+    clean = [remove_digit_tokens(remove_punctuation(' ', text).lower().replace("h i v", "hivaids"))
+             for text in texts]
+    if isinstance(texts, pd.Series):
+        return pd.Series(clean, index=texts.index, name=texts.name)
+    return clean
+
+class LemmaCache:
+    '''
+    Bounded memo of WordNet lemmas keyed by (word, WordNet POS).
+    The corpus has millions of tokens but only tens of thousands of distinct
+    (word, POS) pairs, so almost every lookup skips WordNet. Can be saved
+    to disk and reused across runs and worker processes.
+
+    Parameters
+    ----------
+    max_size : int
+        maximum pairs kept, the oldest are dropped past this. default is 1 million
+
+    '''
+    def __init__(self, max_size=1000000):
+        self.max_size = max_size
+        self.lemmas = {}
+        self.new = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, word, pos, lemmatize):
+        '''
+        Returns lemma of word, calling lemmatize(word, pos) only on a miss
+        '''
+        key = (word, pos)
+        lemma = self.lemmas.get(key)
+        if lemma is not None:
+            self.hits += 1
+            return lemma
+        self.misses += 1
+        lemma = lemmatize(word, pos)
+        self.add(key, lemma)
+        self.new[key] = lemma
+        return lemma
+
+    def add(self, key, lemma):
+        if len(self.lemmas) >= self.max_size:
+            del self.lemmas[next(iter(self.lemmas))] # dicts keep insertion order, drop oldest
+        self.lemmas[key] = lemma
+
+    def take_new(self):
+        '''
+        Returns pairs looked up since the last call, used to send a worker's
+        new lemmas back to the parent process
+        '''
+        new, self.new = self.new, {}
+        return new
+
+    def merge(self, lemmas, hits=0, misses=0):
+        '''
+        Adds lemmas and hit/miss counts from another cache (e.g. a worker's)
+        '''
+        for key, lemma in lemmas.items():
+            if key not in self.lemmas:
+                self.add(key, lemma)
+        self.hits += hits
+        self.misses += misses
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        '''
+        Returns dictionary of size, hits, misses and hit_rate
+        '''
+        return {"size": len(self.lemmas), "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hit_rate, 4)}
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self.lemmas, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path, max_size=1000000):
+        '''
+        Loads cache saved with save, or an empty cache if path doesn't exist
+        '''
+        cache = cls(max_size)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                cache.merge(pickle.load(f))
+        return cache
+
+def load_nlp_models(lemmas=None):
+    '''
+    Loads the NLTK POS tagger and WordNet lemmatizer for this process.
+    Used as the process pool initializer so each worker loads them once
+
+    Parameters
+    ----------
+    lemmas : dictionary
+        (word, POS) -> lemma pairs to seed this process's lemma cache
+    '''
+    global _tagger, _lemmatizer, _lemma_cache
+    if _tagger is None:
+        _tagger = PerceptronTagger()
+        _lemmatizer = WordNetLemmatizer()
+        _lemmatizer.lemmatize("loading", NOUN) # WordNet loads lazily, force it now
+        _lemma_cache = LemmaCache()
+    if lemmas:
+        _lemma_cache.merge(lemmas)
+
+def lemmatize_text(text, lemma_cache=None):
+    '''
+    Tokenizes, POS tags, and lemmatizes a cleaned document
+
+    Parameters
+    ----------
+    text : string
+        document cleaned with clean_text
+    lemma_cache : LemmaCache
+        cache of lemmas, default is this process's cache
+
+    Returns
+    -------
+    lemmatized : string
+        lemmas joined by spaces
+
+    '''
+    load_nlp_models()
+    lookup = (lemma_cache or _lemma_cache).lookup
+    lemmatize = _lemmatizer.lemmatize
+    return ' '.join([lookup(word, TAG_MAP[tag[0]], lemmatize) for word, tag in _tagger.tag(word_tokenize(text))])
+
+def lemmatize_chunk(texts):
+    '''
+    Lemmatizes a list of documents, the unit of work sent to each process
+
+    Returns
+    -------
+    (lemmatized, new_lemmas, hits, misses)
+        documents, plus the worker's new lemmas and cache counts for the chunk
+
+    '''
+    hits, misses = _lemma_cache.hits, _lemma_cache.misses
+    lemmatized = [lemmatize_text(text) for text in texts]
+    return (lemmatized, _lemma_cache.take_new(),
+            _lemma_cache.hits - hits, _lemma_cache.misses - misses)
+
+def lemmatize_documents(texts, n_jobs=None, chunksize=100, lemma_cache=None, executor=None):
+    '''
+    Tokenizes, POS tags, and lemmatizes documents across a pool of processes.
+    Documents are sent to workers in chunks, and results come back in the
+    same order as the input
+
+    Parameters
+    ----------
+    texts : Series or iterable
+        documents cleaned with clean_text
+    n_jobs : int
+        number of worker processes, default is one per core.
+        1 runs in this process without a pool
+    chunksize : int
+        number of documents sent to a worker at a time
+    lemma_cache : LemmaCache
+        shared lemma cache. Workers start from its lemmas, and their new
+        lemmas and hit/miss counts are merged back into it as chunks finish
+    executor : ProcessPoolExecutor
+        existing pool to reuse across calls, e.g. one per shard. Must have
+        been created with load_nlp_models as its initializer
+
+    Returns
+    -------
+    lemmatized : Series or list
+        lemmatized documents, a Series with the same index if given a Series
+
+    '''
+    lemma_cache = lemma_cache if lemma_cache is not None else LemmaCache()
+    if executor is None and n_jobs != 1:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=load_nlp_models,
+                                 initargs=(lemma_cache.lemmas,)) as executor:
+            return lemmatize_documents(texts, chunksize=chunksize, lemma_cache=lemma_cache, executor=executor)
+    
+    docs = list(texts)
+    chunks = [docs[i:i + chunksize] for i in range(0, len(docs), chunksize)]
+    lemmatized = []
+    hits, misses = lemma_cache.hits, lemma_cache.misses
+    with instrumentation.timed("lemmatize", items=len(docs)):
+        if executor is not None:
+            for chunk, new_lemmas, chunk_hits, chunk_misses in executor.map(lemmatize_chunk, chunks):
+                lemmatized.extend(chunk)
+                lemma_cache.merge(new_lemmas, chunk_hits, chunk_misses)
+        else:
+            for chunk in chunks:
+                lemmatized.extend([lemmatize_text(text, lemma_cache) for text in chunk])
+        instrumentation.add(hits=lemma_cache.hits - hits, misses=lemma_cache.misses - misses)
+    if isinstance(texts, pd.Series):
+        return pd.Series(lemmatized, index=texts.index, name=texts.name)
+    return lemmatized
+
+def iter_article_shards(store_path, shard_size=2000):
+    '''
+    Reads articles with scraped text from the crawl store, shard_size rows
+    at a time, so the whole corpus is never in memory at once
+
+    Parameters
+    ----------
+    store_path : string
+        path of crawl store written by scraper.py
+    shard_size : int
+        number of articles per shard
+
+    Yields
+    -------
+    shard : DataFrame
+        article metadata plus "year", "decade" and "article_text" columns,
+        "locations" and "subjects" as lists
+
+    '''
+    conn = crawl_store.open_store(store_path)
+    query = '''SELECT a._id, a.date, a.headline, a.section_name, a.news_desk, a.type_of_material,
+                      a.word_count, a.web_url, a.locations, a.subjects, t.article_text
+               FROM articles a JOIN article_text t ON a._id = t._id
+               ORDER BY a.date, a._id'''
+    for shard in pd.read_sql_query(query, conn, chunksize=shard_size):
+        shard["word_count"] = pd.to_numeric(shard["word_count"], errors="coerce")
+        for c in crawl_store.LIST_COLUMNS:
+            shard[c] = [json.loads(x) for x in shard[c]]
+        shard["year"] = shard["date"].str[0:4]
+        shard["decade"] = (shard["year"].str[0:3] + "0").astype(int)
+        yield shard
+
+def shard_path(shard_dir, n):
+    return os.path.join(shard_dir, f"part-{n:05d}.arrow")
+
+def shard_paths(shard_dir):
+    return sorted(glob.glob(os.path.join(shard_dir, "part-*.arrow")))
+
+def read_shards(shard_dir, columns=None):
+    '''
+    Yields each shard DataFrame in shard_dir in order, optionally only
+    columns. Other columns are never read from disk, see corpus_format
+    '''
+    for path in shard_paths(shard_dir):
+        yield corpus_format.read_frame(path, columns)
+
+def load_shards(shard_dir, columns=None):
+    '''
+    Concatenates every shard in shard_dir into one DataFrame, for stages
+    that need the whole corpus at once (e.g. fitting a topic model).
+    Shards are joined as memory mapped Arrow tables and converted once, e.g.
+    load_shards("pickles/shards/articles", ["year", "decade"])
+    '''
+    tables = [corpus_format.read_table(path, columns) for path in shard_paths(shard_dir)]
+    return corpus_format.to_frame(pa.concat_tables(tables))
+
+def preprocess_shards(shards, out_dir, n_jobs=None, lemma_cache=None):
+    '''
+    Filters, cleans, and lemmatizes one shard at a time, writing each output
+    shard before reading the next, so peak memory depends on the shard size
+    rather than the corpus size. Writes three sets of shards with matching rows:
+        out_dir/articles  : article metadata
+        out_dir/sentiment : "_id" and cleaned "article_text", for sentiment analysis
+        out_dir/cleaned   : "_id" and lemmatized "article_text", for topic modeling
+
+    Parameters
+    ----------
+    shards : iterable
+        DataFrames with article metadata and "article_text", e.g. iter_article_shards
+    out_dir : string
+        directory to write output shards, any old shards are removed first
+    n_jobs : int
+        number of lemmatizer processes, default is one per core
+    lemma_cache : LemmaCache
+        lemma cache shared by every shard, see lemmatize_documents
+
+    Returns
+    -------
+    n_articles : int
+        number of articles written
+
+    '''
+    lemma_cache = lemma_cache if lemma_cache is not None else LemmaCache()
+    stages = ["articles", "sentiment", "cleaned"]
+    for stage in stages:
+        os.makedirs(os.path.join(out_dir, stage), exist_ok=True)
+        # includes pickle shards written before the Arrow format
+        for path in glob.glob(os.path.join(out_dir, stage, "part-*")):
+            os.remove(path)
     
-    article_df = pd.read_pickle("pickles/article_text.p")
+    n_articles = 0
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=load_nlp_models,
+                             initargs=(lemma_cache.lemmas,)) as executor:
+        for n, shard in enumerate(shards):
+            # Drop rows where we were not able to scrape the article text,
+            # and outlier article types
+            shard = shard[(shard.article_text.fillna("") != "") & shard.type_of_material.isin(INCLUDED_TYPES)]
+            shard = shard.reset_index(drop=True)
+            
+            article_clean = shard[["_id"]].copy()
+            article_clean["article_text"] = clean_texts(shard["article_text"])
+            corpus_format.write_frame(shard_path(os.path.join(out_dir, "articles"), n), shard.drop(columns="article_text"))
+            corpus_format.write_frame(shard_path(os.path.join(out_dir, "sentiment"), n), article_clean)
+            
+            article_clean["article_text"] = lemmatize_documents(article_clean["article_text"],
+                                                                lemma_cache=lemma_cache, executor=executor)
+            corpus_format.write_frame(shard_path(os.path.join(out_dir, "cleaned"), n), article_clean)
+            n_articles += len(shard)
+    return n_articles
+
+if __name__ == "__main__":
     
-    # Drop rows where we were not able to scrape the article text
+    # Articles are read from the crawl store and processed in fixed-size
+    # shards, so memory use doesn't grow with the corpus
+    # Drops rows where we were not able to scrape the article text
     # This appears to happen often for very old articles where this is only a 
     # photo of the newspaper, or blog posts. About 5% in total.
-    article_df.replace("", np.NaN, inplace=True)
-    article_df.dropna(subset = ["article_text"], inplace=True)
-    article_df.to_pickle("article_noNaNs.p")
-    
-    # Remove outlier article types like corrections, obituaries, lists etc.
-    included_types = ["News", "Letter", "Op-Ed", "Editorial","Brief", "Archives"]
-    mask = article_df.type_of_material.isin(included_types)
-    article_df = article_df[mask]
-    article_df.type_of_material.value_counts()
-    article_df.decade.value_counts()
-    
-    # Limit to just article_text to move forward with NLP
-    article_clean = article_df[["article_text"]]
-    
-    article_clean["article_text"] = article_clean["article_text"].apply(clean_text)
-    article_clean.to_pickle("pickles/sentiment.p") # save file before lemmatize for sentiment
-    
-    #Tokenize
-    article_clean["article_text"] = article_clean["article_text"].apply(word_tokenize)
-    
-    # Lemmatize all of Noun, Adjective, Verb, Adverb
-    lemmatizer = WordNetLemmatizer()
-    
-    tag_map = defaultdict(lambda : wn.NOUN)
-    tag_map['J'] = wn.ADJ
-    tag_map['V'] = wn.VERB
-    tag_map['R'] = wn.ADV
-    
-    article_clean['article_text'] = article_clean['article_text'].apply(
-        lambda x: [lemmatizer.lemmatize(word, tag_map[tag[0]]) for word, tag in pos_tag(x)])
-    article_clean['article_text'] = [' '.join(map(str, word)) for word in article_clean['article_text']]
+    # Also removes outlier article types like corrections, obituaries, lists etc.
+    shards = iter_article_shards("pickles/crawl.db", shard_size=2000)
     
-    article_clean.to_pickle("cleaned_df.p")
+    # Clean, then tokenize, POS tag, and lemmatize all of Noun, Adjective, Verb, Adverb
+    # Cleaned text is saved before lemmatizing for sentiment analysis
+    # Lemmatizing runs across all cores, each worker loads the tagger and WordNet once
+    # Lemmas are cached on disk, so re-runs barely touch WordNet
+    lemma_cache = LemmaCache.load("pickles/lemma_cache.p")
+    n_articles = preprocess_shards(shards, "pickles/shards", lemma_cache=lemma_cache)
+    print(f"preprocessed {n_articles} articles", lemma_cache.stats())
+    lemma_cache.save("pickles/lemma_cache.p")
@@ -8,7 +8,6 @@ Creates a dataframe with API and Article Text
 """
 
 import pandas as pd
-from bs4 import BeautifulSoup
 from selenium import webdriver
 import requests
 import numpy as np
@@ -16,8 +15,154 @@ import re
 import time
 import os
 import datetime
+import math
+import random
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import json
+import crawl_store
+import corpus_format
+import instrumentation
+from extractors import extract_article_text
+from http_cache import ResponseCache, CacheMiss
+from crawl_store import CATEGORICAL_COLUMNS
 
-def nyt_lgbtq_api(begin_date, end_date, api_key):
+# NYT Article Search API endpoint and the subject filter for LGBTQ articles
+API_URL = "https://api.nytimes.com/svc/search/v2/articlesearch.json"
+LGBTQ_FQ = "subject%3A(%22homosexuality%22%2C%22homosexuality%20and%20bisexuality%22%2C%22same-sex%20marriages%2C%20civil%20unions%20and%20domestic%20partnerships%22%2C%22transgender%20and%20transsexuals%22)"
+
+# API returns 10 docs per page, and will not serve pages past 100
+PAGE_SIZE = 10
+MAX_PAGE = 100
+
+# Fields copied as-is from each Article Search doc
+ITEMS_TO_PARSE = ['_id','abstract','lead_paragraph','snippet','section_name','word_count','type_of_material','news_desk','web_url']
+
+# Status codes worth retrying: rate limited or a server side error
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter. Each request takes one token,
+    tokens refill continuously at "rate" per second up to "capacity".
+    
+    Parameters
+    ----------
+    rate : float
+        tokens added per second (e.g. 10/60 for 10 requests per minute)
+    capacity : int
+        maximum tokens that can be saved up for a burst
+        default is 1, which spaces requests evenly
+
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        
+    def acquire(self):
+        """
+        Blocks until a token is available, then takes it
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def get_with_retry(url, session=None, limiter=None, max_retries=5, backoff=2, headers=None, timeout=30):
+    """
+    GET request that waits on a rate limiter before every attempt and
+    retries with exponential backoff on connection errors, 429 and 5xx
+    
+    Parameters
+    ----------
+    url : str
+        url to request
+    session : requests.Session
+        session to reuse connections, default is a new connection per call
+    limiter : TokenBucket
+        rate limiter shared between threads, default is no limit
+    max_retries : int
+        number of retries before giving up, default is 5
+    backoff : float
+        seconds to wait before first retry, doubles every retry
+        a Retry-After header from the server takes priority
+    headers : dict
+        request headers
+    timeout : float
+        seconds to wait on the server before retrying
+
+    Returns
+    -------
+    requests.Response
+        successful response, raises requests.HTTPError otherwise
+
+    """
+    session = session or requests
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            response = session.get(url, headers=headers, timeout=timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == max_retries:
+                raise
+            wait = backoff * 2 ** attempt
+        else:
+            if response.status_code not in RETRY_STATUS or attempt == max_retries:
+                response.raise_for_status()
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            wait = float(retry_after) if retry_after.isdigit() else backoff * 2 ** attempt
+        time.sleep(wait + random.uniform(0, 1))  # jitter so threads don't retry in lockstep
+
+def cached_get(url, cache=None, offline=False, **kwargs):
+    """
+    Returns response body for url, served from cache when possible
+    
+    Parameters
+    ----------
+    url : str
+        url to request
+    cache : ResponseCache
+        cache to read from and fill, default is no caching
+    offline : bool
+        if True, never touch the network and raise CacheMiss for
+        urls not in the cache
+    **kwargs : passed through to get_with_retry
+
+    Returns
+    -------
+    bytes
+        response body
+
+    """
+    if cache is not None:
+        body = cache.get(url)
+        instrumentation.add(hits=body is not None, misses=body is None)
+        if body is not None:
+            return body
+    if offline:
+        raise CacheMiss(url)
+    body = get_with_retry(url, **kwargs).content
+    instrumentation.add(nbytes=len(body))
+    if cache is not None:
+        cache.put(url, body)
+    return body
+
+@instrumentation.stage("nyt_lgbtq_api", items=lambda articles, *args, **kwargs: len(articles['response']['docs']))
+def nyt_lgbtq_api(begin_date, end_date, api_key, page=0, base_url=API_URL,
+                  session=None, limiter=None, max_retries=5, cache=None, offline=False):
     """
     Pulls .json output for date range 
     from NYT Article Search API, specific to the LGBTQ topic
@@ -30,21 +175,103 @@ def nyt_lgbtq_api(begin_date, end_date, api_key):
         10 digit string of higher end of date range to access (YYYYMMDD)
     api_key : str
         api key from NYT, approved to access Article Search API
+    page : int
+        page of results to return, 10 articles per page. default is 0
+    base_url : str
+        Article Search endpoint, can point at a local stub server for testing
+    session, limiter, max_retries : see get_with_retry
+    cache, offline : see cached_get
 
     Returns
     -------
     .json
-        json output of all articles in that date range
+        json output of one page of articles in that date range
 
     """
-    requestUrl = f"https://api.nytimes.com/svc/search/v2/articlesearch.json?begin_date={begin_date}&end_date={end_date}&fq=subject%3A(%22homosexuality%22%2C%22homosexuality%20and%20bisexuality%22%2C%22same-sex%20marriages%2C%20civil%20unions%20and%20domestic%20partnerships%22%2C%22transgender%20and%20transsexuals%22)&api-key={api_key}"
+    requestUrl = f"{base_url}?begin_date={begin_date}&end_date={end_date}&fq={LGBTQ_FQ}&page={page}&api-key={api_key}"
     requestHeaders = {
       "Accept": "application/json"
     }
     
-    request = requests.get(requestUrl, headers=requestHeaders)
+    body = cached_get(requestUrl, cache=cache, offline=offline, session=session,
+                      limiter=limiter, max_retries=max_retries, headers=requestHeaders)
+    
+    return json.loads(body)
+
+def nyt_lgbtq_api_pages(begin_date, end_date, api_key, **kwargs):
+    """
+    Pulls every page of results for a date range from NYT Article Search API
+    
+    Parameters
+    ----------
+    begin_date, end_date, api_key : see nyt_lgbtq_api
+    **kwargs : passed through to nyt_lgbtq_api
+
+    Returns
+    -------
+    responses : list
+        json output of each page, in page order
+
+    """
+    first = nyt_lgbtq_api(begin_date, end_date, api_key, page=0, **kwargs)
+    hits = first['response']['meta']['hits']
+    n_pages = math.ceil(hits / PAGE_SIZE)
+    if n_pages > MAX_PAGE + 1:
+        print(f"warning: {begin_date}-{end_date} has {hits} hits, "
+              f"API only serves the first {(MAX_PAGE + 1) * PAGE_SIZE}. Use a smaller date range.")
+        n_pages = MAX_PAGE + 1
+    
+    responses = [first]
+    for page in range(1, n_pages):
+        responses.append(nyt_lgbtq_api(begin_date, end_date, api_key, page=page, **kwargs))
+    return responses
+
+def fetch_weeks(dates, api_key, requests_per_minute=10, workers=4, **kwargs):
+    """
+    Pulls every page of every date range from NYT Article Search API
+    using a pool of threads that share one rate limiter, so requests go out
+    as fast as the quota allows rather than on a fixed sleep
     
-    return request.json()
+    Parameters
+    ----------
+    dates : iterable
+        (begin_date, end_date) tuples, see nyt_lgbtq_api
+    api_key : str
+        api key from NYT, approved to access Article Search API
+    requests_per_minute : float
+        request budget shared by all threads, NYT allows 10 per minute
+    workers : int
+        number of threads making requests
+    **kwargs : passed through to nyt_lgbtq_api
+
+    Yields
+    -------
+    (begin_date, end_date, responses)
+        responses is the list of json pages for that date range,
+        yielded in order of completion. Date ranges that still fail after
+        retries are printed and skipped.
+
+    """
+    limiter = TokenBucket(requests_per_minute / 60)
+    local = threading.local()
+    
+    def fetch(date):
+        # one keep-alive session per thread
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return nyt_lgbtq_api_pages(date[0], date[1], api_key,
+                                   session=local.session, limiter=limiter, **kwargs)
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch, date): date for date in dates}
+        for future in as_completed(futures):
+            begin_date, end_date = futures[future]
+            try:
+                responses = future.result()
+            except (requests.exceptions.RequestException, CacheMiss) as e:
+                print(f"failed {begin_date}-{end_date}: {e}")
+                continue
+            yield begin_date, end_date, responses
 
 def parse_api(articles):
     """
@@ -61,7 +288,7 @@ def parse_api(articles):
         key for each article, values shown in "items_to_parse"
 
     """
-    items_to_parse = ['_id','abstract','lead_paragraph','snippet','section_name','word_count','type_of_material','news_desk','web_url']
+    items_to_parse = ITEMS_TO_PARSE
     news = []
     for i in articles['response']['docs']:
         dic = {}
@@ -90,7 +317,58 @@ def parse_api(articles):
         news.append(dic)
     return news
 
-def scrape_article_text(web_url):
+def parse_api_columns(responses):
+    """
+    Parses many json outputs from NYT Article Search API in one pass,
+    straight into column lists rather than a dictionary per article.
+    Keywords are scanned once per article for both locations and subjects.
+
+    Parameters
+    ----------
+    responses : iterable
+        json outputs from Article Search API (e.g. every page of a week)
+
+    Returns
+    -------
+    columns : dictionary
+        column name -> list of values, same columns as parse_api.
+        CATEGORICAL_COLUMNS are returned as pd.Categorical
+
+    """
+    columns = {item: [] for item in ITEMS_TO_PARSE + ['headline','date','locations','subjects']}
+    appends = [(item, columns[item].append) for item in ITEMS_TO_PARSE]
+    add_headline = columns['headline'].append
+    add_date = columns['date'].append
+    add_locations = columns['locations'].append
+    add_subjects = columns['subjects'].append
+    
+    for articles in responses:
+        for doc in articles['response']['docs']:
+            get = doc.get
+            for item, append in appends:
+                append(get(item, ""))
+            add_headline(doc['headline']['main'])
+            add_date(doc['pub_date'][0:10]) # just want year/mo/day, not time
+            
+            # single pass over keywords for both locations and subjects
+            locations = []
+            subjects = []
+            for keyword in doc['keywords']:
+                name = keyword['name']
+                if 'glocations' in name:
+                    locations.append(keyword['value'])
+                if 'subject' in name:
+                    subjects.append(keyword['value'])
+            add_locations(locations)
+            add_subjects(subjects)
+    
+    # low cardinality columns stored as codes into a small set of categories
+    for item in CATEGORICAL_COLUMNS:
+        columns[item] = pd.Categorical(columns[item])
+    return columns
+
+@instrumentation.stage("scrape_article_text")
+def scrape_article_text(web_url, session=None, limiter=None, cache=None, offline=False):
     """
     Scrapes article body text for a given New York Times url
 
@@ -98,59 +376,188 @@ def scrape_article_text(web_url):
     ----------
     web_url : string
         URL pointing to New York Times article page
+    session : requests.Session
+        session to reuse a keep-alive connection, default is a new connection
+    limiter : TokenBucket
+        rate limiter for the article's host, default is no limit
+    cache, offline : see cached_get
 
     Returns
     -------
     article_text : string
-        Article body text
+        Article body text, None if the page couldn't be fetched
 
     """
     try:
         url = web_url
     
-        response = requests.get(url)
-               
-        page = response.text
-        soup = BeautifulSoup(page, "lxml")
-        
-        # find all paragraphs in article, and store as one block of text
-        article_text = ' '.join([p.text for p in soup.find_all("p", {'class':'css-158dogj evys1bk0'})])
-    except:
-        article_text = ""
+        page = cached_get(url, cache=cache, offline=offline, session=session,
+                          limiter=limiter, max_retries=2)
+    except requests.exceptions.RequestException:
+        # timeouts, resets and errors left after retrying. None rather than ""
+        # so the article isn't stored and is retried on the next run
+        return None
+    
+    # find all paragraphs in article, and store as one block of text
+    # tries selectors for each NYT page template in turn, see extractors.py
+    article_text = extract_article_text(page)
     
     return article_text
 
+def scrape_articles(articles, per_host=4, requests_per_second=5, **kwargs):
+    """
+    Scrapes article body text for many urls with a pool of threads.
+    Each thread keeps its own keep-alive session, and every host gets its
+    own concurrency cap and rate limit
+    
+    Parameters
+    ----------
+    articles : iterable
+        (_id, web_url) tuples
+    per_host : int
+        maximum requests in flight to any one host
+    requests_per_second : float
+        maximum request rate to any one host
+    **kwargs : passed through to scrape_article_text (cache, offline)
+
+    Yields
+    -------
+    (_id, article_text)
+        in order of completion, so results can be written out as they arrive.
+        article_text is None for pages that couldn't be fetched, or offline
+        that aren't in the cache
 
-if __name__ == __main__:
+    """
+    articles = list(articles)
+    hosts = {urlparse(url).netloc for _id, url in articles}
+    slots = {host: threading.BoundedSemaphore(per_host) for host in hosts}
+    limiters = {host: TokenBucket(requests_per_second) for host in hosts}
+    local = threading.local()
     
-    # API Key for article_search API on New York Times
-    api_key = "YOUR_API_KEY_HERE"
+    def scrape(url):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=len(hosts), pool_maxsize=per_host)
+            local.session.mount("http://", adapter)
+            local.session.mount("https://", adapter)
+        host = urlparse(url).netloc
+        with slots[host]:
+            try:
+                return scrape_article_text(url, session=local.session, limiter=limiters[host], **kwargs)
+            except CacheMiss:
+                # offline and the response was never cached or was evicted,
+                # skipped like a failed fetch so stored text is kept
+                return None
     
-    # Create list of every week from 1960 to 2020
-    # This is used as an input into the NYT API
-    dates = pd.DataFrame(pd.date_range(start='1/1/1960', periods=3162, freq='W'),columns=["date_begin"])
+    with ThreadPoolExecutor(max_workers=max(1, per_host * len(hosts))) as executor:
+        futures = {executor.submit(scrape, url): _id for _id, url in articles}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def week_dates(start='1/1/1960', periods=3162):
+    """
+    Returns tuple of (begin_date, end_date) YYYYMMDD ints for every week
+    from start, used as the date ranges for the NYT API
+    """
+    dates = pd.DataFrame(pd.date_range(start=start, periods=periods, freq='W'),columns=["date_begin"])
     dates["date_end"] = dates.date_begin + datetime.timedelta(days=6)
     date_begin = [int(str(x.year)+str(x.month).zfill(2)+str(x.day).zfill(2)) for x in dates.date_begin]
     date_end = [int(str(x.year)+str(x.month).zfill(2)+str(x.day).zfill(2)) for x in dates.date_end]
-    dates = tuple(zip(date_begin,date_end))
+    return tuple(zip(date_begin,date_end))
+
+def crawl(store_path, api_key, dates, cache=None, offline=False,
+          requests_per_minute=10, per_host=4, requests_per_second=5):
+    """
+    Pulls every week of articles from the NYT API and scrapes their text
+    into the crawl store. Weeks and articles already in the store are
+    skipped, so a crashed run can be restarted
     
-    # Parse article data from 1960 to 2020 from NYT Article Search API
+    Parameters
+    ----------
+    store_path : string
+        path of crawl store, see crawl_store.open_store
+    api_key : str
+        api key from NYT, approved to access Article Search API
+    dates : iterable
+        (begin_date, end_date) tuples, e.g. week_dates()
+    cache, offline : see cached_get. offline re-parses everything from the
+        response cache without touching the network
+    requests_per_minute : float
+        NYT API request budget, see fetch_weeks
+    per_host, requests_per_second : see scrape_articles
+
+    Returns
+    -------
+    None.
+
+    """
+    # NYT API allows 10 requests per minute, fetch_weeks keeps to the budget
+    # across threads and pages through weeks with more than 10 articles
+    # Each week is saved to the crawl store as soon as it is parsed
+    store = crawl_store.open_store(store_path)
+    done = set() if offline else crawl_store.completed_windows(store)
+    dates = [date for date in dates if date not in done]
     i = 0
-    article_df_all = pd.DataFrame()
-    for date in dates:
-        begin_date = date[0]
-        end_date = date[1]
+    for begin_date, end_date, responses in fetch_weeks(dates, api_key, requests_per_minute=requests_per_minute,
+                                                         cache=cache, offline=offline):
         print(f"scraping {i} / {len(dates)}")
-        articles = nyt_lgbtq_api(begin_date, end_date, api_key)
-        time.sleep(6) #NYT API allows 10 requests per minute (1 every 6 seconds)
-        article_dic = parse_api(articles)
-        article_df =  pd.DataFrame(article_dic)
-        article_df_all = pd.concat([article_df,article_df_all],axis=0)
+        crawl_store.save_week(store, begin_date, end_date, parse_api_columns(responses))
+        i += 1
+    
+    # Scrape actual article text for every url in the store
+    # Each result is saved to the crawl store as it completes, failed
+    # fetches aren't saved so they are retried when the crawl is restarted
+    articles = crawl_store.load_articles(store)
+    done = set() if offline else crawl_store.scraped_ids(store)
+    to_scrape = [(_id, url) for _id, url in zip(articles._id, articles.web_url) if _id not in done]
+    i = failed = 0
+    for _id, article_text in scrape_articles(to_scrape, per_host=per_host,
+                                                  requests_per_second=requests_per_second,
+                                                  cache=cache, offline=offline):
+        if article_text is None:
+            failed += 1
+        else:
+            crawl_store.save_article_text(store, _id, article_text)
         i += 1
+        print(f"scraping article {i} / {len(to_scrape)}")
+    if failed and offline:
+        print(f"{failed} articles aren't in the response cache, their stored text is unchanged")
+    elif failed:
+        print(f"{failed} articles couldn't be fetched, rerun to retry them")
+    
+    # fold the write-ahead log into the database file before closing
+    store.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    store.close()
+
+if __name__ == "__main__":
+    
+    # --offline re-parses everything from the response cache without
+    # touching the network, e.g. after changing parse_api or the paragraph selector
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--offline", action="store_true")
+    parser.add_argument("--cache-dir", default="cache/http")
+    parser.add_argument("--cache-gb", type=float, default=2)
+    parser.add_argument("--requests-per-minute", type=float, default=10)
+    parser.add_argument("--per-host", type=int, default=4)
+    parser.add_argument("--requests-per-second", type=float, default=5)
+    args = parser.parse_args()
+    cache = ResponseCache(args.cache_dir, max_bytes=int(args.cache_gb * 1024 ** 3))
+    
+    # API Key for article_search API on New York Times
+    api_key = "YOUR_API_KEY_HERE"
+    
+    # Parse article data from 1960 to 2020 from NYT Article Search API,
+    # one date range per week, then scrape the text of every article
+    crawl("pickles/crawl.db", api_key, week_dates(), cache=cache, offline=args.offline,
+          requests_per_minute=args.requests_per_minute, per_host=args.per_host,
+          requests_per_second=args.requests_per_second)
        
-    # Save pickle as checkpoint after API runs
-    article_df_all.to_pickle("pickles/articles.p").
-    article_df = pd.read_pickle("pickles/articles.p")
+    # Save checkpoint after API runs, see corpus_format
+    store = crawl_store.open_store("pickles/crawl.db")
+    article_df_all = crawl_store.load_articles(store)
+    corpus_format.write_frame("pickles/articles.arrow", article_df_all)
+    article_df = corpus_format.read_frame("pickles/articles.arrow")
     
     # Create year, decade, and word_count columns
     article_df["year"] = article_df["date"].apply(lambda x: x[0:4])
@@ -158,20 +565,7 @@ if __name__ == __main__:
     article_df["abstract_word_count"] = article_df["abstract"].apply(lambda x: len(x))
     article_df["lead_word_count"] = article_df["lead_paragraph"].apply(lambda x: len(x))
     
-    # Scrape actual article text for every url in dataframe
+    # Save final dataframe with article text for use in rest of analysis
     article_df_scrape = article_df.reset_index()
-    article_text = []
-    i = 0
-    for url in article_df_scrape.web_url:
-        article_text.append(scrape_article_text(url))
-        i += 1
-        print(f"scraping article {i}")
-        if i % 100 == 0:
-            time.sleep(10) # sleep 10 seconds every 100 articles
-        else:
-            time.sleep(0.5) # sleep half second every other time
-    
-    # Save final dataframe with article text for use in rest of analysis        
-    article_df_scrape.to_pickle("pickles/article_text.p")   
-
-
+    article_df_scrape = article_df_scrape.merge(crawl_store.load_article_text(store), on="_id", how="left")
+    corpus_format.write_frame("pickles/article_text.arrow", article_df_scrape)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic NYT-like corpus for benchmarks.py
+Generates Article Search json and article html that look like the real
+crawl (topic words, punctuation, digits, keywords, page templates), at any
+scale, without the API or the network. Every document is generated from
+(seed, index), so the same corpus can be rebuilt in any process
+
+@author: markfunke
+"""
+
+import json
+import threading
+import datetime
+import numpy as np
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+# Words that mark each of the 9 NMF topics in modeling.TOPIC_DICT
+TOPIC_WORDS = [
+    ["love", "relationship", "partner", "friend", "family", "young", "life", "feel", "happy", "story"],
+    ["marriage", "couple", "wedding", "married", "civil union", "spouse", "license", "ceremony", "legal", "benefit"],
+    ["church", "religious", "bishop", "catholic", "faith", "congregation", "pope", "minister", "sin", "episcopal"],
+    ["military", "soldier", "army", "service", "discharge", "pentagon", "navy", "officer", "ban", "veteran"],
+    ["senator", "bill", "vote", "republican", "democrat", "campaign", "candidate", "president", "law", "governor"],
+    ["parade", "march", "police", "crime", "attack", "victim", "arrest", "street", "crowd", "pride"],
+    ["aid", "hiv", "virus", "patient", "drug", "health", "doctor", "disease", "hospital", "treatment"],
+    ["transgender", "gender", "identity", "bathroom", "woman", "trans", "student", "school", "name", "medical"],
+    ["scout", "boy", "troop", "leader", "membership", "organization", "policy", "youth", "camp", "volunteer"],
+]
+
+# Common words, including the adjectives TextBlob scores, so sentiment and
+# stop word removal have realistic work to do
+COMMON_WORDS = ("the of and to a in is that for it as was with be by on not he she they this are or his her "
+                "from at which but have an had one were all their there been has more if will would who when "
+                "what new said good great bad best worst happy sad terrible important public private old "
+                "difficult clear strong wrong right free open angry proud first last many other same "
+                "different large small long little early late hard easy possible true full real").split()
+
+SECTION_NAMES = ["New York", "U.S.", "World", "Opinion", "Arts", "Style", "Sports", "Health", "Archives"]
+NEWS_DESKS = ["Metropolitan Desk", "National Desk", "Foreign Desk", "Editorial Desk", "Culture", "Styles", ""]
+TYPES_OF_MATERIAL = ["News", "News", "News", "Letter", "Op-Ed", "Editorial", "Brief", "Archives", "Review"]
+LOCATIONS = ["New York City", "California", "Massachusetts", "Texas", "Washington (DC)", "Vermont", "Canada"]
+SUBJECTS = ["Homosexuality and Bisexuality", "Same-Sex Marriage, Civil Unions and Domestic Partnerships",
+            "Transgender and Transsexuals", "Acquired Immune Deficiency Syndrome", "Discrimination"]
+
+# NYT page templates, see extractors.ARTICLE_SELECTORS
+PAGE_TEMPLATES = {
+    "css": '<section name="articleBody">{}</section>',
+    "story-body": '<div class="story-body">{}</div>',
+    "legacy": '<div id="articleBody">{}</div>',
+}
+PARAGRAPH_TAGS = {"css": '<p class="css-158dogj evys1bk0">', "story-body": '<p class="story-body-text story-content">',
+                  "legacy": "<p>"}
+
+FIRST_DATE = datetime.date(1970, 1, 1)
+
+def _vocabulary(size, rng):
+    # made up words from syllables, to give the TF-IDF matrix a long tail
+    syllables = np.array(["ba", "ren", "tor", "li", "mas", "che", "on", "vel", "dri", "ka", "sum", "pe", "ta", "ny"])
+    lengths = rng.integers(2, 5, size)
+    return np.array(COMMON_WORDS + ["".join(rng.choice(syllables, n)) for n in lengths])
+
+def synthetic_vocab(size=5000, seed=0):
+    """
+    Returns array of vocabulary words, common words first then made up ones
+    """
+    return _vocabulary(size, np.random.default_rng(seed))
+
+def _rng(seed, i):
+    return np.random.default_rng([seed, i])
+
+def synthetic_text(i, seed=0, vocab=None, mean_words=600):
+    """
+    Generates the body text of article i
+
+    Parameters
+    ----------
+    i : int
+        article index
+    seed : int
+        corpus seed
+    vocab : array
+        from synthetic_vocab, generated from seed if not given
+    mean_words : int
+        average number of words per article
+
+    Returns
+    -------
+    text : string
+        paragraphs separated by newlines, with punctuation and digits
+
+    """
+    vocab = synthetic_vocab(seed=seed) if vocab is None else vocab
+    rng = _rng(seed, i)
+    n_words = max(20, int(rng.normal(mean_words, mean_words / 3)))
+    topic = TOPIC_WORDS[i % len(TOPIC_WORDS)]
+
+    # zipf distributed common/made up words, with a share of topic words
+    ids = np.minimum(rng.zipf(1.3, n_words) - 1, len(vocab) - 1)
+    words = vocab[ids].astype(object)
+    from_topic = rng.random(n_words) < 0.15
+    words[from_topic] = rng.choice(topic, from_topic.sum())
+    numbers = rng.random(n_words) < 0.01
+    words[numbers] = [f"{n}s" if n > 1900 else str(n) for n in rng.integers(1, 2020, numbers.sum())]
+
+    # sentences of 8-25 words, paragraphs of 3 sentences
+    paragraphs, sentences, start = [], [], 0
+    while start < n_words:
+        end = start + int(rng.integers(8, 26))
+        sentence = " ".join(words[start:end])
+        sentence = sentence[:1].upper() + sentence[1:] + rng.choice([".", ".", ".", "?", "!"])
+        if rng.random() < 0.1:
+            sentence = f"“{sentence}” she said."
+        sentences.append(sentence)
+        if len(sentences) == 3:
+            paragraphs.append(" ".join(sentences))
+            sentences = []
+        start = end
+    if sentences:
+        paragraphs.append(" ".join(sentences))
+    return "\n".join(paragraphs)
+
+def article_date(i, docs_per_week=20):
+    return FIRST_DATE + datetime.timedelta(days=7 * (i // docs_per_week) + i % 7)
+
+def article_url(i, base_url="https://www.nytimes.com", docs_per_week=20):
+    return f"{base_url}/{article_date(i, docs_per_week):%Y/%m/%d}/us/article-{i}.html"
+
+def synthetic_doc(i, seed=0, vocab=None, base_url="https://www.nytimes.com", docs_per_week=20):
+    """
+    Generates the Article Search API doc of article i, with the fields
+    scraper.parse_api reads
+
+    Returns
+    -------
+    doc : dictionary
+
+    """
+    rng = np.random.default_rng([seed, i, 1])
+    headline = synthetic_text(i, seed, vocab, mean_words=10).split("\n")[0]
+    lead = synthetic_text(i, seed, vocab, mean_words=40).split("\n")[0]
+    keywords = ([{"name": "glocations", "value": v} for v in rng.choice(LOCATIONS, rng.integers(0, 3), replace=False)]
+                + [{"name": "subject", "value": v} for v in rng.choice(SUBJECTS, rng.integers(1, 4), replace=False)])
+    return {"_id": f"nyt://article/{seed:04d}-{i:012d}",
+            "abstract": lead[:200], "lead_paragraph": lead, "snippet": lead[:120],
+            "section_name": str(rng.choice(SECTION_NAMES)), "news_desk": str(rng.choice(NEWS_DESKS)),
+            "type_of_material": str(rng.choice(TYPES_OF_MATERIAL)), "word_count": int(rng.integers(100, 2000)),
+            "web_url": article_url(i, base_url, docs_per_week),
+            "headline": {"main": headline, "print_headline": headline},
+            "pub_date": f"{article_date(i, docs_per_week)}T05:00:00+0000",
+            "keywords": keywords}
+
+def api_response(docs, hits):
+    """
+    Wraps docs in the json layout of one Article Search response page
+    """
+    return {"status": "OK", "response": {"docs": docs, "meta": {"hits": hits, "offset": 0, "time": 5}}}
+
+def synthetic_page(i, seed=0, vocab=None, template=None):
+    """
+    Generates html of article i's page. Templates rotate through
+    PAGE_TEMPLATES unless one is given, so every extractor selector is used
+    """
+    template = template or list(PAGE_TEMPLATES)[i % len(PAGE_TEMPLATES)]
+    tag = PARAGRAPH_TAGS[template]
+    body = "".join(f"{tag}{p}</p>" for p in synthetic_text(i, seed, vocab).split("\n"))
+    return ("<!DOCTYPE html><html><head><title>Article</title><script>var x = 1;</script></head><body>"
+            f"<nav><p>Sections</p></nav><article>{PAGE_TEMPLATES[template].format(body)}</article>"
+            "<footer><p>Copyright The New York Times</p></footer></body></html>")
+
+def synthetic_texts(n_docs, seed=0, mean_words=600):
+    """
+    Returns list of the first n_docs article texts of the corpus
+    """
+    vocab = synthetic_vocab(seed=seed)
+    return [synthetic_text(i, seed, vocab, mean_words) for i in range(n_docs)]
+
+def synthetic_articles(start, stop, seed=0, vocab=None, mean_words=600):
+    """
+    Returns DataFrame of articles start to stop with the columns of
+    preprocessing.iter_article_shards, i.e. one shard of the corpus
+    """
+    vocab = synthetic_vocab(seed=seed) if vocab is None else vocab
+    docs = [synthetic_doc(i, seed, vocab) for i in range(start, stop)]
+    keywords = lambda doc, name: [k["value"] for k in doc["keywords"] if k["name"] == name]
+    shard = pd.DataFrame({"_id": [doc["_id"] for doc in docs],
+                          "date": [doc["pub_date"][:10] for doc in docs],
+                          "headline": [doc["headline"]["main"] for doc in docs],
+                          "section_name": [doc["section_name"] for doc in docs],
+                          "news_desk": [doc["news_desk"] for doc in docs],
+                          "type_of_material": [doc["type_of_material"] for doc in docs],
+                          "word_count": [float(doc["word_count"]) for doc in docs],
+                          "web_url": [doc["web_url"] for doc in docs],
+                          "locations": [keywords(doc, "glocations") for doc in docs],
+                          "subjects": [keywords(doc, "subject") for doc in docs],
+                          "article_text": [synthetic_text(i, seed, vocab, mean_words) for i in range(start, stop)]},
+                         dtype=object)
+    shard["word_count"] = shard["word_count"].astype(float)
+    shard["year"] = shard["date"].str[0:4]
+    shard["decade"] = (shard["year"].str[0:3] + "0").astype(int)
+    return shard
+
+def week_windows(n_docs, docs_per_week=20):
+    """
+    Returns (begin_date, end_date) YYYYMMDD windows covering n_docs articles,
+    as scraper.py builds them
+    """
+    n_weeks = -(-n_docs // docs_per_week)
+    return [((FIRST_DATE + datetime.timedelta(days=7 * w)).strftime("%Y%m%d"),
+             (FIRST_DATE + datetime.timedelta(days=7 * w + 6)).strftime("%Y%m%d")) for w in range(n_weeks)]
+
+class StubServer:
+    """
+    Local HTTP server standing in for the NYT Article Search API and
+    article pages. Responses are generated on request, so a corpus of any
+    size takes no memory or disk. Use as a context manager
+
+    Parameters
+    ----------
+    n_docs : int
+        articles in the corpus
+    seed : int
+        corpus seed
+    docs_per_week : int
+        articles in each weekly window, see week_windows
+    page_size : int
+        docs per API page, as scraper.PAGE_SIZE
+    fail_first : int
+        times each path answers fail_status before it succeeds, to exercise
+        retries. default is 0, never fail
+    fail_status : int
+        status code of the failures, e.g. 429 or 503
+    retry_after : str
+        Retry-After header sent with the failures, default is none
+
+    """
+    def __init__(self, n_docs, seed=0, docs_per_week=20, page_size=10, fail_first=0, fail_status=503,
+                 retry_after=None):
+        self.n_docs, self.seed, self.docs_per_week, self.page_size = n_docs, seed, docs_per_week, page_size
+        self.fail_first, self.fail_status, self.retry_after = fail_first, fail_status, retry_after
+        self.vocab = synthetic_vocab(seed=seed)
+        self.weeks = {begin: w for w, (begin, end) in enumerate(week_windows(n_docs, docs_per_week))}
+        self.requests = 0
+        self.failures = {}
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body go out as separate writes, don't let them wait on delayed acks
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests += 1
+                    failed = stub.failures.get(self.path, 0) < stub.fail_first
+                    if failed:
+                        stub.failures[self.path] = stub.failures.get(self.path, 0) + 1
+                if failed:
+                    status, body, content_type = stub.fail_status, "try again", "text/plain"
+                else:
+                    status, body, content_type = stub.respond(self.path)
+                body = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if failed and stub.retry_after is not None:
+                    self.send_header("Retry-After", stub.retry_after)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.api_url = self.base_url + "/svc/search/v2/articlesearch.json"
+
+    def respond(self, path):
+        """
+        Returns (status, body, content type) for a request path
+        """
+        parts = urlsplit(path)
+        if parts.path.endswith("articlesearch.json"):
+            query = parse_qs(parts.query)
+            week = self.weeks.get(query.get("begin_date", [""])[0])
+            if week is None:
+                return 200, json.dumps(api_response([], 0)), "application/json"
+            first = week * self.docs_per_week
+            last = min(first + self.docs_per_week, self.n_docs)
+            start = first + int(query.get("page", ["0"])[0]) * self.page_size
+            docs = [synthetic_doc(i, self.seed, self.vocab, self.base_url, self.docs_per_week)
+                    for i in range(start, min(start + self.page_size, last))]
+            return 200, json.dumps(api_response(docs, last - first)), "application/json"
+        if parts.path.endswith(".html"):
+            i = int(parts.path.rsplit("-", 1)[1][:-len(".html")])
+            if i < self.n_docs:
+                return 200, synthetic_page(i, self.seed, self.vocab), "text/html"
+        return 404, "not found", "text/plain"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
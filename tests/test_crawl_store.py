@@ -0,0 +1,88 @@
+import functools
+
+import pandas as pd
+import pytest
+
+import crawl_store
+import scraper
+from scraper import PAGE_SIZE, fetch_weeks, parse_api_columns
+from synthetic_corpus import StubServer, api_response, synthetic_doc, synthetic_vocab, week_windows
+
+VOCAB = synthetic_vocab()
+
+def week_columns(first, last, base_url="https://www.nytimes.com"):
+    docs = [synthetic_doc(i, vocab=VOCAB, base_url=base_url) for i in range(first, last)]
+    return parse_api_columns(api_response(docs[i:i + PAGE_SIZE], len(docs)) for i in range(0, len(docs), PAGE_SIZE))
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / "crawl.db")
+
+def test_save_week_round_trip(store_path):
+    store = crawl_store.open_store(store_path)
+    crawl_store.save_week(store, 19600103, 19600109, week_columns(0, 20))
+    crawl_store.save_week(store, 19600110, 19600116, week_columns(20, 35))
+    stored = crawl_store.load_articles(store).set_index("_id")
+    expected = pd.DataFrame(week_columns(0, 35)).set_index("_id")
+    assert len(stored) == 35
+    for column in ["headline", "date", "web_url", "word_count", "locations", "subjects"]:
+        assert stored.loc[expected.index, column].tolist() == expected[column].tolist()
+    for column in crawl_store.CATEGORICAL_COLUMNS:
+        assert isinstance(stored[column].dtype, pd.CategoricalDtype)
+        assert stored.loc[expected.index, column].astype(str).tolist() == expected[column].astype(str).tolist()
+
+def test_save_week_replaces_articles(store_path):
+    store = crawl_store.open_store(store_path)
+    crawl_store.save_week(store, 19600103, 19600109, week_columns(0, 20))
+    # re-parsed window, and an article returned for two windows, stored once
+    crawl_store.save_week(store, 19600103, 19600109, week_columns(0, 20))
+    crawl_store.save_week(store, 19600110, 19600116, week_columns(19, 30))
+    assert len(crawl_store.load_articles(store)) == 30
+    assert crawl_store.completed_windows(store) == {(19600103, 19600109), (19600110, 19600116)}
+
+def test_completed_windows_survive_restart(store_path):
+    store = crawl_store.open_store(store_path)
+    crawl_store.save_week(store, 19600103, 19600109, week_columns(0, 20))
+    store.close()
+    store = crawl_store.open_store(store_path)
+    assert crawl_store.completed_windows(store) == {(19600103, 19600109)}
+    assert len(crawl_store.load_articles(store)) == 20
+
+def test_save_article_text_keeps_stored_text(store_path):
+    store = crawl_store.open_store(store_path)
+    crawl_store.save_article_text(store, "a", "first scrape")
+    crawl_store.save_article_text(store, "a", "")
+    crawl_store.save_article_text(store, "b", "")
+    crawl_store.save_article_text(store, "b", "later scrape")
+    crawl_store.save_article_text(store, "c", "first scrape")
+    crawl_store.save_article_text(store, "c", "page changed")
+    stored = dict(crawl_store.load_article_text(store).itertuples(index=False))
+    assert stored == {"a": "first scrape", "b": "later scrape", "c": "page changed"}
+    assert crawl_store.scraped_ids(store) == {"a", "b", "c"}
+
+def test_crawl_resumes(store_path, monkeypatch):
+    dates = [(int(begin), int(end)) for begin, end in week_windows(60)]
+    with StubServer(60) as stub:
+        monkeypatch.setattr(scraper, "fetch_weeks", functools.partial(fetch_weeks, base_url=stub.api_url))
+        # a crawl stopped after the first week, with one article scraped
+        store = crawl_store.open_store(store_path)
+        crawl_store.save_week(store, *dates[0], week_columns(0, 20, stub.base_url))
+        first = crawl_store.load_articles(store).iloc[0]
+        crawl_store.save_article_text(store, first["_id"], "scraped before the restart")
+        store.close()
+
+        scraper.crawl(store_path, "test", dates, requests_per_minute=1e9, requests_per_second=1e9)
+        # two more weeks of 20 articles, two pages each, and 59 article pages
+        assert stub.requests == 2 * 2 + 59
+        store = crawl_store.open_store(store_path)
+        assert crawl_store.completed_windows(store) == set(dates)
+        assert len(crawl_store.load_articles(store)) == 60
+        text = dict(crawl_store.load_article_text(store).itertuples(index=False))
+        assert len(text) == 60 and all(text.values())
+        assert text[first["_id"]] == "scraped before the restart"
+        store.close()
+
+        # nothing left to do
+        stub.requests = 0
+        scraper.crawl(store_path, "test", dates, requests_per_minute=1e9, requests_per_second=1e9)
+        assert stub.requests == 0
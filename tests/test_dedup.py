@@ -0,0 +1,22 @@
+import numpy as np
+
+from dedup import EMPTY, NUM_PERM, lsh_candidates, near_duplicate_clusters
+
+def test_lsh_candidates_empty_corpus():
+    pairs = lsh_candidates(np.empty((0, NUM_PERM), dtype=np.uint32))
+    assert pairs.shape == (0, 2)
+
+def test_lsh_candidates_no_shingles():
+    # every document shorter than a shingle
+    pairs = lsh_candidates(np.full((3, NUM_PERM), EMPTY, dtype=np.uint32))
+    assert pairs.shape == (0, 2)
+
+def test_near_duplicate_clusters_short_documents():
+    assert len(near_duplicate_clusters([], n_jobs=1)) == 0
+    assert list(near_duplicate_clusters(["gay rights", "pride", ""], n_jobs=1)) == [0, 1, 2]
+
+def test_near_duplicate_clusters_finds_copies():
+    story = " ".join(f"word{i}" for i in range(200))
+    other = " ".join(f"other{i}" for i in range(200))
+    clusters = near_duplicate_clusters([story, other, story + " archives", "too short"], n_jobs=1)
+    assert list(clusters) == [0, 1, 0, 3]
@@ -0,0 +1,172 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+from sklearn.decomposition import NMF
+from sklearn.feature_extraction.text import TfidfVectorizer
+from textblob import TextBlob
+from textblob.en import sentiment as lexicon
+
+from modeling import (LEXICON_TOLERANCE, append_doc_topic, bin_years, find_bins, load_doc_topic, load_top_words,
+                      load_topic_model, rollup_cube, save_top_words, save_topic_model, sentiment_lexicon_scores,
+                      tableau_from_cube, tableau_rows, top_topic_words, topic_year_cube, update_topic_model)
+from preprocessing import clean_texts
+from synthetic_corpus import synthetic_texts
+
+N_TOPICS = 5
+
+def articles(texts, first_year):
+    years = [str(first_year + i % 50) for i in range(len(texts))]
+    return pd.DataFrame({"article_text": texts, "year": years, "decade": [int(y[:3] + "0") for y in years]})
+
+@pytest.fixture
+def topic_model(tmp_path):
+    # model fit on the first 300 articles, saved as NMF_topic_words and stage_nmf save it
+    texts = synthetic_texts(400, mean_words=150)
+    old, new = articles(texts[:300], 1960), articles(texts[300:], 1965)
+    cv = TfidfVectorizer(min_df=2)
+    doc_word = cv.fit_transform(old["article_text"])
+    nmf_model = NMF(N_TOPICS, random_state=0, max_iter=500)
+    doc_topic = nmf_model.fit_transform(doc_word)
+    paths = {"model_path": str(tmp_path / "topic_model.p"), "doc_topic_path": str(tmp_path / "doc_topic.f32"),
+             "tableau_path": str(tmp_path / "tableau_topics.csv"), "top_words_path": str(tmp_path / "topic_words.p")}
+    save_topic_model(paths["model_path"], cv, nmf_model, doc_word, doc_topic)
+    append_doc_topic(paths["doc_topic_path"], doc_topic, overwrite=True)
+    tableau_rows(old, doc_topic).to_csv(paths["tableau_path"])
+    save_top_words(paths["top_words_path"], top_topic_words(nmf_model.components_, cv.get_feature_names_out()))
+    return {"old": old, "new": new, "doc_word": doc_word, "doc_topic": doc_topic, "cv": cv,
+            "components": nmf_model.components_.copy(), "paths": paths}
+
+def frobenius(X, W, H):
+    return np.linalg.norm(X.toarray() - W @ H)
+
+def test_update_matches_full_update(topic_model):
+    new_topic = update_topic_model(topic_model["new"], update_iter=50, **topic_model["paths"])
+    components = load_topic_model(topic_model["paths"]["model_path"])["nmf"].components_
+
+    # the running sums give the same multiplicative updates as the concatenated matrices
+    X = scipy.sparse.vstack([topic_model["doc_word"], topic_model["cv"].transform(topic_model["new"]["article_text"])])
+    W = np.vstack([topic_model["doc_topic"], new_topic])
+    expected = topic_model["components"].copy()
+    for _ in range(50):
+        expected *= np.asarray((X.T @ W).T) / np.maximum(W.T @ W @ expected, 1e-10)
+    np.testing.assert_allclose(components, expected, rtol=1e-6, atol=1e-12)
+
+    # and fit the whole corpus better than fixed topics, close to a full refit
+    refit = NMF(N_TOPICS, random_state=0, max_iter=500)
+    refit_topic = refit.fit_transform(X)
+    loss = frobenius(X, W, components)
+    assert loss < frobenius(X, W, topic_model["components"])
+    assert loss < 1.01 * frobenius(X, refit_topic, refit.components_)
+
+def test_update_appends_rows(topic_model):
+    paths = topic_model["paths"]
+    new_topic = update_topic_model(topic_model["new"], **paths)
+
+    doc_topic = load_doc_topic(paths["doc_topic_path"], N_TOPICS)
+    assert doc_topic.shape == (400, N_TOPICS)
+    np.testing.assert_array_equal(doc_topic[:300], topic_model["doc_topic"].astype(np.float32))
+    np.testing.assert_array_equal(doc_topic[300:], new_topic.astype(np.float32))
+
+    # Tableau rows keep their doc-topic row as index, articles before 1970 are left out
+    tableau = pd.read_csv(paths["tableau_path"], index_col=0)
+    new_rows = tableau.loc[tableau.index >= 300]
+    years = topic_model["new"]["year"].astype(int).to_numpy()
+    np.testing.assert_array_equal(new_rows.index, 300 + np.flatnonzero(years > 1969))
+    np.testing.assert_array_equal(new_rows["topic"], doc_topic[new_rows.index].argmax(axis=1))
+    assert len(tableau) == len(new_rows) + (topic_model["old"]["year"].astype(int) > 1969).sum()
+
+def test_update_rewrites_top_words(topic_model):
+    paths = topic_model["paths"]
+    update_topic_model(topic_model["new"], update_iter=20, **paths)
+    model = load_topic_model(paths["model_path"])
+    top_words = load_top_words(paths["top_words_path"])
+    expected = top_topic_words(model["nmf"].components_, topic_model["cv"].get_feature_names_out())
+    for key in ("vocab", "word_ids", "weights"):
+        np.testing.assert_array_equal(top_words[key], expected[key])
+
+def test_fixed_topics_leave_model_alone(topic_model):
+    paths = topic_model["paths"]
+    with open(paths["top_words_path"], "rb") as f:
+        top_words = f.read()
+    update_topic_model(topic_model["new"], **paths)
+    np.testing.assert_array_equal(load_topic_model(paths["model_path"])["nmf"].components_,
+                                  topic_model["components"])
+    with open(paths["top_words_path"], "rb") as f:
+        assert f.read() == top_words
+
+def textblob_scores(texts):
+    return np.array([TextBlob(text).sentiment[:2] for text in texts]).reshape(-1, 2)
+
+def assert_textblob_parity(texts):
+    polarity, subjectivity = sentiment_lexicon_scores(texts, chunksize=97)
+    expected = textblob_scores(texts)
+    np.testing.assert_allclose(polarity, expected[:, 0], rtol=0, atol=LEXICON_TOLERANCE)
+    np.testing.assert_allclose(subjectivity, expected[:, 1], rtol=0, atol=LEXICON_TOLERANCE)
+
+def test_lexicon_matches_textblob_on_cleaned_texts():
+    raw = synthetic_texts(300, mean_words=150) + [
+        "", "!!!", "It isn't good!", "They're not very happy.", "I wouldn't say it's bad",
+        "Not a good day, but really not bad at all.", "very very good", "no really very good"]
+    assert_textblob_parity(clean_texts(raw))
+
+def test_lexicon_matches_textblob_on_modifier_runs():
+    # random runs of intensifiers, negations, scored words and short or unknown words
+    rng = np.random.default_rng(0)
+    known = [w for w in lexicon if " " not in w and w.isalpha()]
+    modifiers = [w for w in known if "RB" in lexicon[w]]
+    pools = [[w for w in modifiers if w.endswith("ly")], [w for w in modifiers if not w.endswith("ly")],
+             [w for w in known if "RB" not in lexicon[w]], ["no", "not", "never"],
+             ["a", "i", "an", "is", "of", "x"], ["the", "house", "city", "people", "which"]]
+    texts = [" ".join(pools[k][rng.integers(len(pools[k]))] for k in rng.integers(0, len(pools), n))
+             for n in rng.integers(0, 40, 2000)]
+    assert_textblob_parity(texts)
+
+def test_lexicon_empty():
+    polarity, subjectivity = sentiment_lexicon_scores([])
+    assert polarity.shape == subjectivity.shape == (0,)
+    np.testing.assert_array_equal(sentiment_lexicon_scores(["the house", ""])[0], [0, 0])
+
+def test_bin_years_matches_find_bins():
+    years = np.arange(1960, 2025)
+    expected = [find_bins(year, low_end=1960, high_end=2020, width=5) for year in years]
+    np.testing.assert_array_equal(bin_years(years, low_end=1960, high_end=2020, width=5), expected)
+    np.testing.assert_array_equal(bin_years(pd.Series(years), 1960, 2020, 10),
+                                  [find_bins(year, 1960, 2020, 10) for year in years])
+    # outside the bins, where find_bins returns None or wraps around
+    assert np.isnan(bin_years([1959, 2025, 2100], 1960, 2020, 5)).all()
+
+@pytest.fixture
+def scored_articles():
+    rng = np.random.default_rng(0)
+    n = 5000
+    return pd.DataFrame({"year": rng.integers(1960, 2021, n), "topic": rng.integers(0, 9, n),
+                         "polarity": rng.uniform(-1, 1, n), "subjectivity": rng.uniform(0, 1, n)})
+
+def grouped(frame, by):
+    # the same aggregates with a pandas groupby over the articles
+    return frame.groupby(by).agg(count=("polarity", "size"), polarity_sum=("polarity", "sum"),
+                                 subjectivity_sum=("subjectivity", "sum"), polarity_mean=("polarity", "mean"),
+                                 subjectivity_mean=("subjectivity", "mean")).reset_index()
+
+def test_topic_year_cube_matches_groupby(scored_articles):
+    # leave a gap year and a missing topic so empty cells are dropped
+    articles = scored_articles[(scored_articles["year"] != 1990) & (scored_articles["topic"] != 4)]
+    cube = topic_year_cube(articles["year"], articles["topic"], articles["polarity"], articles["subjectivity"])
+    pd.testing.assert_frame_equal(cube, grouped(articles, ["year", "topic"]), check_dtype=False)
+
+@pytest.mark.parametrize("by", [["year"], ["decade"], ["year_bin"], ["topic"], ["year_bin", "topic"]])
+def test_rollup_cube_matches_groupby(scored_articles, by):
+    articles = scored_articles.assign(decade=scored_articles["year"] // 10 * 10,
+                                      year_bin=[find_bins(year, 1960, 2020, 5) for year in scored_articles["year"]])
+    cube = topic_year_cube(articles["year"], articles["topic"], articles["polarity"], articles["subjectivity"])
+    pd.testing.assert_frame_equal(rollup_cube(cube, by), grouped(articles, by), check_dtype=False)
+
+def test_empty_cube():
+    empty = pd.Series([], dtype=float)
+    cube = topic_year_cube(empty, empty, empty, empty)
+    assert cube.empty
+    assert list(cube.columns) == ["year", "topic", "count", "polarity_sum", "subjectivity_sum",
+                                  "polarity_mean", "subjectivity_mean"]
+    assert rollup_cube(cube, ["decade"]).empty
+    assert tableau_from_cube(cube).empty
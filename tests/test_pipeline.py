@@ -0,0 +1,91 @@
+import importlib
+import sys
+
+import pytest
+
+from pipeline import Artifact, Pipeline, Stage
+
+HELPER = '''
+def transform(text):
+    return text.lower()
+'''
+
+STAGES = '''
+from pipe_helper import transform
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+def write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+def stage_words(inputs, outputs):
+    write(outputs["words"], transform(read(inputs["source"])))
+
+def stage_upper(inputs, outputs, suffix=""):
+    write(outputs["upper"], read(inputs["words"]).upper() + suffix)
+
+def stage_count(inputs, outputs):
+    write(outputs["count"], str(len(read(inputs["upper"]))))
+
+def stage_lazy(inputs, outputs):
+    pass
+'''
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    # stage functions in a module of their own, beside a project module they import from
+    (tmp_path / "pipe_helper.py").write_text(HELPER)
+    (tmp_path / "pipe_stages.py").write_text(STAGES)
+    (tmp_path / "source.csv").write_text("Pride March")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    for name in ("pipe_helper", "pipe_stages"):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    return tmp_path, importlib.import_module("pipe_stages")
+
+def make_pipeline(project, suffix=""):
+    tmp_path, stages = project
+    artifacts = [Artifact(name, str(tmp_path / f"{name}.csv"), "csv")
+                 for name in ("source", "words", "upper", "count", "lazy")]
+    return Pipeline([Stage("words", stages.stage_words, ["source"], ["words"]),
+                     Stage("upper", stages.stage_upper, ["words"], ["upper"], {"suffix": suffix}),
+                     Stage("count", stages.stage_count, ["upper"], ["count"]),
+                     Stage("lazy", stages.stage_lazy, ["source"], ["lazy"])],
+                    artifacts, str(tmp_path / "manifest.json"))
+
+def test_second_run_skips_everything(project):
+    targets = ["words", "upper", "count"]
+    assert set(make_pipeline(project).run(targets).values()) == {"ran"}
+    assert make_pipeline(project).run(targets) == {"words": "skipped", "upper": "skipped", "count": "skipped"}
+    assert (project[0] / "count.csv").read_text() == "11"
+
+def test_param_change_reruns_downstream_only(project):
+    make_pipeline(project).run(["count"])
+    status = make_pipeline(project, suffix="!").run(["count"])
+    assert status == {"words": "skipped", "upper": "ran", "count": "ran"}
+    assert (project[0] / "count.csv").read_text() == "12"
+
+def test_identical_output_stops_rerun(project):
+    make_pipeline(project).run(["count"])
+    status = make_pipeline(project).run(["count"], force=["words"])
+    assert status == {"words": "ran", "upper": "skipped", "count": "skipped"}
+
+def test_source_change_reruns_everything_after_it(project):
+    make_pipeline(project).run(["count"])
+    (project[0] / "source.csv").write_text("Stonewall Inn")
+    assert set(make_pipeline(project).run(["count"]).values()) == {"ran"}
+    assert (project[0] / "upper.csv").read_text() == "STONEWALL INN"
+
+def test_module_change_invalidates_stages_using_it(project):
+    make_pipeline(project).run(["count"])
+    # only stage_words imports from pipe_helper. The module loaded before the
+    # edit still runs, so words is rewritten identically and nothing after it runs
+    (project[0] / "pipe_helper.py").write_text(HELPER + "\n# edited\n")
+    status = make_pipeline(project).run(["count"])
+    assert status == {"words": "ran", "upper": "skipped", "count": "skipped"}
+
+def test_missing_output_raises(project):
+    with pytest.raises(FileNotFoundError, match="lazy did not write lazy"):
+        make_pipeline(project).run(["lazy"])
@@ -0,0 +1,101 @@
+import pandas as pd
+import pytest
+
+from preprocessing import LemmaCache, clean_text, clean_texts
+
+EDGE_CASES = [
+    "",
+    "   ",
+    "!!!",
+    "...?!--",
+    "“”‘’",
+    "Prop 8 passed in 2008",
+    "abc123def 42nd street a1 1a _9_ x_1",
+    "ends with digit 7",
+    "7",
+    "Rate was 3.5% in '99",
+    "H.I.V. and AIDS, H I V",
+    "The N.Y.C. Pride March — “Stonewall” at 50",
+    "Café, naïve résumé ÉCOLE",
+    "İstanbul ΣΟΦΊΑ straße",
+    "Arabic digits ٣ and ٤٥ and superscript x² ½",
+    "tabs\tand\nnewlines\r\n",
+    "under_score and snake_case_2",
+    "emoji 🏳️‍🌈 pride",
+]
+
+@pytest.mark.parametrize("text", EDGE_CASES)
+def test_clean_texts_matches_clean_text(text):
+    assert clean_texts([text]) == [clean_text(text)]
+
+def test_clean_texts_batch_and_series():
+    assert clean_texts(EDGE_CASES) == list(map(clean_text, EDGE_CASES))
+    series = pd.Series(EDGE_CASES, index=range(10, 10 + len(EDGE_CASES)), name="article_text")
+    clean = clean_texts(series)
+    assert clean.index.equals(series.index) and clean.name == "article_text"
+    assert clean.tolist() == list(map(clean_text, EDGE_CASES))
+
+def test_clean_texts_empty():
+    assert clean_texts([]) == []
+
+class CountingLemmatizer:
+    # stands in for WordNetLemmatizer.lemmatize, counting calls
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, word, pos):
+        self.calls.append((word, pos))
+        return word.rstrip("s")
+
+def test_lemma_cache_lookup():
+    cache, lemmatize = LemmaCache(), CountingLemmatizer()
+    assert [cache.lookup(w, "n", lemmatize) for w in ["cats", "dogs", "cats", "cats"]] == ["cat", "dog", "cat", "cat"]
+    assert cache.lookup("cats", "v", lemmatize) == "cat"
+    assert lemmatize.calls == [("cats", "n"), ("dogs", "n"), ("cats", "v")]
+    assert cache.stats() == {"size": 3, "hits": 2, "misses": 3, "hit_rate": 0.4}
+
+def test_lemma_cache_size_bound():
+    cache, lemmatize = LemmaCache(max_size=3), CountingLemmatizer()
+    for word in ["a", "b", "c", "d"]:
+        cache.lookup(word, "n", lemmatize)
+    # oldest pair dropped, and looked up again on its next use
+    assert list(cache.lemmas) == [("b", "n"), ("c", "n"), ("d", "n")]
+    cache.lookup("a", "n", lemmatize)
+    assert len(cache.lemmas) == 3 and lemmatize.calls.count(("a", "n")) == 2
+    cache.merge({("e", "n"): "e", ("f", "n"): "f"})
+    assert list(cache.lemmas) == [("a", "n"), ("e", "n"), ("f", "n")]
+
+def test_lemma_cache_merges_worker_lemmas():
+    # as lemmatize_documents does: workers seeded with the parent's lemmas
+    # send back only the pairs they looked up, with their hit and miss counts
+    parent, lemmatize = LemmaCache(), CountingLemmatizer()
+    parent.lookup("cats", "n", lemmatize)
+    parent.take_new()
+    workers = [LemmaCache(), LemmaCache()]
+    for worker, words in zip(workers, [["cats", "dogs"], ["dogs", "birds", "birds"]]):
+        worker.merge(parent.lemmas)
+        for word in words:
+            worker.lookup(word, "n", lemmatize)
+    for worker in workers:
+        parent.merge(worker.take_new(), worker.hits, worker.misses)
+    assert parent.lemmas == {("cats", "n"): "cat", ("dogs", "n"): "dog", ("birds", "n"): "bird"}
+    assert (parent.hits, parent.misses) == (0 + 1 + 1, 1 + 1 + 2)
+    # take_new empties, so the next chunk only sends what is new since
+    assert all(worker.take_new() == {} for worker in workers)
+    workers[0].lookup("fish", "n", lemmatize)
+    assert workers[0].take_new() == {("fish", "n"): "fish"}
+
+def test_lemma_cache_save_load(tmp_path):
+    cache, lemmatize = LemmaCache(), CountingLemmatizer()
+    for word in ["cats", "dogs", "birds"]:
+        cache.lookup(word, "n", lemmatize)
+    path = str(tmp_path / "lemma_cache.p")
+    cache.save(path)
+    loaded = LemmaCache.load(path)
+    assert loaded.lemmas == cache.lemmas and list(loaded.lemmas) == list(cache.lemmas)
+    # loaded pairs aren't new, and counts start over
+    assert loaded.take_new() == {} and (loaded.hits, loaded.misses) == (0, 0)
+    assert loaded.lookup("dogs", "n", lemmatize) == "dog" and lemmatize.calls.count(("dogs", "n")) == 1
+    # a smaller bound keeps the newest pairs
+    assert list(LemmaCache.load(path, max_size=2).lemmas) == [("dogs", "n"), ("birds", "n")]
+    assert LemmaCache.load(str(tmp_path / "missing.p")).lemmas == {}
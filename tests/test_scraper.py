@@ -0,0 +1,105 @@
+import pandas as pd
+import pytest
+
+import scraper
+from crawl_store import CATEGORICAL_COLUMNS
+from scraper import (PAGE_SIZE, fetch_weeks, get_with_retry, nyt_lgbtq_api, parse_api, parse_api_columns,
+                     scrape_article_text, scrape_articles)
+from synthetic_corpus import (StubServer, api_response, article_url, synthetic_doc, synthetic_vocab,
+                              week_windows)
+
+@pytest.fixture
+def waits(monkeypatch):
+    # record retry sleeps instead of sleeping
+    waits = []
+    monkeypatch.setattr(scraper.time, "sleep", waits.append)
+    return waits
+
+def sequential_pages(stub, windows):
+    # one request per page, one window after another, as the crawl used to run
+    pages = {}
+    for begin_date, end_date in windows:
+        first = nyt_lgbtq_api(begin_date, end_date, "test", base_url=stub.api_url)
+        n_pages = -(-first["response"]["meta"]["hits"] // PAGE_SIZE)
+        pages[begin_date, end_date] = [first] + [nyt_lgbtq_api(begin_date, end_date, "test", page=page,
+                                                               base_url=stub.api_url)
+                                                 for page in range(1, n_pages)]
+    return pages
+
+def test_fetch_weeks_pages_past_ten_hits():
+    windows = week_windows(60, docs_per_week=25)
+    with StubServer(60, docs_per_week=25) as stub:
+        fetched = {(begin, end): pages for begin, end, pages in fetch_weeks(windows, "test", requests_per_minute=1e9,
+                                                                            base_url=stub.api_url)}
+    # 25, 25 and 10 docs a week, 10 to a page
+    assert [len(fetched[w]) for w in windows] == [3, 3, 1]
+    ids = [doc["_id"] for w in windows for page in fetched[w] for doc in page["response"]["docs"]]
+    assert len(ids) == len(set(ids)) == 60
+
+def test_fetch_weeks_matches_sequential():
+    windows = week_windows(75, docs_per_week=25)
+    with StubServer(75, docs_per_week=25) as stub:
+        baseline = sequential_pages(stub, windows)
+        fetched = {(begin, end): pages for begin, end, pages in fetch_weeks(windows, "test", requests_per_minute=1e9,
+                                                                            base_url=stub.api_url)}
+    assert fetched == baseline
+    expected = pd.DataFrame([row for w in windows for page in baseline[w] for row in parse_api(page)])
+    frame = pd.DataFrame(parse_api_columns(page for w in windows for page in fetched[w]))
+    pd.testing.assert_frame_equal(frame, expected, check_dtype=False, check_categorical=False)
+
+def test_parse_api_columns_matches_parse_api():
+    vocab = synthetic_vocab()
+    docs = [synthetic_doc(i, vocab=vocab) for i in range(45)]
+    # fields the API leaves out are parsed as ""
+    del docs[3]["abstract"], docs[17]["news_desk"], docs[40]["word_count"]
+    docs[5]["keywords"] = []
+    pages = [api_response(docs[i:i + PAGE_SIZE], len(docs)) for i in range(0, len(docs), PAGE_SIZE)]
+    pages.append(api_response([], 0))
+    expected = pd.concat([pd.DataFrame(parse_api(page)) for page in pages], ignore_index=True)
+    expected = expected.astype({column: "category" for column in CATEGORICAL_COLUMNS})
+    pd.testing.assert_frame_equal(pd.DataFrame(parse_api_columns(pages)), expected)
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_get_with_retry_honours_retry_after(status, waits):
+    with StubServer(5, fail_first=2, fail_status=status, retry_after="7") as stub:
+        response = get_with_retry(article_url(0, stub.base_url))
+        assert response.status_code == 200
+        assert stub.requests == 3
+    # Retry-After plus up to a second of jitter, rather than the backoff
+    assert len(waits) == 2
+    assert all(7 <= wait < 8 for wait in waits)
+
+def test_get_with_retry_backs_off_without_retry_after(waits):
+    with StubServer(5, fail_first=2) as stub:
+        get_with_retry(article_url(0, stub.base_url), backoff=2)
+    assert [int(wait) for wait in waits] == [2, 4]
+
+def test_get_with_retry_gives_up(waits):
+    with StubServer(5, fail_first=10, fail_status=503) as stub:
+        with pytest.raises(scraper.requests.HTTPError):
+            get_with_retry(article_url(0, stub.base_url), max_retries=2)
+        assert stub.requests == 3
+
+def test_fetch_weeks_retries_throttled_pages(waits):
+    windows = week_windows(50, docs_per_week=25)
+    with StubServer(50, docs_per_week=25, fail_status=429, retry_after="1") as stub:
+        baseline = sequential_pages(stub, windows)
+        stub.fail_first, stub.requests = 1, 0
+        fetched = {(begin, end): pages for begin, end, pages in fetch_weeks(windows, "test", requests_per_minute=1e9,
+                                                                            base_url=stub.api_url)}
+        # every page throttled once, then served
+        assert stub.requests == 2 * 6
+    assert fetched == baseline
+    # waits under a second are the rate limiter's
+    assert sorted(wait for wait in waits if wait >= 1e-3) == pytest.approx([1.5] * 6, abs=0.5)
+
+def test_scrape_articles_matches_sequential(waits):
+    with StubServer(30, fail_status=503, retry_after="0") as stub:
+        articles = [(i, article_url(i, stub.base_url)) for i in range(30)]
+        baseline = {_id: scrape_article_text(url) for _id, url in articles}
+        stub.fail_first = 1
+        texts = dict(scrape_articles(articles, per_host=4, requests_per_second=1e9))
+        assert stub.requests == 2 * 30 + 30
+    assert texts == baseline
+    assert all(baseline.values())
+    assert max(waits) < 1
@@ -0,0 +1,108 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+from sklearn.decomposition import NMF
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+import topic_service
+from modeling import save_topic_model
+from preprocessing import clean_texts
+from synthetic_corpus import synthetic_texts
+from topic_service import TopicService, cd_transform, make_server
+
+TEXTS = synthetic_texts(500, mean_words=150)
+
+@pytest.fixture
+def no_nltk(monkeypatch):
+    # NLTK models aren't needed to test the transform, lemmatizing is a no-op
+    monkeypatch.setattr(topic_service, "load_nlp_models", lambda *args: None)
+    monkeypatch.setattr(topic_service, "lemmatize_text", lambda text, lemma_cache=None: text)
+
+def fit_service(tmp_path, **nmf_params):
+    cv = TfidfVectorizer(min_df=2)
+    doc_word = cv.fit_transform(clean_texts(TEXTS[:400]))
+    nmf_model = NMF(9, random_state=0, max_iter=500, **nmf_params)
+    save_topic_model(str(tmp_path / "topic_model.p"), cv, nmf_model, doc_word, nmf_model.fit_transform(doc_word))
+    return TopicService(str(tmp_path / "topic_model.p"), lemma_cache_path=None), nmf_model, cv
+
+@pytest.mark.parametrize("nmf_params", [{}, {"alpha_W": 1e-6, "l1_ratio": 0.5}, {"alpha_W": 1e-6, "l1_ratio": 0.0}])
+def test_transform_matches_sklearn(tmp_path, no_nltk, nmf_params):
+    service, nmf_model, cv = fit_service(tmp_path, **nmf_params)
+    assert service.fast
+    new = clean_texts(TEXTS[400:])
+    expected = nmf_model.transform(cv.transform(new))
+    np.testing.assert_allclose(service.transform(new), expected, atol=1e-6)
+    # one document at a time, as assign_topic does
+    for text in new[:5]:
+        np.testing.assert_allclose(service.transform([text]), nmf_model.transform(cv.transform([text])), atol=1e-6)
+
+def test_transform_empty(tmp_path, no_nltk):
+    service, nmf_model, cv = fit_service(tmp_path)
+    assert service.transform([]).shape == (0, 9)
+    # no words in the vocabulary
+    np.testing.assert_array_equal(service.transform(["zzzz"]), np.zeros((1, 9)))
+
+def test_cd_transform_zero_topic():
+    # a topic with no weight anywhere keeps zero weight
+    HHt = np.diag([2.0, 0.0])
+    W = cd_transform(np.array([[4.0, 1.0]]), HHt)
+    np.testing.assert_allclose(W, [[2.0, 0.0]])
+
+@pytest.fixture
+def server(tmp_path, no_nltk):
+    service, nmf_model, cv = fit_service(tmp_path)
+    server = make_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", service
+    server.shutdown()
+    server.server_close()
+
+def request(url, data=None):
+    # (status, json body)
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data)) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+def post(url, body):
+    return request(url + "/topics", json.dumps(body).encode())
+
+def test_health(server):
+    url, service = server
+    assert request(url + "/health") == (200, {"status": "ok"})
+    assert request(url + "/missing")[0] == 404
+
+def test_post_text(server):
+    url, service = server
+    status, body = post(url, {"text": TEXTS[450]})
+    assert status == 200
+    assert body == service.assign_topic(TEXTS[450])
+    assert body["topic_name"] == topic_service.TOPIC_DICT[body["topic"]]
+
+def test_post_texts(server):
+    url, service = server
+    status, body = post(url, {"texts": TEXTS[450:455]})
+    assert status == 200
+    expected = service.assign_topics(TEXTS[450:455])
+    assert [topic["topic"] for topic in body["topics"]] == expected["topic"].tolist()
+    np.testing.assert_allclose([topic["weight"] for topic in body["topics"]], expected["weight"])
+    assert post(url, {"texts": []}) == (200, {"topics": []})
+
+@pytest.mark.parametrize("body", [{"texts": ["ok", 3]}, {"texts": [None]}, {"texts": [["nested"]]}])
+def test_post_non_string_texts(server, body):
+    status, response = post(server[0], body)
+    assert status == 400
+    assert response["error"] == '"texts" must be a list of strings'
+
+@pytest.mark.parametrize("data", [b"not json", b"{", b""])
+def test_post_bad_json(server, data):
+    assert request(server[0] + "/topics", data)[0] == 400
+
+@pytest.mark.parametrize("body", [{"foo": 1}, [1, 2], {"text": 3}])
+def test_post_wrong_shape(server, body):
+    assert post(server[0], body)[0] == 400
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from PIL import Image
+from palettable.colorbrewer.diverging import Spectral_9
+try:
+    from matplotlib.colors import makeMappingArray
+except ImportError:
+    # renamed in matplotlib 3.3
+    from matplotlib.colors import _create_lookup_table as makeMappingArray
+
+from word_cloud import gradient_mask, gradient_palette
+
+def gradient_mask_loop(mask, gradient_orientation, cmap=Spectral_9.mpl_colormap):
+    # pixel loop as originally done in word_cloud.gradient_cloud
+    mask = mask.copy()
+    imgsize = mask.size
+    palette = makeMappingArray(imgsize[1], cmap)
+    for y in range(imgsize[1]):
+        for x in range(imgsize[0]):
+            if mask.getpixel((x,y)) != (255,255,255):
+                color = palette[y] if gradient_orientation == "vertical" else palette[x]
+                r = int(color[0] * 255)
+                g = int(color[1] * 255)
+                b = int(color[2] * 255)
+                mask.putpixel((x, y), (r, g, b))
+    return np.array(mask)
+
+def icon(width, height):
+    # filled ellipse on white, as icon_mask gives for a transparent icon
+    yy, xx = np.mgrid[:height, :width]
+    inside = ((xx - width / 2) / (width / 2)) ** 2 + ((yy - height / 2) / (height / 2)) ** 2 <= 1
+    pixels = np.full((height, width, 4), 255, dtype=np.uint8)
+    pixels[inside, :3] = (200, 30, 90)
+    return Image.fromarray(pixels, "RGBA")
+
+@pytest.mark.parametrize("orientation", ["vertical", "horizontal"])
+@pytest.mark.parametrize("width, height", [(40, 70), (50, 50), (1, 30)])
+def test_gradient_mask_matches_loop(width, height, orientation):
+    mask = icon(width, height)
+    assert np.array_equal(gradient_mask(mask, orientation), gradient_mask_loop(mask, orientation))
+
+def test_gradient_mask_matches_loop_wide_vertical():
+    mask = icon(70, 40)
+    assert np.array_equal(gradient_mask(mask, "vertical"), gradient_mask_loop(mask, "vertical"))
+
+def test_gradient_mask_wide_horizontal():
+    # the loop ran out of colors here, the gradient spans the width instead
+    colored = gradient_mask(icon(70, 40), "horizontal")
+    assert np.array_equal(colored[:, :, :3], np.broadcast_to(gradient_palette(70)[None], (40, 70, 3)))
+
+def test_gradient_mask_palette_length():
+    colored = gradient_mask(icon(40, 70), "horizontal", palette_length=40)
+    assert np.array_equal(colored[0, :, :3], gradient_palette(40))
+    with pytest.raises(ValueError):
+        gradient_mask(icon(40, 70), "vertical", palette_length=40)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Assigns one of the 9 NMF topics to new articles, using the vectorizer and
+NMF model saved by modeling.NMF_topic_words, without refitting
+The model, NLTK tagger and lemma cache are loaded once and kept warm, so a
+single article costs cleaning, lemmatizing, one sparse transform and a few
+9 x 9 solver iterations. Can be used from Python or as a local HTTP endpoint
+
+e.g. python topic_service.py --port 8000
+     curl -d '{"text": "The couple married at city hall"}' localhost:8000/topics
+
+@author: markfunke
+"""
+
+import json
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+from preprocessing import clean_texts, lemmatize_text, lemmatize_documents, load_nlp_models, LemmaCache
+from modeling import TOPIC_DICT, load_topic_model
+
+def cd_transform(XHt, HHt, max_iter=200, tol=1e-4):
+    """
+    Doc-topic weights of documents with the topic-word matrix H held fixed,
+    by the coordinate descent of sklearn's NMF.transform (solver "cd"),
+    vectorized over documents. sklearn recomputes H H' (topics x vocabulary
+    x topics) on every call, here it is computed once per model
+
+    Parameters
+    ----------
+    XHt : array
+        (documents, topics) product of the document-term matrix and H'
+    HHt : array
+        (topics, topics) H H', plus any l2 penalty on the diagonal
+    max_iter, tol : same as the NMF model
+
+    Returns
+    -------
+    W : array
+        (documents, topics) doc-topic weights
+
+    """
+    W = np.zeros_like(XHt)
+    n_topics = HHt.shape[0]
+    violation_init = None
+    for _ in range(max_iter):
+        violation = 0.0
+        for t in range(n_topics):
+            grad = W @ HHt[t] - XHt[:, t]
+            # projected gradient, only negative gradients count at the bound
+            violation += np.abs(np.where(W[:, t] == 0, np.minimum(grad, 0), grad)).sum()
+            if HHt[t, t] != 0:
+                W[:, t] = np.maximum(W[:, t] - grad / HHt[t, t], 0)
+        if violation_init is None:
+            violation_init = violation
+        if violation_init == 0 or violation / violation_init <= tol:
+            break
+    return W
+
+class TopicService:
+    """
+    Warm topic model for assigning topics to new articles
+
+    Parameters
+    ----------
+    model_path : string
+        topic model saved by NMF_topic_words / save_topic_model
+    lemma_cache_path : string
+        lemma cache saved by preprocessing.py, None to start empty
+    n_jobs : int
+        lemmatizer processes kept for batches of at least pool_min documents,
+        1 (default) lemmatizes everything in this process
+    pool_min : int
+        smallest batch sent to the lemmatizer pool
+    topic_names : dictionary
+        topic number -> name, default is modeling.TOPIC_DICT
+
+    """
+    def __init__(self, model_path="pickles/topic_model.p", lemma_cache_path="pickles/lemma_cache.p",
+                 n_jobs=1, pool_min=50, topic_names=TOPIC_DICT):
+        model = load_topic_model(model_path)
+        self.cv, self.nmf = model["vectorizer"], model["nmf"]
+        self.topic_names = topic_names
+        self.pool_min = pool_min
+
+        # H' and H H' with the model's W penalties, as sklearn's transform applies them
+        self.Ht = np.ascontiguousarray(self.nmf.components_.T)
+        self.HHt = self.Ht.T @ self.Ht
+        n_features = self.Ht.shape[0]
+        alpha_W, l1_ratio = getattr(self.nmf, "alpha_W", 0.0), self.nmf.l1_ratio
+        self.l1_reg = n_features * alpha_W * l1_ratio
+        self.HHt.flat[::self.HHt.shape[0] + 1] += n_features * alpha_W * (1 - l1_ratio)
+        # the "mu" solver isn't coordinate descent, use sklearn's transform
+        self.fast = getattr(self.nmf, "solver", "cd") == "cd"
+
+        self.lemma_cache = LemmaCache.load(lemma_cache_path) if lemma_cache_path else LemmaCache()
+        self.lock = threading.Lock()
+        load_nlp_models()
+        self.executor = None
+        if n_jobs != 1:
+            self.executor = ProcessPoolExecutor(max_workers=n_jobs, initializer=load_nlp_models,
+                                                initargs=(self.lemma_cache.lemmas,))
+
+    def lemmatize(self, texts):
+        """
+        Cleans and lemmatizes documents as preprocessing.py does
+        """
+        cleaned = clean_texts(list(texts))
+        if self.executor is not None and len(cleaned) >= self.pool_min:
+            with self.lock:
+                return lemmatize_documents(cleaned, lemma_cache=self.lemma_cache, executor=self.executor)
+        # the tagger is shared by request threads, the lemma cache isn't thread safe
+        with self.lock:
+            return [lemmatize_text(text, self.lemma_cache) for text in cleaned]
+
+    def transform(self, lemmatized):
+        """
+        Returns (documents, topics) doc-topic weights of lemmatized documents
+        """
+        if not len(lemmatized):
+            return np.zeros((0, self.HHt.shape[0]))
+        doc_word = self.cv.transform(lemmatized)
+        if not self.fast:
+            return self.nmf.transform(doc_word)
+        XHt = np.asarray(doc_word @ self.Ht)
+        if self.l1_reg:
+            XHt -= self.l1_reg
+        return cd_transform(XHt, self.HHt, self.nmf.max_iter, self.nmf.tol)
+
+    @instrumentation.stage("assign_topics", items=instrumentation.count_items)
+    def assign_topics(self, texts):
+        """
+        Assigns the most likely topic to each document
+
+        Parameters
+        ----------
+        texts : Series or list
+            raw article text
+
+        Returns
+        -------
+        topics : DataFrame
+            "topic", "topic_name", "weight" of the topic, and the weights of
+            every topic ("topic0", "topic1", ...), one row per document.
+            Documents with no words in the vocabulary have weight 0
+
+        """
+        doc_topic = self.transform(self.lemmatize(texts))
+        topics = pd.DataFrame(doc_topic, columns=[f"topic{t}" for t in range(doc_topic.shape[1])])
+        topics.insert(0, "topic", doc_topic.argmax(axis=1))
+        topics.insert(1, "topic_name", topics["topic"].map(self.topic_names))
+        topics.insert(2, "weight", doc_topic.max(axis=1))
+        if isinstance(texts, pd.Series):
+            topics.index = texts.index
+        return topics
+
+    def assign_topic(self, text):
+        """
+        Assigns the most likely topic to one document
+
+        Returns
+        -------
+        dictionary
+            "topic", "topic_name", "weight" and "weights" of every topic
+
+        """
+        # skips building a DataFrame, which costs as much as the transform
+        weights = self.transform(self.lemmatize([text]))[0]
+        topic = int(weights.argmax())
+        return {"topic": topic, "topic_name": self.topic_names[topic], "weight": float(weights[topic]),
+                "weights": weights.round(6).tolist()}
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def make_server(service, host="127.0.0.1", port=8000):
+    """
+    HTTP server for a TopicService. POST /topics with json {"text": ...}
+    returns the topic of one document, {"texts": [...]} returns
+    {"topics": [...]} in the same order. GET /health checks it is up
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        call serve_forever() to start
+
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # keep small responses from waiting on delayed acks
+        disable_nagle_algorithm = True
+
+        def send_json(self, status, body):
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, {"status": "ok"})
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/topics":
+                self.send_json(404, {"error": "not found"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if not isinstance(request, dict):
+                    request = {}
+                if isinstance(request.get("text"), str):
+                    self.send_json(200, service.assign_topic(request["text"]))
+                elif isinstance(request.get("texts"), list):
+                    if not all(isinstance(text, str) for text in request["texts"]):
+                        self.send_json(400, {"error": '"texts" must be a list of strings'})
+                        return
+                    topics = service.assign_topics(request["texts"])[["topic", "topic_name", "weight"]]
+                    self.send_json(200, {"topics": topics.to_dict(orient="records")})
+                else:
+                    self.send_json(400, {"error": 'expected {"text": string} or {"texts": [strings]}'})
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="pickles/topic_model.p")
+    parser.add_argument("--lemma-cache", default="pickles/lemma_cache.p")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--n-jobs", type=int, default=1, help="lemmatizer processes for large batches")
+    args = parser.parse_args()
+
+    with TopicService(args.model, args.lemma_cache, n_jobs=args.n_jobs) as service:
+        # first request pays for WordNet's lazy loading otherwise
+        service.assign_topic("warm up")
+        server = make_server(service, args.host, args.port)
+        print(f"serving topics on http://{args.host}:{server.server_address[1]}/topics")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
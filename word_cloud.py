@@ -6,46 +6,103 @@ Creates wordclouds for topic modeling
 @author: markfunke
 """
 
-import pandas as pd
+import os
+import json
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 import numpy as np
 from wordcloud import WordCloud, ImageColorGenerator
 from palettable.colorbrewer.diverging import Spectral_9
-from matplotlib.colors import makeMappingArray
 import matplotlib.pyplot as plt
+import instrumentation
+
+def topic_word_dict(top_words, topic_num, num_words):
+    """
+    Returns dictionary of the num_words highest weighted words of a topic,
+    from top_words saved by modeling.NMF_topic_words
+    """
+    ids = top_words["word_ids"][topic_num, :num_words]
+    return dict(zip(top_words["vocab"][ids], top_words["weights"][topic_num, :num_words]))
+
+def max_word_weights(top_words):
+    """
+    Returns dictionary of every kept word and its highest weight over all topics
+    """
+    weights = np.zeros(len(top_words["vocab"]), dtype=top_words["weights"].dtype)
+    np.maximum.at(weights, top_words["word_ids"].ravel(), top_words["weights"].ravel())
+    return dict(zip(top_words["vocab"], weights))
+
+# (topic, file name) of the cloud made for each NMF topic
+TOPIC_CLOUDS = [(0,"love"), (1,"marriage"), (2,"religion"), (3,"military"), (4,"politics"),
+                (5,"parade"), (6,"HIV"), (7,"gender"), (8,"scouts")]
+
+# Manual edits to clean up certain words, by topic
+WORD_RENAMES = {6: {"aid": "AIDS", "hivaids": "HIV", "dr": "doctor"}}
+
+def title_cloud_dict(top_words):
+    """
+    Words from all topics for the title slide, each at its highest topic
+    weight, plus the title "LGBTQ in the New York Times" as the largest
+    """
+    cloud_dict = max_word_weights(top_words)
+    
+    # Add Title Words as the largest frequency
+    cloud_dict["LGBTQ in the New York Times"] = 30
+    
+    # Nitpicky edits to clean up image
+    for old, new in WORD_RENAMES[6].items():
+        if old in cloud_dict:
+            cloud_dict[new] = cloud_dict.pop(old)
+    cloud_dict["AIDS"] = 2.4
+    cloud_dict["civil union"] = 2.4
+    cloud_dict["supreme court"] = 2.4
+    cloud_dict["love"] = 2
+    return cloud_dict
+
+def cloud_words(top_words, topic_num, num_words):
+    """
+    Returns word dictionary for a topic cloud, with WORD_RENAMES applied
+    """
+    word_dict = topic_word_dict(top_words, topic_num, num_words)
+    for old, new in WORD_RENAMES.get(topic_num, {}).items():
+        if old in word_dict:
+            word_dict[new] = word_dict.pop(old)
+    return word_dict
+
+def topic_cloud(word_dict, mask, font_path):
+    """
+    Lays out a topic word cloud: black words on a transparent background
+    """
+    return WordCloud(font_path=font_path, width=3000, height=2000, mode = "RGBA",color_func=lambda *args, **kwargs: "black", background_color=None,collocations=True, mask=mask).generate_from_frequencies(word_dict)
 
 # Create Word Cloud for topics
-def create_word_cloud(topic_word,topic_num,mask,num_words,file_name):
+@instrumentation.stage("create_word_cloud")
+def create_word_cloud(top_words,topic_num,mask,num_words,file_name,font_path="font/AmaticSC-Bold.ttf"):
     """
 
     Parameters
     ----------
-    topic_word : DataFrame 
-        topic-word  matrix output
+    top_words : dictionary
+        top words of each topic, see modeling.top_topic_words
     topic_num : integer
-        topic column in matrix to create word cloud
+        topic to create word cloud
     mask : array
         image array to fit word cloud shape
     num_words : integer
         number of words to include in word cloud
     file_name : string
         path of filename to save
+    font_path : string
+        path to font to use for wordcloud
 
     Returns
     -------
     None. Saves wordcloud file.
 
     """
-    topic_words = topic_word.sort_values(by=columns[topic_num], ascending=False).iloc[0:num_words,topic_num].reset_index()
-    word_dict = dict(zip(topic_words.iloc[:,0], topic_words.iloc[:,1]))
-    
-    # manual edits to clean up certain words
-    if topic_num == 6:
-        word_dict["AIDS"] = word_dict.pop("aid")
-        word_dict["HIV"] = word_dict.pop("hivaids")
-        word_dict["doctor"] = word_dict.pop("dr")
-    
-    wc = WordCloud(font_path=font_path, width=3000, height=2000, mode = "RGBA",color_func=lambda *args, **kwargs: "black", background_color=None,collocations=True, mask=mask).generate_from_frequencies(word_dict)
+    wc = topic_cloud(cloud_words(top_words, topic_num, num_words), mask, font_path)
     
     plt.figure( figsize=(20,10), facecolor='k')
     plt.imshow(wc)
@@ -54,13 +111,178 @@ def create_word_cloud(topic_word,topic_num,mask,num_words,file_name):
     plt.show()
     wc.to_file(f"images/word_clouds/{file_name}.png")
     
-def gradient_cloud(cloud_dict, icon_path, font_path, gradient_orientation, output_path):
+def occupancy_mask(mask_path):
+    """
+    Reads a mask image once and reduces it to the 2D array WordCloud uses:
+    255 where words can't go (white in the image), 0 elsewhere
+    """
+    mask = np.array(Image.open(mask_path))
+    # RGB only, as WordCloud compares mask[:, :, :3] and ignores alpha
+    blocked = (mask == 255) if mask.ndim == 2 else (mask[..., :3] == 255).all(axis=-1)
+    return np.where(blocked, 255, 0).astype(np.uint8)
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def cloud_digest(word_dict, mask_digest, font_path):
+    """
+    Hash of everything a topic cloud is rendered from, see render_word_clouds
+    """
+    words = sorted((word, round(float(weight), 6)) for word, weight in word_dict.items())
+    return hashlib.sha256(json.dumps([words, mask_digest, font_path]).encode()).hexdigest()
+
+# Occupancy masks of a render worker, set once per process by render_worker_init
+_render_masks = {}
+
+def render_worker_init(masks):
+    _render_masks.update(masks)
+
+def render_cloud(word_dict, mask_path, font_path, output_path):
+    # runs in a worker process, no matplotlib figure needed to save
+    topic_cloud(word_dict, _render_masks[mask_path], font_path).to_file(output_path)
+    return output_path
+
+@instrumentation.stage("render_word_clouds", items=lambda rendered, *args, **kwargs: len(rendered))
+def render_word_clouds(top_words, jobs, font_path, out_dir="images/word_clouds", num_words=40,
+                       n_jobs=None, skip_unchanged=True):
+    """
+    Renders topic word clouds headless across a process pool. Each mask is
+    read and reduced to its occupancy array once, and sent once to each
+    worker. A manifest in out_dir records the hash of each cloud's words,
+    mask and font, so clouds whose inputs haven't changed are not re-rendered
+    
+    Parameters
+    ----------
+    top_words : dictionary
+        top words of each topic, see modeling.top_topic_words
+    jobs : list
+        (topic_num, file_name, mask_path) for each cloud
+    font_path : string
+        path to font to use for wordclouds
+    out_dir : string
+        directory to save clouds, as out_dir/file_name.png
+    num_words : integer
+        number of words to include in each word cloud
+    n_jobs : int
+        worker processes, default is number of cpus
+    skip_unchanged : bool
+        skip clouds whose manifest hash matches and whose file exists
+
+    Returns
+    -------
+    rendered : list
+        paths of the clouds rendered, skipped clouds are left out
+
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    
+    mask_digests = {mask_path: file_digest(mask_path) for _, _, mask_path in jobs}
+    todo = []
+    for topic_num, file_name, mask_path in jobs:
+        word_dict = cloud_words(top_words, topic_num, num_words)
+        output_path = os.path.join(out_dir, f"{file_name}.png")
+        digest = cloud_digest(word_dict, mask_digests[mask_path], font_path)
+        if skip_unchanged and manifest.get(file_name) == digest and os.path.exists(output_path):
+            continue
+        todo.append((file_name, digest, word_dict, mask_path, output_path))
+    if not todo:
+        return []
+    
+    masks = {mask_path: occupancy_mask(mask_path) for mask_path in {job[3] for job in todo}}
+    rendered = []
+    with ProcessPoolExecutor(n_jobs, initializer=render_worker_init, initargs=(masks,)) as executor:
+        futures = [(file_name, digest, executor.submit(render_cloud, word_dict, mask_path, font_path, output_path))
+                   for file_name, digest, word_dict, mask_path, output_path in todo]
+        for file_name, digest, future in futures:
+            rendered.append(future.result())
+            manifest[file_name] = digest
+            # written after every cloud, so a crash keeps finished ones
+            with open(manifest_path, "w") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+    return rendered
+
+def icon_mask(icon_path):
+    """
+    Opens icon and pastes it onto a white RGBA image, using the icon's own
+    alpha, so transparent areas become white (no words) in the word cloud mask
+    """
+    icon = Image.open(icon_path).convert("RGBA")
+    mask = Image.new("RGBA", icon.size, (255,255,255))
+    mask.paste(icon,icon)
+    return mask
+
+def gradient_palette(length, cmap=Spectral_9.mpl_colormap):
+    """
+    Returns (length, 3) uint8 array of RGB colors linearly interpolated
+    across cmap, as matplotlib makeMappingArray did
+    """
+    # matplotlib color maps are from range of (0,1). Convert to RGB,
+    # truncating like int()
+    return (cmap(np.linspace(0, 1, length))[:, :3] * 255).astype(np.uint8)
+
+def gradient_mask(mask, gradient_orientation, cmap=Spectral_9.mpl_colormap, skip_white=False,
+                  palette_length=None):
+    """
+    Colors the icon with a linear gradient, as whole-array operations
+
+    Parameters
+    ----------
+    mask : Image or array
+        RGBA icon from icon_mask
+    gradient_orientation : string
+        "vertical" for vertical gradient, else horizonatal
+    cmap : matplotlib colormap
+        colors of the gradient, default is Spectral_9
+    skip_white : bool
+        leave white pixels of the icon white. The original pixel loop
+        compared RGBA pixels to an RGB tuple, which never matches, so it
+        colored every pixel. default is False, same output as the loop
+    palette_length : int
+        number of gradient colors, at least the length of the gradient axis.
+        default is the image height, as in the loop, so output is identical
+        to it. Horizontal gradients on wider than tall icons, where the loop
+        ran out of colors, default to the width
+
+    Returns
+    -------
+    colored : array
+        (height, width, 4) uint8 RGBA array
+
+    """
+    colored = np.array(mask, dtype=np.uint8)
+    height, width = colored.shape[:2]
+    axis_length = height if gradient_orientation == "vertical" else width
+    palette = gradient_palette(palette_length or max(height, axis_length), cmap)
+    if len(palette) < axis_length:
+        raise ValueError(f"palette of {len(palette)} colors is shorter than the gradient axis ({axis_length} pixels)")
+
+    # one color per row (vertical) or column (horizontal), broadcast over the image
+    colors = palette[:height, None, :] if gradient_orientation == "vertical" else palette[None, :width, :]
+    colors = np.broadcast_to(colors, (height, width, 3))
+    if skip_white:
+        keep = (colored[:, :, :3] == 255).all(axis=2)
+        colored[:, :, :3] = np.where(keep[:, :, None], colored[:, :, :3], colors)
+        colored[:, :, 3] = np.where(keep, colored[:, :, 3], 255)
+    else:
+        colored[:, :, :3] = colors
+        colored[:, :, 3] = 255
+    return colored
+
+@instrumentation.stage("gradient_cloud")
+def gradient_cloud(cloud_dict, icon_path, font_path, gradient_orientation, output_path,
+                   cmap=Spectral_9.mpl_colormap):
     """
 
     Parameters
     ----------
     cloud_dict : dictionary
-        DESCRIPTION.
+        word -> frequency
     icon_path : string
         path to icon to use for wordcloud shape
     font_path : string
@@ -69,6 +291,8 @@ def gradient_cloud(cloud_dict, icon_path, font_path, gradient_orientation, outpu
         "vertical" for vertical gradient, else horizonatal
     output_path : string
         path of filename to save
+    cmap : matplotlib colormap
+        colors of the gradient, default is Spectral_9
 
     Returns
     -------
@@ -78,31 +302,13 @@ def gradient_cloud(cloud_dict, icon_path, font_path, gradient_orientation, outpu
 
     # Leveraged public github repo code from Max Woolf
     # https://github.com/minimaxir/stylistic-word-clouds/blob/master/wordcloud_cnn_reactions.py
-    # Edited slightly to make into a function
-    icon = Image.open(icon_path).convert("RGBA")
-    mask = Image.new("RGBA", icon.size, (255,255,255))
-    mask.paste(icon,icon)
+    # Edited slightly to make into a function, gradient built with numpy
+    # instead of a getpixel / putpixel loop
+    mask = icon_mask(icon_path)
     mask_wordcloud = np.array(mask)
     
-    # Create a linear gradient using the matplotlib color map
-    imgsize = icon.size
-    palette = makeMappingArray(imgsize[1], Spectral_9.mpl_colormap)   # interpolates colors
-    
-    for y in range(imgsize[1]):
-        for x in range(imgsize[0]):
-        	if mask.getpixel((x,y)) != (255,255,255):   # Only change nonwhite pixels of icon
-        	
-        		color = palette[y] if gradient_orientation == "vertical" else palette[x]
-        		
-        		# matplotlib color maps are from range of (0,1). Convert to RGB.
-        		r = int(color[0] * 255)
-        		g = int(color[1] * 255)
-        		b = int(color[2] * 255)
-        		
-        		mask.putpixel((x, y), (r, g, b))
-    			
     # create coloring from image
-    image_colors = ImageColorGenerator(np.array(mask))
+    image_colors = ImageColorGenerator(gradient_mask(mask, gradient_orientation, cmap))
    
     # generate word cloud     
     wc = WordCloud(font_path=font_path, background_color="black", max_words=2000, mask=mask_wordcloud,
@@ -112,48 +318,27 @@ def gradient_cloud(cloud_dict, icon_path, font_path, gradient_orientation, outpu
     wc.recolor(color_func=image_colors)
     wc.to_file(output_path)
 
-if __name__ == __main__:
+if __name__ == "__main__":
     
-    # Read in final topic-word matrix from NMF results in modeling.py
-    topic_word = pd.read_pickle("pickles/topic_words.p")
+    # Read in top words of each topic from NMF results in modeling.py
+    with open("pickles/topic_words.p", "rb") as f:
+        top_words = pickle.load(f)
     
-    # Convert image to arrays for masks in wordcloud
-    rainbow_mask = np.array(Image.open('images/rainbow.jpg'))
+    font_path = "font/AmaticSC-Bold.ttf"
     
-    # Create clouds for each topic
-    create_word_cloud(topic_word,0,rainbow_mask,40,"love")
-    create_word_cloud(topic_word,1,rainbow_mask,40,"marriage")
-    create_word_cloud(topic_word,2,rainbow_mask,40,"religion")
-    create_word_cloud(topic_word,3,rainbow_mask,40,"military")
-    create_word_cloud(topic_word,4,rainbow_mask,40,"politics")
-    create_word_cloud(topic_word,5,rainbow_mask,40,"parade")
-    create_word_cloud(topic_word,6,rainbow_mask,40,"HIV")
-    create_word_cloud(topic_word,7,rainbow_mask,40,"gender")
-    create_word_cloud(topic_word,8,rainbow_mask,40,"scouts")
+    # Create clouds for each topic, in parallel. Clouds whose words haven't
+    # changed since the last run are skipped.
+    # create_word_cloud shows a single cloud interactively
+    rainbow = 'images/rainbow.jpg'
+    render_word_clouds(top_words, [(topic, name, rainbow) for topic, name in TOPIC_CLOUDS], font_path)
     
     # Create title slide with words from all topics overlayed on a pride flag
     # and the title "LGBTQ in the New York Times"
     
     # Create dictionary of words
-    cloud_df = topic_word.copy()
-    cloud_df["value"] = topic_word.max(axis=1)
-    cloud_df.reset_index(inplace=True)
-    cloud_dict = dict(zip(cloud_df.iloc[:,0], cloud_df.iloc[:,-1]))
-    
-    # Add Title Words as the largest frequency
-    cloud_dict["LGBTQ in the New York Times"] = 30
-    
-    # Nitpicky edits to clean up image
-    cloud_dict["AIDS"] = cloud_dict.pop("aid")
-    cloud_dict["HIV"] = cloud_dict.pop("hivaids")
-    cloud_dict["doctor"] = cloud_dict.pop("dr")
-    cloud_dict["AIDS"] = 2.4
-    cloud_dict["civil union"] = 2.4
-    cloud_dict["supreme court"] = 2.4
-    cloud_dict["love"] = 2
+    cloud_dict = title_cloud_dict(top_words)
     
     # Generate gradient cloud
-    font_path = "font/AmaticSC-Bold.ttf"
     gradient_orientation = "horizontal"
     icon_path = 'images/rainbow.jpg'
     output_path = "images/flag_title.png"